@@ -0,0 +1,108 @@
+import time
+import threading
+import numpy as np
+
+
+class AnswerCache:
+    '''
+        In-memory cache of generated answers, looked up by the similarity of the query embeddings
+        so that near-duplicate questions reuse a previous answer.
+
+        Entries expire after `ttl` seconds and the oldest entries are dropped beyond `max_entries`.
+        An entry only matches queries asked with the same generative model and topic.
+        The vectors are kept in a preallocated ring buffer of `max_entries` rows, so storing an entry copies nothing.
+    '''
+
+    def __init__(self, dimension: int = 384, max_entries: int = 1000, ttl: float = 86400.0):
+        self.dimension = dimension
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.vectors = np.zeros((max_entries, dimension), dtype=np.float32)
+        self.entries = [None] * max_entries
+        # the entries are the `size` slots from `start` on, oldest first
+        self.start = 0
+        self.size = 0
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+
+    def lookup(self, vector, model: str, topic: str = None, threshold: float = 0.95):
+        '''
+            Finds the most similar previous query.
+                Args:
+                    vector: The dense embedding of the query.
+                    model (str): The generative model the answer must come from.
+                    topic (str): The topic of the query, if any.
+                    threshold (float): The minimum cosine similarity of a match.
+                Returns:
+                    dict or None: The stored result, or None if no previous query is similar enough.
+        '''
+
+        vector = normalize(vector)
+        with self.lock:
+            self._expire()
+            if self.size:
+                indices = (self.start + np.arange(self.size)) % self.max_entries
+                scores = (self.vectors @ vector)[indices]
+                for i in np.argsort(-scores):
+                    if scores[i] < threshold:
+                        break
+                    entry = self.entries[indices[i]]
+                    if entry['model'] == model and entry['topic'] == (topic or None):
+                        self.counters['hits'] += 1
+                        return entry['result']
+            self.counters['misses'] += 1
+            return None
+
+
+    def store(self, vector, model: str, result: dict, topic: str = None):
+        if not self.max_entries:
+            return
+        with self.lock:
+            self._expire()
+            index = (self.start + self.size) % self.max_entries
+            # a full buffer overwrites its oldest entry
+            if self.size == self.max_entries:
+                self.start = (self.start + 1) % self.max_entries
+            else:
+                self.size += 1
+            self.vectors[index] = normalize(vector)
+            self.entries[index] = {
+                'model': model,
+                'topic': topic or None,
+                'result': result,
+                'created_at': time.time(),
+            }
+
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        while self.size and self.entries[self.start]['created_at'] < deadline:
+            self.entries[self.start] = None
+            self.start = (self.start + 1) % self.max_entries
+            self.size -= 1
+
+
+    def clear(self):
+        with self.lock:
+            self.entries = [None] * self.max_entries
+            self.start = 0
+            self.size = 0
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                'entries': self.size,
+                'max_entries': self.max_entries,
+            }
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
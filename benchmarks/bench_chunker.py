@@ -0,0 +1,75 @@
+'''
+    Compares the character splitter with the token-aware chunker of `process_docs`.
+
+    For every article it reports the number of chunks, the number of tokens the dense model actually embeds
+    (and the number it silently truncates), and the time spent embedding the chunks with both models.
+
+    usage:
+        python benchmarks/bench_chunker.py Telephone Alexander_Graham_Bell
+        python benchmarks/bench_chunker.py --file article.md
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from widiscover_core import Widiscover
+
+
+def measure(wd: Widiscover, docs: list, sources: list, **chunking):
+    chunks = wd.process_docs(docs, sources, **chunking)
+    texts = [chunk['metadata']['text'] for chunk in chunks]
+    limit = wd.token_chunker.max_tokens
+    tokens = [wd.token_chunker.count(text) for text in texts]
+    start = time.perf_counter()
+    list(wd.vectorizer.embed(texts))
+    dense_time = time.perf_counter() - start
+    start = time.perf_counter()
+    list(wd.sparse_vectorizer.embed(texts))
+    sparse_time = time.perf_counter() - start
+    return {
+        'chunks': len(chunks),
+        'tokens embedded': sum(min(count, limit) for count in tokens),
+        'tokens truncated': sum(max(0, count - limit) for count in tokens),
+        'dense embed (s)': round(dense_time, 3),
+        'sparse embed (s)': round(sparse_time, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('keys', nargs='*', default=['Telephone'], help='Wikipedia page keys')
+    parser.add_argument('--file', action='append', default=[], help='local markdown file(s) instead of Wikipedia pages')
+    parser.add_argument('--length', type=int, default=1800, help='character chunk length')
+    parser.add_argument('--overlap', type=int, default=180, help='character chunk overlap')
+    parser.add_argument('--tokens', type=int, default=256, help='token chunk length')
+    parser.add_argument('--token-overlap', type=int, default=32, help='token chunk overlap')
+    args = parser.parse_args()
+
+    wd = Widiscover()
+    wd.warm_up()
+    if args.file:
+        sources = args.file
+        docs = []
+        for path in args.file:
+            with open(path) as f:
+                docs.append(f.read())
+    else:
+        sources = args.keys
+        docs = list(wd.extract_text(args.keys))
+
+    results = {
+        'characters': measure(wd, docs, sources, length=args.length, overlap=args.overlap, unit='characters'),
+        'tokens': measure(wd, docs, sources, length=args.tokens, overlap=args.token_overlap, unit='tokens'),
+    }
+    print('{:<20}{:>14}{:>14}'.format('', *results))
+    for metric in results['characters']:
+        print('{:<20}{:>14}{:>14}'.format(metric, *(result[metric] for result in results.values())))
+    wd.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+'''
+    Measures the pipeline against the local Wikipedia and Groq stubs of `stubs.py`, without any network access.
+
+    The single query benchmark runs the stages of a query one after the other on a `Widiscover` engine and reports
+    the latency percentiles of every stage (keyword extraction, search, download + chunking + embedding, retrieval, answer).
+    The concurrent benchmark serves the FastAPI app and reports the latency percentiles and the throughput
+    of N clients sending POST /api/query requests at the same time.
+
+    usage:
+        python benchmarks/bench_pipeline.py --repeat 20
+        python benchmarks/bench_pipeline.py --clients 8 --requests 10 --wiki-latency 0.1 --groq-latency 0.5
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import argparse
+import importlib
+import threading
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stubs
+
+
+QUERIES = [
+    'Who invented the telephone?',
+    'When was the theory of relativity published?',
+    'What is the capital of Australia?',
+    'How does photosynthesis work?',
+    'Who painted the Mona Lisa?',
+]
+
+
+def percentiles(values: list):
+    if not values:
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        'n': len(values),
+        'mean (ms)': round(float(np.mean(values)) * 1000, 1),
+        'p50 (ms)': round(float(p50) * 1000, 1),
+        'p90 (ms)': round(float(p90) * 1000, 1),
+        'p99 (ms)': round(float(p99) * 1000, 1),
+    }
+
+
+def print_table(title: str, rows: dict):
+    print('\n' + title)
+    columns = list(next(iter(rows.values())).keys()) if rows else []
+    print('{:<12}'.format('') + ''.join('{:>12}'.format(column) for column in columns))
+    for name, row in rows.items():
+        print('{:<12}'.format(name) + ''.join('{:>12}'.format(row.get(column, '')) for column in columns))
+
+
+def bench_single(url: str, queries: list, repeat: int, settings: dict, chunking: dict):
+    '''
+        Runs the stages of every query `repeat` times and returns their latencies.
+    '''
+
+    from widiscover_core import Widiscover
+    wd = Widiscover(wikipedia_url=url, groq_base_url=url, groq_api_key='benchmark', requests_per_second=1000.0)
+    wd.warm_up()
+    stages = {name: [] for name in ('keywords', 'search', 'ingest', 'retrieve', 'answer', 'total')}
+    chunks_per_query = []
+    try:
+        for _ in range(repeat):
+            for query in queries:
+                start = time.perf_counter()
+                keywords = wd.extract_keywords(query)
+                searched = time.perf_counter()
+                keys = wd.wikisearch(keywords, result_number_per_page=settings['configResultNumberPerPage']) or []
+                fetched = time.perf_counter()
+                chunks = wd.ingest(keys, **chunking)
+                ingested = time.perf_counter()
+                context = wd.search_chunks(query, chunks, top_k=settings['configTopKResults'], threshold=settings['configThreshold'],
+                                           retriever=settings['configRetriever'])
+                retrieved = time.perf_counter()
+                wd.answer(query, context, spelling=settings['configDistance'], generative_model=settings['configGenerativeModel'],
+                          token_budget=settings['configContextTokenBudget'])
+                answered = time.perf_counter()
+                stages['keywords'].append(searched - start)
+                stages['search'].append(fetched - searched)
+                stages['ingest'].append(ingested - fetched)
+                stages['retrieve'].append(retrieved - ingested)
+                stages['answer'].append(answered - retrieved)
+                stages['total'].append(answered - start)
+                chunks_per_query.append(len(chunks))
+    finally:
+        wd.close()
+    return stages, chunks_per_query
+
+
+def bench_concurrent(app, queries: list, clients: int, requests: int, port: int):
+    '''
+        Serves the app with uvicorn and sends `requests` queries from each of the `clients` concurrent clients.
+    '''
+
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    try:
+        return asyncio.run(run_clients('http://127.0.0.1:{}'.format(port), queries, clients, requests))
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+async def run_clients(app_url: str, queries: list, clients: int, requests: int):
+    import httpx
+    async with httpx.AsyncClient(base_url=app_url, timeout=300) as client:
+        while True:
+            try:
+                if (await client.get('/api/ready')).status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+        latencies = []
+        errors = []
+
+        async def run_client(number: int):
+            for i in range(requests):
+                query = queries[(number + i) % len(queries)]
+                start = time.perf_counter()
+                response = await client.post('/api/query', json={'query': query})
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors.append(response.status_code)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[run_client(number) for number in range(clients)])
+        return latencies, errors, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--query', action='append', help='benchmark query (repeatable), several built-in queries by default')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of every query in the single query benchmark, 0 to skip it')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients of the app, 0 to skip the concurrent benchmark')
+    parser.add_argument('--requests', type=int, default=5, help='queries sent by every client')
+    parser.add_argument('--port', type=int, default=7455, help='port of the benchmarked app')
+    parser.add_argument('--fixtures', default=stubs.FIXTURES, help='directory of the recorded searches and pages')
+    parser.add_argument('--wiki-latency', type=float, default=0.05, help='seconds before the stub answers a Wikipedia request')
+    parser.add_argument('--groq-latency', type=float, default=0.3, help='seconds before the first token of a stub completion')
+    parser.add_argument('--token-latency', type=float, default=0.01, help='seconds between two tokens of a stub completion')
+    parser.add_argument('--paragraphs', type=int, default=40, help='paragraphs of a generated page')
+    parser.add_argument('--settings', help='JSON file of settings overriding the defaults of config.json')
+    args = parser.parse_args()
+
+    stub_state = stubs.Stubs(args.fixtures, args.wiki_latency, args.groq_latency, args.token_latency, args.paragraphs)
+    server, url = stubs.start(stub_state)
+    print('stubs listening on', url)
+    os.environ.update({
+        'WIDISCOVER_WIKIPEDIA_URL': url,
+        'GROQ_BASE_URL': url,
+        'GROQ_API_KEY': 'benchmark',
+        'WIDISCOVER_REQUESTS_PER_SECOND': '1000',
+    })
+
+    # the app reads 'config.json' and serves 'ui/build' from the working directory, the benchmark runs in a scratch one
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='widiscover-bench-')
+    os.makedirs(os.path.join(directory, 'ui', 'build', '_app', 'immutable', 'assets'))
+    os.environ['WIDISCOVER_CACHE_DIR'] = os.path.join(directory, '.cache')
+    os.chdir(directory)
+    try:
+        app = importlib.import_module('main')
+        settings = dict(app.DEFAULT_CONFIG)
+        if args.settings:
+            with open(os.path.join(cwd, args.settings)) as f:
+                settings.update(json.load(f))
+        with open('config.json', 'w') as f:
+            json.dump(settings, f)
+        queries = args.query or QUERIES
+
+        if args.repeat:
+            stages, chunks = bench_single(url, queries, args.repeat, settings, app.chunk_settings(settings))
+            print_table('single query ({} queries x {}, {:.0f} chunks per query)'.format(len(queries), args.repeat, np.mean(chunks)),
+                        {name: percentiles(values) for name, values in stages.items()})
+            print('throughput: {:.2f} queries/s'.format(len(stages['total']) / sum(stages['total'])))
+
+        if args.clients:
+            latencies, errors, elapsed = bench_concurrent(app.app, queries, args.clients, args.requests, args.port)
+            print_table('{} concurrent clients x {} requests'.format(args.clients, args.requests), {'/api/query': percentiles(latencies)})
+            print('throughput: {:.2f} queries/s, errors: {}'.format(len(latencies) / elapsed, len(errors)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print('\nstub requests:', stub_state.counters)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
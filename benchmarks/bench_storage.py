@@ -0,0 +1,152 @@
+'''
+    Compares the memory, disk usage, write time and query latency of the Qdrant storage modes of the chunk collections.
+
+    Every mode runs in its own process on the same synthetic chunks (random unit dense vectors and sparse vectors
+    shaped like SPLADE's): the resident memory added by the collection, its size on disk, the upsert time,
+    the latency percentiles of the dense prefetch + sparse rescoring query and the overlap of its top results
+    with the in-memory float32 mode are reported.
+
+    The local mode of qdrant-client (':memory:' or a directory) ignores the on-disk and quantization settings,
+    pass the URL of a Qdrant server with --url to measure them.
+
+    usage:
+        python benchmarks/bench_storage.py --chunks 20000 --queries 200
+        python benchmarks/bench_storage.py --chunks 200000 --url http://localhost:6333
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_pipeline import percentiles, print_table
+
+
+DIMENSION = 384
+VOCABULARY = 30522
+
+
+def resident_memory():
+    '''
+        Returns the resident memory of the process in bytes.
+    '''
+
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def directory_size(path: str):
+    return sum(os.path.getsize(os.path.join(directory, name)) for directory, _, names in os.walk(path) for name in names)
+
+
+def synthetic_vectors(rng: np.random.Generator, count: int, nonzeros: int = 120):
+    dense = rng.standard_normal((count, DIMENSION)).astype(np.float32)
+    dense /= np.linalg.norm(dense, axis=1, keepdims=True)
+    sparse = []
+    for _ in range(count):
+        indices = np.sort(rng.choice(VOCABULARY, size=nonzeros, replace=False))
+        sparse.append((indices, rng.exponential(0.5, size=nonzeros).astype(np.float32)))
+    return dense, sparse
+
+
+def run_mode(location: str, on_disk: bool, quantization: str, chunks: int, queries: int, batch: int, seed: int):
+    '''
+        Measures a storage mode in the current process.
+    '''
+
+    from retrievers import QdrantIndex
+    rng = np.random.default_rng(seed)
+    dense, sparse = synthetic_vectors(rng, chunks)
+    query_dense, query_sparse = synthetic_vectors(rng, queries, nonzeros=20)
+    baseline = resident_memory()
+
+    index = QdrantIndex(location, 'bench', dense_dimension=DIMENSION, on_disk=on_disk, quantization=quantization)
+    index.create(recreate=True)
+    start = time.perf_counter()
+    for offset in range(0, chunks, batch):
+        index.upsert([(i, dense[i], sparse[i][0], sparse[i][1], {'text': 'chunk {}'.format(i), 'source': 'Page_{}'.format(i % 1000)})
+                      for i in range(offset, min(offset + batch, chunks))])
+    upsert_time = time.perf_counter() - start
+    memory = resident_memory() - baseline
+
+    latencies = []
+    results = []
+    for i in range(queries):
+        start = time.perf_counter()
+        found = index.search_many([(query_dense[i], query_sparse[i][0], query_sparse[i][1])], top_k=4, threshold=0.0)[0]
+        latencies.append(time.perf_counter() - start)
+        results.append([item['text'] for item in found])
+    index.close()
+    return {
+        'upsert_time': upsert_time,
+        'memory': memory,
+        'latencies': latencies,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=20000, help='chunks written to every collection')
+    parser.add_argument('--queries', type=int, default=100, help='queries measured on every collection')
+    parser.add_argument('--batch', type=int, default=256, help='chunks per upsert')
+    parser.add_argument('--url', help='URL of a Qdrant server, its storage modes are measured too')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode = json.loads(args.child)
+        print(json.dumps(run_mode(mode['location'], mode['on_disk'], mode['quantization'], args.chunks, args.queries, args.batch, args.seed)))
+        return
+
+    directory = tempfile.mkdtemp(prefix='widiscover-storage-')
+    modes = {
+        'memory': {'location': ':memory:', 'on_disk': False, 'quantization': None},
+        'local': {'location': os.path.join(directory, 'local'), 'on_disk': False, 'quantization': None},
+    }
+    if args.url:
+        modes.update({
+            'server': {'location': args.url, 'on_disk': False, 'quantization': None},
+            'server disk': {'location': args.url, 'on_disk': True, 'quantization': None},
+            'server int8': {'location': args.url, 'on_disk': False, 'quantization': 'int8'},
+            'disk + int8': {'location': args.url, 'on_disk': True, 'quantization': 'int8'},
+        })
+    rows = {}
+    reference = None
+    try:
+        for name, mode in modes.items():
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--chunks', str(args.chunks), '--queries', str(args.queries),
+                                     '--batch', str(args.batch), '--seed', str(args.seed), '--child', json.dumps(mode)],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            reference = reference or result['results']
+            overlap = np.mean([len(set(a) & set(b)) / len(a) if a else float(not b) for a, b in zip(reference, result['results'])])
+            latency = percentiles(result['latencies'])
+            rows[name] = {
+                'RSS (MB)': round(result['memory'] / 2 ** 20, 1),
+                'disk (MB)': round(directory_size(mode['location']) / 2 ** 20, 1) if os.path.isdir(mode['location']) else '-',
+                'upsert (s)': round(result['upsert_time'], 2),
+                'p50 (ms)': latency['p50 (ms)'],
+                'p99 (ms)': latency['p99 (ms)'],
+                'overlap@4': round(float(overlap), 3),
+            }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print_table('{} chunks, {} queries'.format(args.chunks, args.queries), rows)
+
+
+if __name__ == '__main__':
+    main()
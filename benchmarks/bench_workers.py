@@ -0,0 +1,136 @@
+'''
+    Measures the throughput of the server for an increasing number of worker processes.
+
+    For every worker count the app is started with `main.serve` (the workers share the embedding models and
+    the vector cache of one embedding server process) against the local Wikipedia and Groq stubs of `stubs.py`,
+    with empty caches, and N concurrent clients send POST /api/query requests to it. The throughput,
+    the latency percentiles and the resident memory of the server processes are reported.
+
+    usage:
+        python benchmarks/bench_workers.py --workers 1 2 4 --clients 16 --requests 10
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import asyncio
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stubs
+from bench_pipeline import QUERIES, percentiles, print_table, run_clients
+
+
+def process_tree_memory(pid: int):
+    '''
+        Returns the resident memory of a process and of its descendants in bytes.
+    '''
+
+    memory = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                memory += next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+            with open('/proc/{}/task/{}/children'.format(pid, pid)) as f:
+                pids += [int(child) for child in f.read().split()]
+        except (OSError, StopIteration):
+            continue
+    return memory
+
+
+def bench_workers(directory: str, workers: int, port: int, queries: list, clients: int, requests: int):
+    '''
+        Serves the app with `workers` workers and measures `requests` queries sent by each of the `clients` concurrent clients.
+    '''
+
+    env = dict(os.environ, WIDISCOVER_CACHE_DIR=os.path.join(directory, '.cache-{}'.format(workers)))
+    server = subprocess.Popen(
+        [sys.executable, '-c', 'import sys; sys.path.insert(0, {!r}); import main; main.serve("127.0.0.1", {}, {})'.format(ROOT, port, workers)],
+        cwd=directory, env=env)
+    try:
+        app_url = 'http://127.0.0.1:{}'.format(port)
+        # the first queries wait for every worker to be ready and aren't measured
+        asyncio.run(run_clients(app_url, queries, workers * 2, 1))
+        latencies, errors, elapsed = asyncio.run(run_clients(app_url, queries, clients, requests))
+        memory = process_tree_memory(server.pid)
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    return latencies, errors, elapsed, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts to measure')
+    parser.add_argument('--query', action='append', help='benchmark query (repeatable), several built-in queries by default')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients of the app')
+    parser.add_argument('--requests', type=int, default=5, help='queries sent by every client')
+    parser.add_argument('--port', type=int, default=7456, help='port of the benchmarked app')
+    parser.add_argument('--fixtures', default=stubs.FIXTURES, help='directory of the recorded searches and pages')
+    parser.add_argument('--wiki-latency', type=float, default=0.02, help='seconds before the stub answers a Wikipedia request')
+    parser.add_argument('--groq-latency', type=float, default=0.05, help='seconds before the first token of a stub completion')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='seconds between two tokens of a stub completion')
+    parser.add_argument('--paragraphs', type=int, default=40, help='paragraphs of a generated page')
+    parser.add_argument('--settings', help='JSON file of settings overriding the defaults of config.json')
+    args = parser.parse_args()
+
+    stub_state = stubs.Stubs(args.fixtures, args.wiki_latency, args.groq_latency, args.token_latency, args.paragraphs)
+    stub_server, url = stubs.start(stub_state)
+    print('stubs listening on', url)
+    os.environ.update({
+        'WIDISCOVER_WIKIPEDIA_URL': url,
+        'GROQ_BASE_URL': url,
+        'GROQ_API_KEY': 'benchmark',
+        'WIDISCOVER_REQUESTS_PER_SECOND': '1000',
+    })
+
+    # the app reads 'config.json' and serves 'ui/build' from the working directory, the benchmark runs in a scratch one
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='widiscover-bench-')
+    os.makedirs(os.path.join(directory, 'ui', 'build', '_app', 'immutable', 'assets'))
+    os.chdir(directory)
+    rows = {}
+    try:
+        import main as app
+        settings = dict(app.DEFAULT_CONFIG)
+        if args.settings:
+            with open(os.path.join(cwd, args.settings)) as f:
+                settings.update(json.load(f))
+        with open('config.json', 'w') as f:
+            json.dump(settings, f)
+        queries = args.query or QUERIES
+        for workers in args.workers:
+            start = time.perf_counter()
+            latencies, errors, elapsed, memory = bench_workers(directory, workers, args.port, queries, args.clients, args.requests)
+            latency = percentiles(latencies)
+            rows['{} workers'.format(workers)] = {
+                'queries/s': round(len(latencies) / elapsed, 2),
+                'p50 (ms)': latency.get('p50 (ms)', '-'),
+                'p99 (ms)': latency.get('p99 (ms)', '-'),
+                'errors': len(errors),
+                'RSS (MB)': round(memory / 2 ** 20),
+                'run (s)': round(time.perf_counter() - start, 1),
+            }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+    print_table('{} concurrent clients x {} requests'.format(args.clients, args.requests), rows)
+    print('\nstub requests:', stub_state.counters)
+    stub_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+'''
+    Local stand-ins for the Wikipedia and Groq APIs used by the benchmarks.
+
+    A single HTTP server answers the search (/w/rest.php/v1/search/page), page (/api/rest_v1/page/html/{key}),
+    action API (/w/api.php: the leads, lengths, sections and section texts of the section-level fetching)
+    and chat completion (/openai/v1/chat/completions, streamed or not) requests of `Widiscover`, after a configurable latency.
+    Completions can be slower for some models (--model-latency) and limited to a number of requests per window
+    (--groq-limit), with Groq's rate-limit headers and 429 responses.
+    Searches and pages are served from the recorded fixtures when there are some (see --record), otherwise
+    deterministic pages of Parsoid-like HTML are generated from the page key.
+
+    usage:
+        python benchmarks/stubs.py --port 8765
+        WIDISCOVER_WIKIPEDIA_URL=http://127.0.0.1:8765 GROQ_BASE_URL=http://127.0.0.1:8765 python main.py
+
+        python benchmarks/stubs.py --record "invented telephone" "theory relativity"
+
+    Recorded searches are keyed on their keywords, as extracted by `Widiscover.extract_keywords` from the benchmark queries.
+'''
+
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urllib.parse as urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+WORDS = ('the of and in to was is for on as by with he that at from his it an were are which this be also or had first '
+         'one their its new after but who not they have has her she two been other when there all during into school time may '
+         'years more most only over city many such some later can would these about world through state university between '
+         'invention telephone signal sound electric patent system device network history century research company science').split()
+ANSWER = 'According to the contexts, the answer is described in the first passage of the retrieved Wikipedia articles.'
+
+
+def fixture_name(text: str):
+    return urlparse.quote(text, safe='')[:120] + '-' + hashlib.blake2b(text.encode('utf-8'), digest_size=4).hexdigest()
+
+
+class Stubs:
+    '''
+        Holds the latencies and the fixtures of the stub server.
+            Args:
+                fixtures (str): The directory of the recorded searches and pages.
+                wiki_latency (float): Seconds before answering a Wikipedia request.
+                groq_latency (float): Seconds before the first token of a completion.
+                token_latency (float): Seconds between two streamed tokens.
+                paragraphs (int): The number of paragraphs of a generated page.
+                model_latencies (dict): Model -> seconds before the first token, instead of `groq_latency`.
+                groq_limit (int): Completions accepted per `groq_window` seconds, 0 for no limit.
+                groq_window (float): The rate limit window in seconds.
+    '''
+
+    def __init__(self, fixtures: str = FIXTURES, wiki_latency: float = 0.05, groq_latency: float = 0.3,
+                 token_latency: float = 0.01, paragraphs: int = 40, model_latencies: dict = None,
+                 groq_limit: int = 0, groq_window: float = 60.0):
+        self.fixtures = fixtures
+        self.wiki_latency = wiki_latency
+        self.groq_latency = groq_latency
+        self.token_latency = token_latency
+        self.paragraphs = paragraphs
+        self.model_latencies = model_latencies or {}
+        self.groq_limit = groq_limit
+        self.groq_window = groq_window
+        self.window_start = time.monotonic()
+        self.window_requests = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            'searches': 0,
+            'pages': 0,
+            'api': 0,
+            'completions': 0,
+            'rate_limited': 0,
+        }
+
+
+    def count(self, counter: str):
+        with self.lock:
+            self.counters[counter] += 1
+
+
+    def search(self, query: str, limit: int):
+        path = os.path.join(self.fixtures, 'search', fixture_name(query) + '.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        words = [word.capitalize() for word in re.findall(r'\w+', query)] or ['Page']
+        return {'pages': [{
+            'id': i,
+            'key': '_'.join(words) + ('_{}'.format(i) if i else ''),
+            'title': ' '.join(words) + (' {}'.format(i) if i else ''),
+            'description': 'Generated page',
+        } for i in range(limit)]}
+
+
+    def page(self, key: str):
+        path = os.path.join(self.fixtures, 'pages', fixture_name(key) + '.html')
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+        rng = random.Random(key)
+        sections = []
+        for section in range(self.paragraphs // 5 + 1):
+            paragraphs = ''.join(
+                '<p>{}.<sup class="mw-ref reference"><a href="#cite_note-{}">[{}]</a></sup></p>'.format(
+                    ' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))).capitalize(), n, n)
+                for n in range(5))
+            heading = '<h2 id="s{0}">Section {0}</h2>'.format(section) if section else ''
+            sections.append('<section data-mw-section-id="{}">{}{}</section>'.format(section, heading, paragraphs))
+        references = '<section><h2 id="References">References</h2><div class="mw-references-wrap"><ol class="mw-references references">' + \
+            ''.join('<li>Reference {}</li>'.format(n) for n in range(50)) + '</ol></div></section>'
+        return '<!DOCTYPE html><html><head><title>{0}</title></head><body><table class="infobox"><tr><td>{0}</td></tr></table>{1}{2}' \
+               '<div role="navigation" class="navbox">Navigation</div></body></html>'.format(key, ''.join(sections), references)
+
+
+    def sections(self, key: str):
+        '''
+            Splits a page at its h2 headings, like the parse API of MediaWiki.
+                Returns:
+                    list: (heading, HTML, text length) of every section, the lead first with an empty heading.
+        '''
+
+        body = re.sub(r'^.*?<body>|</body>.*$', '', self.page(key), flags=re.DOTALL)
+        sections = []
+        for part in re.split(r'(?=<h2[ >])', body):
+            heading = re.match(r'<h2[^>]*>(.*?)</h2>', part)
+            text = re.sub(r'<[^>]+>', '', part)
+            sections.append((re.sub(r'<[^>]+>', '', heading.group(1)) if heading else '', part, len(text.encode('utf-8'))))
+        return sections
+
+
+    def api(self, query: dict):
+        '''
+            Answers the 'query' (extracts and info of pages) and 'parse' (sections or section text) requests of the action API.
+        '''
+
+        if query.get('action') == 'query':
+            pages = []
+            normalized = []
+            for key in query.get('titles', '').split('|'):
+                title = key.replace('_', ' ')
+                if title != key:
+                    normalized.append({'from': key, 'to': title})
+                sections = self.sections(key)
+                pages.append({
+                    'title': title,
+                    # like TextExtracts, without the infobox
+                    'extract': ' '.join(re.sub(r'<[^>]+>', ' ', re.sub(r'<table.*?</table>', '', sections[0][1], flags=re.DOTALL)).split()),
+                    'length': sum(size for _, _, size in sections),
+                })
+            return {'query': {'normalized': normalized, 'pages': pages}}
+        if query.get('action') == 'parse':
+            key = query.get('page', '')
+            sections = self.sections(key)
+            if query.get('prop') == 'sections':
+                offsets = [sum(size for _, _, size in sections[:i]) for i in range(len(sections))]
+                return {'parse': {'title': key.replace('_', ' '), 'sections': [
+                    {'toclevel': 1, 'level': '2', 'line': heading, 'number': str(i), 'index': str(i), 'byteoffset': offsets[i]}
+                    for i, (heading, _, _) in enumerate(sections) if i]}}
+            index = int(query.get('section', 0))
+            if index < len(sections):
+                return {'parse': {'title': key.replace('_', ' '), 'text': sections[index][1]}}
+        return {'error': {'code': 'badrequest'}}
+
+
+    def latency(self, model: str):
+        return self.model_latencies.get(model, self.groq_latency)
+
+
+    def rate_limit(self):
+        '''
+            Counts a completion in the current window.
+                Returns:
+                    tuple: The rate-limit headers, and whether the completion is over the limit.
+        '''
+
+        if not self.groq_limit:
+            return {}, False
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.groq_window:
+                self.window_start = now
+                self.window_requests = 0
+            limited = self.window_requests >= self.groq_limit
+            if limited:
+                self.counters['rate_limited'] += 1
+            else:
+                self.window_requests += 1
+            reset = self.groq_window - (now - self.window_start)
+            return {
+                'x-ratelimit-limit-requests': str(self.groq_limit),
+                'x-ratelimit-remaining-requests': str(self.groq_limit - self.window_requests),
+                'x-ratelimit-reset-requests': '{:.2f}s'.format(reset),
+                **({'Retry-After': str(max(1, round(reset)))} if limited else {}),
+            }, limited
+
+
+    def usage(self, messages: list, completion_tokens: int, model: str = None):
+        prompt_tokens = sum(len(message.get('content', '')) for message in messages) // 4
+        return {
+            'queue_time': 0.0,
+            'prompt_tokens': prompt_tokens,
+            'prompt_time': self.latency(model),
+            'completion_tokens': completion_tokens,
+            'completion_time': completion_tokens * self.token_latency,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'total_time': self.latency(model) + completion_tokens * self.token_latency,
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stubs: Stubs = None
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def send_body(self, body: bytes, content_type: str, headers: dict = None, status: int = 200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        time.sleep(self.stubs.wiki_latency)
+        if url.path.endswith('/w/rest.php/v1/search/page'):
+            self.stubs.count('searches')
+            query = urlparse.parse_qs(url.query)
+            body = self.stubs.search(query.get('q', [''])[0], int(query.get('limit', ['3'])[0]))
+            self.send_body(json.dumps(body).encode('utf-8'), 'application/json')
+        elif url.path.endswith('/w/api.php'):
+            self.stubs.count('api')
+            query = {name: values[0] for name, values in urlparse.parse_qs(url.query).items()}
+            self.send_body(json.dumps(self.stubs.api(query)).encode('utf-8'), 'application/json')
+        elif '/api/rest_v1/page/html/' in url.path:
+            self.stubs.count('pages')
+            key = urlparse.unquote(url.path.split('/api/rest_v1/page/html/', 1)[1])
+            html = self.stubs.page(key)
+            etag = 'W/"1/{}"'.format(hashlib.blake2b(html.encode('utf-8'), digest_size=8).hexdigest())
+            self.send_body(html.encode('utf-8'), 'text/html; charset=utf-8', {'ETag': etag})
+        else:
+            self.send_error(404)
+
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        headers, limited = self.stubs.rate_limit()
+        if limited:
+            body = {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}}
+            self.send_body(json.dumps(body).encode('utf-8'), 'application/json', headers, status=429)
+            return
+        self.stubs.count('completions')
+        tokens = re.findall(r'\S+\s*', ANSWER)
+        model = request.get('model', 'stub')
+        usage = self.stubs.usage(request.get('messages', []), len(tokens), model)
+        time.sleep(self.stubs.latency(model))
+        if not request.get('stream'):
+            body = {
+                'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ANSWER}, 'finish_reason': 'stop', 'logprobs': None}],
+                'usage': usage, 'x_groq': {'id': 'req_stub'},
+            }
+            time.sleep(len(tokens) * self.stubs.token_latency)
+            self.send_body(json.dumps(body).encode('utf-8'), 'application/json', headers)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        for i, token in enumerate(tokens + [None]):
+            chunk = {
+                'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'delta': {'content': token} if token else {}, 'finish_reason': None if token else 'stop', 'logprobs': None}],
+                'x_groq': {'id': 'req_stub', **({} if token else {'usage': usage})},
+            }
+            self.wfile.write('data: {}\n\n'.format(json.dumps(chunk)).encode('utf-8'))
+            self.wfile.flush()
+            if token:
+                time.sleep(self.stubs.token_latency)
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def start(stubs: Stubs, host: str = '127.0.0.1', port: int = 0):
+    '''
+        Starts the stub server in a daemon thread.
+            Returns:
+                tuple: The server and its base URL.
+    '''
+
+    handler = type('StubHandler', (Handler,), {'stubs': stubs})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='stubs', daemon=True).start()
+    return server, 'http://{}:{}'.format(host, server.server_address[1])
+
+
+def record(queries: list, fixtures: str = FIXTURES, limit: int = 3):
+    '''
+        Records the search results of the queries and their pages from Wikipedia into the fixtures.
+    '''
+
+    import requests
+    session = requests.Session()
+    session.headers['User-Agent'] = 'Widiscover 2.4 benchmark recorder'
+    os.makedirs(os.path.join(fixtures, 'search'), exist_ok=True)
+    os.makedirs(os.path.join(fixtures, 'pages'), exist_ok=True)
+    for keywords in queries:
+        # the keywords are joined like in `Widiscover.search_params`
+        query = '+'.join(keywords.split())
+        response = session.get('https://en.wikipedia.org/w/rest.php/v1/search/page', params={'q': query, 'limit': limit + 1})
+        response.raise_for_status()
+        with open(os.path.join(fixtures, 'search', fixture_name(query) + '.json'), 'w') as f:
+            json.dump(response.json(), f)
+        for page in response.json()['pages']:
+            html = session.get('https://en.wikipedia.org/api/rest_v1/page/html/' + urlparse.quote(page['key'], safe=''))
+            html.raise_for_status()
+            with open(os.path.join(fixtures, 'pages', fixture_name(page['key']) + '.html'), 'w', encoding='utf-8') as f:
+                f.write(html.text)
+            print('recorded', page['key'])
+            time.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures', default=FIXTURES, help='directory of the recorded searches and pages')
+    parser.add_argument('--wiki-latency', type=float, default=0.05, help='seconds before answering a Wikipedia request')
+    parser.add_argument('--groq-latency', type=float, default=0.3, help='seconds before the first token of a completion')
+    parser.add_argument('--token-latency', type=float, default=0.01, help='seconds between two streamed tokens')
+    parser.add_argument('--paragraphs', type=int, default=40, help='paragraphs of a generated page')
+    parser.add_argument('--model-latency', action='append', default=[], metavar='MODEL=SECONDS',
+                        help='seconds before the first token of the completions of a model (repeatable)')
+    parser.add_argument('--groq-limit', type=int, default=0, help='completions accepted per window, 0 for no limit')
+    parser.add_argument('--groq-window', type=float, default=60.0, help='seconds of the rate limit window')
+    parser.add_argument('--record', nargs='+', metavar='KEYWORDS', help='record the searches and pages of these keywords from Wikipedia')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.fixtures)
+        return
+    model_latencies = {model: float(seconds) for model, _, seconds in (item.rpartition('=') for item in args.model_latency)}
+    stubs = Stubs(args.fixtures, args.wiki_latency, args.groq_latency, args.token_latency, args.paragraphs,
+                  model_latencies, args.groq_limit, args.groq_window)
+    server, url = start(stubs, port=args.port)
+    print('Wikipedia and Groq stubs listening on', url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
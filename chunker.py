@@ -0,0 +1,113 @@
+import re
+from bisect import bisect_left
+from tokenizers import Tokenizer
+
+
+# the strength of a boundary: chunks preferably end before a heading, then at a paragraph, then at a sentence
+HEADING, PARAGRAPH, SENTENCE = 3, 2, 1
+BOUNDARIES = [
+    (HEADING, re.compile(r'^#{1,6}[ \t]', re.MULTILINE)),
+    (HEADING, re.compile(r'^.+\n[=-]{3,}[ \t]*$', re.MULTILINE)),
+    (PARAGRAPH, re.compile(r'\n[ \t]*\n\s*')),
+    (SENTENCE, re.compile(r'(?<=[.!?])["\')\]]?\s+')),
+]
+
+
+class TokenChunker:
+    '''
+        Splits markdown into chunks measured in the tokens of the dense model's tokenizer.
+
+        The text is tokenized once and chunks are cut at the strongest boundary (heading, paragraph, sentence)
+        found in the second half of the token window, so that each chunk fits the model without being truncated.
+        The overlap of the next chunk starts at the strongest boundary of the overlap window as well.
+    '''
+
+    def __init__(self, tokenizer: Tokenizer, max_tokens: int = None):
+        # a copy of the model's tokenizer that neither truncates nor pads, so the whole document can be measured
+        self.tokenizer = Tokenizer.from_str(tokenizer.to_str())
+        truncation = self.tokenizer.truncation
+        self.tokenizer.no_truncation()
+        self.tokenizer.no_padding()
+        if max_tokens is None:
+            # leave room for the special tokens ([CLS], [SEP]) added by the model
+            max_tokens = truncation['max_length'] - self.tokenizer.num_special_tokens_to_add(False) if truncation else 256
+        self.max_tokens = max_tokens
+
+
+    @classmethod
+    def from_text_embedding(cls, vectorizer):
+        '''
+            Builds a chunker from the tokenizer of a fastembed `TextEmbedding`.
+        '''
+
+        model = vectorizer.model
+        if getattr(model, 'tokenizer', None) is None:
+            model._ensure_tokenizer()
+        return cls(model.tokenizer)
+
+
+    def count(self, text: str):
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+    def spans(self, text: str, length: int = 256, overlap: int = 32):
+        '''
+            Computes the chunks of a text.
+                Args:
+                    text (str): The markdown text.
+                    length (int): The maximum number of tokens of a chunk, capped by the model's limit.
+                    overlap (int): The number of tokens shared by consecutive chunks.
+                Returns:
+                    list: (start, end) character offsets of the chunks.
+        '''
+
+        offsets = self.tokenizer.encode(text, add_special_tokens=False).offsets
+        total = len(offsets)
+        if not total:
+            return []
+        length = max(1, min(length, self.max_tokens))
+        overlap = max(0, min(overlap, length // 2))
+        starts = [start for start, _ in offsets]
+        # the boundary strength before every token, in a single pass over the text per boundary kind
+        strength = [0] * (total + 1)
+        for kind, pattern in BOUNDARIES:
+            for match in pattern.finditer(text):
+                position = match.end() if kind != HEADING else match.start()
+                token = bisect_left(starts, position)
+                if 0 < token < total and strength[token] < kind:
+                    strength[token] = kind
+
+        spans = []
+        start = 0
+        while True:
+            end = start + length
+            if end >= total:
+                spans.append((offsets[start][0], offsets[-1][1]))
+                break
+            best = end
+            for token in range(end, start + length // 2, -1):
+                if strength[token] > strength[best]:
+                    best = token
+                    if strength[best] == HEADING:
+                        break
+            end = best
+            spans.append((offsets[start][0], offsets[end - 1][1]))
+            # a chunk cut before a heading is not repeated at the start of the next section
+            if strength[end] == HEADING:
+                start = end
+            else:
+                start = max(overlap_start(strength, end - overlap, end), start + 1)
+        return spans
+
+
+def overlap_start(strength: list, first: int, end: int):
+    '''
+        Returns the token starting the overlap of the next chunk: the strongest boundary in [first, end), the earliest
+        one of that strength so that most of the overlap is kept, or `first` when there is no boundary in the overlap.
+    '''
+
+    best = first
+    for token in range(first, end):
+        if strength[token] > strength[best]:
+            best = token
+    return best
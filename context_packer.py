@@ -0,0 +1,147 @@
+import re
+from chunker import TokenChunker
+
+
+# the default context token budget of the generative models, a budget of 0 in the settings selects it
+MODEL_TOKEN_BUDGETS = {
+    'gemma2-9b-it': 2000,
+    'llama-3.1-8b-instant': 3000,
+    'meta-llama/llama-guard-4-12b': 2000,
+    'compound-beta-mini': 3000,
+}
+DEFAULT_TOKEN_BUDGET = 6000
+# passages shorter than this aren't worth truncating into the rest of the budget
+MIN_TRUNCATED_TOKENS = 32
+PARAGRAPH = re.compile(r'\n[ \t]*\n')
+WORD = re.compile(r'\w+')
+SENTENCE_END = re.compile(r'[.!?]["\')\]]?\s')
+
+
+class ContextPacker:
+    '''
+        Packs the retrieved chunks into the contexts of the prompt.
+
+        Overlapping and adjacent chunks of the same page are merged into a single passage, paragraphs already
+        present in a better passage and passages nearly identical to a better one are removed, and the passages
+        are added best first until the token budget is spent (the last one truncated at a sentence end).
+        Tokens are counted with the tokenizer of the dense model, an estimate of the tokens of the generative model.
+    '''
+
+    def __init__(self, chunker: TokenChunker, similarity: float = 0.8, shingle: int = 3):
+        self.chunker = chunker
+        self.similarity = similarity
+        self.shingle = shingle
+
+
+    def pack(self, context: list[dict], token_budget: int):
+        '''
+            Args:
+                context (list): The retrieved chunks with their 'text', 'source', 'score' and character offsets
+                    ('start', 'end') in the page.
+                token_budget (int): The maximum number of tokens of the packed passages.
+            Returns:
+                tuple: The passages ('text', 'source', 'section', 'score'), best first, and the usage counters
+                'context_tokens' and 'context_tokens_saved' (compared to sending every chunk in full).
+        '''
+
+        original_tokens = sum(self.chunker.count(item['text']) for item in context)
+        passages = self.deduplicate(self.merge(context))
+        packed = []
+        tokens = 0
+        for passage in passages:
+            remaining = token_budget - tokens
+            count = self.chunker.count(passage['text'])
+            if count > remaining:
+                if remaining < MIN_TRUNCATED_TOKENS:
+                    break
+                passage = {**passage, 'text': self.truncate(passage['text'], remaining)}
+                count = self.chunker.count(passage['text'])
+                if not passage['text'] or count > remaining:
+                    break
+            packed.append(passage)
+            tokens += count
+        return packed, {
+            'context_tokens': tokens,
+            'context_tokens_saved': max(original_tokens - tokens, 0),
+        }
+
+
+    def merge(self, context: list[dict]):
+        '''
+            Merges the overlapping or adjacent chunks of each page, a merged passage keeps the best score of its chunks.
+        '''
+
+        passages = []
+        by_source = {}
+        for item in context:
+            if 'start' not in item:
+                passages.append(dict(item))
+                continue
+            by_source.setdefault(item['source'], []).append(item)
+        for items in by_source.values():
+            items.sort(key=lambda item: item['start'])
+            current = dict(items[0])
+            for item in items[1:]:
+                if item['start'] <= current['end']:
+                    if item['end'] > current['end']:
+                        current['text'] += item['text'][current['end'] - item['start']:]
+                        current['end'] = item['end']
+                    current['score'] = max(current.get('score', 0), item.get('score', 0))
+                else:
+                    passages.append(current)
+                    current = dict(item)
+            passages.append(current)
+        passages.sort(key=lambda passage: -passage.get('score', 0))
+        return passages
+
+
+    def deduplicate(self, passages: list[dict]):
+        '''
+            Drops the paragraphs seen in a better passage, then the passages whose word shingles mostly
+            overlap those of a better passage.
+        '''
+
+        paragraphs = set()
+        shingles = []
+        kept = []
+        for passage in passages:
+            parts = []
+            for paragraph in PARAGRAPH.split(passage['text']):
+                words = tuple(WORD.findall(paragraph.lower()))
+                if not words:
+                    continue
+                if len(words) >= self.shingle and words in paragraphs:
+                    continue
+                paragraphs.add(words)
+                parts.append(paragraph.strip())
+            if not parts:
+                continue
+            text = '\n\n'.join(parts)
+            words = WORD.findall(text.lower())
+            passage_shingles = {tuple(words[i:i + self.shingle]) for i in range(max(len(words) - self.shingle + 1, 1))}
+            if any(len(passage_shingles & other) >= self.similarity * min(len(passage_shingles), len(other)) for other in shingles):
+                continue
+            shingles.append(passage_shingles)
+            kept.append({**passage, 'text': text})
+        return kept
+
+
+    def truncate(self, text: str, max_tokens: int):
+        '''
+            Returns the longest prefix of `text` of at most `max_tokens` tokens ending at a sentence end if there is one.
+        '''
+
+        offsets = self.chunker.tokenizer.encode(text, add_special_tokens=False).offsets
+        if len(offsets) <= max_tokens:
+            return text
+        prefix = text[:offsets[max_tokens - 1][1]]
+        ends = [match.start() + len(match.group().rstrip()) for match in SENTENCE_END.finditer(prefix + ' ')]
+        return prefix[:ends[-1]] if ends else prefix
+
+
+def model_token_budget(generative_model: str, budget: int = 0):
+    '''
+        Returns the context token budget of a generative model, `budget` if it is set.
+    '''
+
+    return budget or MODEL_TOKEN_BUDGETS.get(generative_model, DEFAULT_TOKEN_BUDGET)
@@ -0,0 +1,404 @@
+'''
+    Builds a persistent Qdrant index of a local Wikipedia dump, so that Widiscover can answer without any access to Wikipedia.
+
+    The dump is either a MediaWiki XML export (e.g. enwiki-latest-pages-articles.xml.bz2, the wikitext of the articles
+    is converted to markdown) or JSON lines with a 'title' and a 'text' field; both can be compressed with bz2 or gzip.
+    Worker processes chunk and embed batches of articles with the same models and chunking as the live pipeline,
+    while the main process reads the dump and writes the chunks to the collection. A checkpoint is saved after every batch
+    written, an interrupted build resumes from it.
+
+    usage:
+        python dump_index.py build enwiki-latest-pages-articles.xml.bz2 --index .cache/index --workers 4
+        python dump_index.py build articles.jsonl.gz --index http://localhost:6333
+        python dump_index.py query "Who invented the telephone?" --index .cache/index
+
+        WIDISCOVER_INDEX_PATH=.cache/index python main.py
+
+    A local index directory can only be opened by one process at a time: stop the app while building it.
+'''
+
+import os
+import re
+import bz2
+import gzip
+import html
+import json
+import time
+import uuid
+import argparse
+import itertools
+import collections
+import multiprocessing
+import xml.etree.ElementTree as ET
+from html_extract import SKIPPED_SECTIONS, HEADING_LINE
+from retrievers import QdrantIndex
+from widiscover_core import chunk_document
+
+
+DENSE_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+SPARSE_MODEL = 'prithivida/Splade_PP_en_v1'
+# links to the pages of these namespaces are dropped with their label
+LINK_NAMESPACES = ('file:', 'image:', 'media:', 'category:')
+COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+REFERENCE = re.compile(r'<ref[^>]*/>|<ref[^>]*>.*?</ref>', re.DOTALL | re.IGNORECASE)
+DROPPED_ELEMENTS = re.compile(r'<(math|gallery|timeline|score|syntaxhighlight|source|imagemap|table)\b[^>]*>.*?</\1>',
+                              re.DOTALL | re.IGNORECASE)
+TAG = re.compile(r'</?[a-zA-Z][^>]*>')
+LINK_BRACKETS = re.compile(r'\[\[|\]\]')
+EXTERNAL_LINK = re.compile(r'\[(?:https?:)?//[^\s\]]+(?: ([^\]]*))?\]')
+HEADING = re.compile(r'^(={1,6})\s*(.+?)\s*\1\s*$', re.MULTILINE)
+EMPHASIS = re.compile(r"'{2,5}")
+LIST_ITEM = re.compile(r'^[*#:;]+\s*', re.MULTILINE)
+MAGIC_WORD = re.compile(r'__[A-Z]+__')
+# the state of a worker process, set by `init_worker`
+_worker = {}
+
+
+def strip_nested(text: str, opening: str, closing: str):
+    '''
+        Removes the nested constructs delimited by `opening` and `closing`, e.g. the templates ('{{', '}}') of wikitext.
+    '''
+
+    parts = []
+    depth = 0
+    position = 0
+    for match in re.finditer(re.escape(opening) + '|' + re.escape(closing), text):
+        if match.group() == opening:
+            if not depth:
+                parts.append(text[position:match.start()])
+            depth += 1
+        elif depth:
+            depth -= 1
+            if not depth:
+                position = match.end()
+    if not depth:
+        parts.append(text[position:])
+    return ''.join(parts)
+
+
+def replace_links(text: str):
+    '''
+        Replaces the internal links of wikitext by their label and drops the files, images and categories.
+    '''
+
+    parts = []
+    depth = 0
+    position = 0
+    start = 0
+    for match in LINK_BRACKETS.finditer(text):
+        if match.group() == '[[':
+            if not depth:
+                parts.append(text[position:match.start()])
+                start = match.end()
+            depth += 1
+        elif depth:
+            depth -= 1
+            if not depth:
+                link = text[start:match.start()]
+                if not link.split('|', 1)[0].strip().lower().startswith(LINK_NAMESPACES):
+                    parts.append(link.rsplit('|', 1)[-1])
+                position = match.end()
+    if not depth:
+        parts.append(text[position:])
+    return ''.join(parts)
+
+
+def drop_sections(markdown: str):
+    '''
+        Drops the sections holding no prose (references, external links...) like `WikiTextExtractor` does.
+    '''
+
+    lines = []
+    skipped_level = None
+    for line in markdown.split('\n'):
+        match = HEADING_LINE.match(line)
+        if match:
+            level = len(match.group(1))
+            if skipped_level is None or level <= skipped_level:
+                skipped_level = level if match.group(2).strip().lower() in SKIPPED_SECTIONS else None
+        if skipped_level is None:
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def wikitext_to_markdown(wikitext: str):
+    '''
+        Converts the wikitext of an article to the markdown produced by `WikiTextExtractor` from its HTML:
+        paragraphs, list items and '#' headings, without templates, tables, references or files.
+    '''
+
+    text = COMMENT.sub('', wikitext)
+    text = REFERENCE.sub('', text)
+    text = DROPPED_ELEMENTS.sub('', text)
+    text = strip_nested(text, '{{', '}}')
+    text = strip_nested(text, '{|', '|}')
+    text = replace_links(text)
+    text = EXTERNAL_LINK.sub(lambda match: match.group(1) or '', text)
+    text = html.unescape(TAG.sub('', text))
+    text = MAGIC_WORD.sub('', EMPHASIS.sub('', text))
+    text = LIST_ITEM.sub('- ', text)
+    text = HEADING.sub(lambda match: '\n{} {}\n'.format('#' * len(match.group(1)), match.group(2)), text)
+    text = drop_sections(text)
+    blocks = []
+    for block in re.split(r'\n\s*\n', text):
+        lines = [line.strip() for line in block.split('\n') if line.strip() and line.strip() != '-']
+        if lines:
+            blocks.append('\n'.join(lines))
+    return '\n\n'.join(blocks)
+
+
+def open_dump(path: str):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def dump_format(path: str):
+    '''
+        Returns 'jsonl' for JSON lines dumps and 'xml' for MediaWiki exports.
+    '''
+
+    name = re.sub(r'\.(bz2|gz)$', '', path)
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson', '.json')) else 'xml'
+
+
+def read_dump(path: str):
+    '''
+        Yields the (title, text) of the articles of a dump: the wikitext of the main namespace pages that aren't redirects
+        for an XML export, or the 'title' and 'text' of every line of a JSON lines dump.
+    '''
+
+    if dump_format(path) == 'jsonl':
+        with open_dump(path) as f:
+            for line in f:
+                if line.strip():
+                    article = json.loads(line)
+                    yield article['title'], article.get('text') or ''
+        return
+    with open_dump(path) as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        title = namespace = text = None
+        redirect = False
+        for event, element in context:
+            if event != 'end':
+                continue
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag == 'title':
+                title = element.text
+            elif tag == 'ns':
+                namespace = element.text
+            elif tag == 'redirect':
+                redirect = True
+            elif tag == 'text':
+                text = element.text or ''
+            elif tag == 'page':
+                if namespace == '0' and not redirect and title:
+                    yield title, text or ''
+                title = namespace = text = None
+                redirect = False
+                # the parsed pages are released as the dump is read
+                root.clear()
+
+
+def page_key(title: str):
+    return title.replace(' ', '_')
+
+
+def point_id(metadata: dict):
+    '''
+        The id of a chunk, the same across runs so that a resumed build overwrites the chunks already written.
+    '''
+
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, '{}#{}'.format(metadata['source'], metadata['start'])))
+
+
+def init_worker(dense_model_name: str, sparse_model_name: str, markup: str, chunking: dict, threads: int):
+    from embedding_service import EmbeddingService
+    from chunker import TokenChunker
+    embedder = EmbeddingService(dense_model_name, sparse_model_name, threads=threads)
+    _worker.update({
+        'embedder': embedder,
+        'token_chunker': TokenChunker.from_text_embedding(embedder.vectorizer) if chunking['unit'] == 'tokens' else None,
+        'markup': markup,
+        'chunking': chunking,
+    })
+
+
+def process_articles(articles: list):
+    '''
+        Chunks and embeds a batch of articles in a worker process.
+            Returns:
+                list: The points of the chunks, see `QdrantIndex.upsert`.
+    '''
+
+    chunks = []
+    for title, text in articles:
+        if _worker['markup'] == 'xml':
+            text = wikitext_to_markdown(text)
+        chunks += chunk_document(text, page_key(title), token_chunker=_worker['token_chunker'], **_worker['chunking'])
+    vectors = _worker['embedder'].embed([chunk['metadata']['text'] for chunk in chunks])
+    return [(point_id(chunk['metadata']), dense, indices, values, chunk['metadata'])
+            for chunk, (dense, indices, values) in zip(chunks, vectors)]
+
+
+def load_checkpoint(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def checkpoint_path(index: str, collection_name: str):
+    if index.startswith(('http://', 'https://')):
+        return '{}.checkpoint.json'.format(collection_name)
+    return os.path.join(index, '{}.checkpoint.json'.format(collection_name))
+
+
+def build_index(dump: str, index: str, collection_name: str = 'wikipedia', workers: int = None, batch_articles: int = 32,
+                length: int = 256, overlap: int = 32, unit: str = 'tokens', dense_model_name: str = DENSE_MODEL,
+                sparse_model_name: str = SPARSE_MODEL, restart: bool = False, limit: int = None, checkpoint: str = None,
+                on_disk: bool = True, quantization: str = None):
+    '''
+        Chunks, embeds and writes the articles of a dump to a persistent collection, resuming from the checkpoint of a previous run.
+            Args:
+                dump (str): The path of the dump.
+                index (str): The directory of the local collection, or the URL of a Qdrant server.
+                collection_name (str): The name of the collection.
+                workers (int): The number of worker processes, half of the CPUs by default.
+                batch_articles (int): The number of articles sent to a worker at once.
+                length, overlap, unit: The chunking of `Widiscover.process_docs`.
+                restart (bool): Empty the collection and start from the first article instead of resuming.
+                limit (int): Stop after this number of articles of the dump.
+                checkpoint (str): The path of the checkpoint, next to the collection by default.
+                on_disk (bool), quantization (str): The storage of the collection, see `retrievers.collection_config`.
+            Returns:
+                dict: The checkpoint: the dump, the settings, the number of articles and chunks written and whether the dump is done.
+    '''
+
+    workers = workers or max(1, (os.cpu_count() or 2) // 2)
+    if not index.startswith(('http://', 'https://')):
+        os.makedirs(index, exist_ok=True)
+    checkpoint = checkpoint or checkpoint_path(index, collection_name)
+    settings = {
+        'dense_model_name': dense_model_name,
+        'sparse_model_name': sparse_model_name,
+        'length': length,
+        'overlap': overlap,
+        'unit': unit,
+        'on_disk': on_disk,
+        'quantization': quantization,
+    }
+    state = None if restart else load_checkpoint(checkpoint)
+    if state and (state['dump'] != os.path.abspath(dump) or state['settings'] != settings):
+        raise Exception('Error: the index was built from another dump or with other settings, use --restart to rebuild it.')
+    collection = QdrantIndex(index, collection_name, on_disk=on_disk, quantization=quantization)
+    if not state:
+        collection.create(recreate=True)
+        state = {'dump': os.path.abspath(dump), 'settings': settings, 'articles': 0, 'chunks': 0, 'done': False}
+        save_checkpoint(checkpoint, state)
+    if state['done']:
+        collection.close()
+        return state
+
+    stop = limit - state['articles'] if limit is not None else None
+    articles = itertools.islice(read_dump(dump), state['articles'], None)
+    batches = itertools.batched(itertools.islice(articles, stop) if stop is not None else articles, batch_articles)
+    chunking = {'length': length, 'overlap': overlap, 'unit': unit}
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    start = time.perf_counter()
+    exhausted = False
+    try:
+        with multiprocessing.get_context('spawn').Pool(
+                workers, initializer=init_worker,
+                initargs=(dense_model_name, sparse_model_name, dump_format(dump), chunking, threads)) as pool:
+            # a bounded window of batches in the workers, written in the order of the dump
+            pending = collections.deque()
+
+            def submit_next():
+                nonlocal exhausted
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                else:
+                    pending.append((len(batch), pool.apply_async(process_articles, (batch,))))
+
+            for _ in range(workers * 2):
+                submit_next()
+            while pending:
+                count, result = pending.popleft()
+                points = result.get()
+                submit_next()
+                collection.upsert(points)
+                state['articles'] += count
+                state['chunks'] += len(points)
+                save_checkpoint(checkpoint, state)
+                elapsed = time.perf_counter() - start
+                print('{} articles, {} chunks ({:.1f} articles/s)'.format(state['articles'], state['chunks'],
+                                                                         state['articles'] / elapsed if elapsed else 0), flush=True)
+        state['done'] = exhausted and (limit is None or state['articles'] < limit)
+        save_checkpoint(checkpoint, state)
+    finally:
+        collection.close()
+    return state
+
+
+def query_index(query: str, index: str, collection_name: str = 'wikipedia', top_k: int = 4, threshold: float = 0.3):
+    from embedding_service import EmbeddingService
+    embedder = EmbeddingService(DENSE_MODEL, SPARSE_MODEL)
+    collection = QdrantIndex(index, collection_name)
+    try:
+        return collection.search_many([embedder.embed_query(query)], top_k=top_k, threshold=threshold)[0]
+    finally:
+        collection.close()
+        embedder.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='index the articles of a dump')
+    build.add_argument('dump', help='MediaWiki XML export or JSON lines, optionally compressed with bz2 or gzip')
+    build.add_argument('--index', default=os.path.join('.cache', 'index'), help='directory of the index or URL of a Qdrant server')
+    build.add_argument('--collection', default='wikipedia', help='name of the collection')
+    build.add_argument('--workers', type=int, default=None, help='worker processes, half of the CPUs by default')
+    build.add_argument('--batch-articles', type=int, default=32, help='articles sent to a worker at once')
+    build.add_argument('--unit', choices=('tokens', 'characters'), default='tokens', help='unit of the chunk length and overlap')
+    build.add_argument('--length', type=int, default=256, help='chunk length')
+    build.add_argument('--overlap', type=int, default=32, help='overlap between consecutive chunks')
+    build.add_argument('--limit', type=int, default=None, help='stop after this number of articles')
+    build.add_argument('--on-disk', action=argparse.BooleanOptionalAction, default=True,
+                       help='keep the vectors, the sparse index and the payloads on disk (Qdrant server only)')
+    build.add_argument('--quantization', choices=('none', 'int8'), default='none',
+                       help='int8 scalar quantization of the dense vectors, rescored with the originals (Qdrant server only)')
+    build.add_argument('--restart', action='store_true', help='rebuild the index instead of resuming from the checkpoint')
+    query = commands.add_parser('query', help='print the chunks of the index retrieved for a query')
+    query.add_argument('query')
+    query.add_argument('--index', default=os.path.join('.cache', 'index'), help='directory of the index or URL of a Qdrant server')
+    query.add_argument('--collection', default='wikipedia', help='name of the collection')
+    query.add_argument('--top-k', type=int, default=4)
+    query.add_argument('--threshold', type=float, default=0.3)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        state = build_index(args.dump, args.index, args.collection, workers=args.workers, batch_articles=args.batch_articles,
+                            length=args.length, overlap=args.overlap, unit=args.unit, restart=args.restart, limit=args.limit,
+                            on_disk=args.on_disk, quantization=None if args.quantization == 'none' else args.quantization)
+        print('{} articles, {} chunks{}'.format(state['articles'], state['chunks'], ', done' if state['done'] else ''))
+    else:
+        for result in query_index(args.query, args.index, args.collection, top_k=args.top_k, threshold=args.threshold):
+            print('{:.3f} {} ({}): {}'.format(result['score'], result['source'], result['section'] or '-',
+                                              result['text'][:200].replace('\n', ' ')))
+
+
+if __name__ == '__main__':
+    main()
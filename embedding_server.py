@@ -0,0 +1,199 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
+from tokenizers import Tokenizer
+from singleflight import SingleFlight
+from vector_cache import VectorCache, embed_cached
+
+
+class EmbeddingServer:
+    '''
+        Serves an `EmbeddingService` and a `VectorCache` to the worker processes of a multi-worker server
+        over a local socket, so that the embedding models are loaded once and the chunks embedded by one worker
+        are found in the cache by the others.
+
+        Every connection is served by its own thread; the requests of all the workers are coalesced
+        into the batches of the single embedding service.
+    '''
+
+    def __init__(self, address: str, authkey: bytes, embedder, vector_cache: VectorCache = None,
+                 dense_model_name: str = '', sparse_model_name: str = ''):
+        self.address = address
+        self.authkey = authkey
+        self.embedder = embedder
+        self.vector_cache = vector_cache
+        self.dense_model_name = dense_model_name
+        self.sparse_model_name = sparse_model_name
+        self.inflight = SingleFlight()
+        self.methods = {
+            'embed': self.embed,
+            'tokenizer': self.tokenizer,
+            'stats': self.stats,
+        }
+        self.connections = 0
+
+
+    def serve_forever(self):
+        with Listener(self.address, family='AF_UNIX', authkey=self.authkey) as listener:
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception:
+                    # e.g. a client with the wrong key
+                    continue
+                threading.Thread(target=self.handle, args=(connection,), name='embedding-connection', daemon=True).start()
+
+
+    def handle(self, connection):
+        self.connections += 1
+        try:
+            with connection:
+                while True:
+                    try:
+                        method, args = connection.recv()
+                    except (EOFError, OSError):
+                        return
+                    try:
+                        result = ('ok', self.methods[method](*args))
+                    except Exception as e:
+                        result = ('error', e)
+                    connection.send(result)
+        finally:
+            self.connections -= 1
+
+
+    def embed(self, kind: str, texts: list[str]):
+        if kind == 'passage':
+            return embed_cached(self.embedder, texts, self.vector_cache, self.inflight, self.dense_model_name, self.sparse_model_name)
+        return self.embedder.submit(kind, texts).result()
+
+
+    def tokenizer(self):
+        return self.embedder.tokenizer().to_str()
+
+
+    def stats(self):
+        return {
+            **self.embedder.stats(),
+            'connections': self.connections,
+            'vectors': self.vector_cache.stats() if self.vector_cache else {},
+        }
+
+
+class RemoteEmbeddingService:
+    '''
+        Client of an `EmbeddingServer` with the interface of `EmbeddingService`.
+
+        Requests are sent on a pool of connections, at most `max_connections` at a time.
+    '''
+
+    def __init__(self, address: str, authkey: bytes, batch_size: int = 32, max_connections: int = 8):
+        self.address = address
+        self.authkey = authkey
+        self.batch_size = batch_size
+        # the models live in the embedding server
+        self.vectorizer = None
+        self.sparse_vectorizer = None
+        self.connections = queue.LifoQueue()
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='embedding-client')
+
+
+    def call(self, method: str, *args):
+        try:
+            connection = self.connections.get_nowait()
+        except queue.Empty:
+            connection = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+        try:
+            connection.send((method, args))
+            status, result = connection.recv()
+        except BaseException:
+            connection.close()
+            raise
+        self.connections.put(connection)
+        if status == 'error':
+            raise result
+        return result
+
+
+    def embed(self, texts: list[str]):
+        return self.submit('passage', texts).result()
+
+
+    def embed_query(self, query: str):
+        return self.submit('query', [query]).result()[0]
+
+
+    def embed_dense_query(self, query: str):
+        return self.submit('dense_query', [query]).result()[0]
+
+
+    def tokenizer(self):
+        return Tokenizer.from_str(self.call('tokenizer'))
+
+
+    def submit(self, kind: str, texts: list[str]):
+        if not texts:
+            future = Future()
+            future.set_result([])
+            return future
+        return self.executor.submit(self.call, 'embed', kind, list(texts))
+
+
+    def stats(self):
+        return {
+            **self.call('stats'),
+            'server': self.address,
+        }
+
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def run(address: str, authkey: bytes, dense_model_name: str = 'sentence-transformers/all-MiniLM-L6-v2',
+        sparse_model_name: str = 'prithivida/Splade_PP_en_v1', batch_size: int = 32, threads: int = None,
+        cache_directory: str = None, max_entries: int = 50000):
+    '''
+        Loads the models and the vector cache and serves them on `address` until the process is terminated.
+        Target of the embedding server process started by `main.serve`.
+    '''
+
+    from embedding_service import EmbeddingService
+    embedder = EmbeddingService(dense_model_name, sparse_model_name, batch_size=batch_size, threads=threads)
+    embedder.embed(['Widiscover'])
+    embedder.embed_query('Widiscover')
+    vector_cache = VectorCache(os.path.join(cache_directory, 'vectors'), max_entries=max_entries) if cache_directory else None
+    try:
+        EmbeddingServer(address, authkey, embedder, vector_cache, dense_model_name, sparse_model_name).serve_forever()
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the whole process group, the main process stops the workers
+        pass
+    finally:
+        embedder.close()
+        if vector_cache:
+            vector_cache.close()
+
+
+def wait_ready(address: str, authkey: bytes, process, timeout: float = 600.0):
+    '''
+        Waits until the embedding server started in `process` accepts connections.
+    '''
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise Exception('Error: the embedding server stopped with exit code {}'.format(process.exitcode))
+        try:
+            Client(address, family='AF_UNIX', authkey=authkey).close()
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.2)
+    raise Exception('Error: the embedding server didn\'t start within {} seconds'.format(timeout))
@@ -0,0 +1,179 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from fastembed import TextEmbedding, SparseTextEmbedding
+
+
+class EmbeddingService:
+    '''
+        Runs the dense and the sparse model on a single worker thread with a fixed ONNX Runtime thread budget.
+
+        Requests from concurrent queries are put on a shared queue; the worker coalesces them into batches
+        of up to `batch_size` texts (waiting at most `max_wait` seconds for more work) and runs each model once per batch.
+    '''
+
+    def __init__(self,
+        dense_model_name: str,
+        sparse_model_name: str,
+        batch_size: int = 32,
+        threads: int = None,
+        max_wait: float = 0.005,
+    ):
+        self.batch_size = batch_size
+        self.threads = threads or os.cpu_count()
+        self.max_wait = max_wait
+        self.vectorizer = TextEmbedding(model_name=dense_model_name, threads=self.threads)
+        self.sparse_vectorizer = SparseTextEmbedding(model_name=sparse_model_name, threads=self.threads)
+        if not self.vectorizer:
+            raise Exception('Error: FastEmbed vectorizer couldn\'t be loaded')
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.counters = {
+            'requests': 0,
+            'batches': 0,
+            'texts': 0,
+        }
+        self.worker = threading.Thread(target=self._run, name='embedding-service', daemon=True)
+        self.worker.start()
+
+
+    def embed(self, texts: list[str]):
+        '''
+            Embeds passages with both models.
+                Returns:
+                    list: (dense vector, sparse indices, sparse values) tuples in the order of `texts`.
+        '''
+
+        return self.submit('passage', texts).result()
+
+
+    def embed_query(self, query: str):
+        '''
+            Embeds a query with both models.
+                Returns:
+                    tuple: The dense vector, the sparse indices and the sparse values.
+        '''
+
+        return self.submit('query', [query]).result()[0]
+
+
+    def embed_dense_query(self, query: str):
+        return self.submit('dense_query', [query]).result()[0]
+
+
+    def tokenizer(self):
+        '''
+            Returns the tokenizer of the dense model.
+        '''
+
+        model = self.vectorizer.model
+        if getattr(model, 'tokenizer', None) is None:
+            model._ensure_tokenizer()
+        return model.tokenizer
+
+
+    def submit(self, kind: str, texts: list[str]):
+        '''
+            Queues texts without waiting for them.
+                Args:
+                    kind (str): 'passage', 'query' or 'dense_query'.
+                    texts (list): The texts to embed.
+                Returns:
+                    concurrent.futures.Future: Resolves to the list returned by `embed` (or the dense vectors for 'dense_query').
+        '''
+
+        future = Future()
+        if not texts:
+            future.set_result([])
+            return future
+        with self.lock:
+            if self.closed:
+                raise Exception('Error: the embedding service is closed')
+            self.queue.put((kind, list(texts), future))
+        return future
+
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self._drain()
+                return
+            jobs = [job]
+            size = len(job[1])
+            # coalesce the requests that arrive while the batch isn't full
+            while size < self.batch_size:
+                try:
+                    job = self.queue.get(timeout=self.max_wait)
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.queue.put(None)
+                    break
+                jobs.append(job)
+                size += len(job[1])
+            for kind in ('passage', 'query', 'dense_query'):
+                group = [job for job in jobs if job[0] == kind]
+                if group:
+                    self._process(kind, group)
+
+
+    def _process(self, kind: str, jobs: list):
+        texts = [text for _, job_texts, _ in jobs for text in job_texts]
+        try:
+            if kind == 'dense_query':
+                results = list(self.vectorizer.query_embed(texts, batch_size=self.batch_size))
+            else:
+                if kind == 'query':
+                    dense = self.vectorizer.query_embed(texts, batch_size=self.batch_size)
+                    sparse = self.sparse_vectorizer.query_embed(texts, batch_size=self.batch_size)
+                else:
+                    dense = self.vectorizer.embed(texts, batch_size=self.batch_size)
+                    sparse = self.sparse_vectorizer.embed(texts, batch_size=self.batch_size)
+                results = [(vector, embedding.indices, embedding.values) for vector, embedding in zip(dense, sparse)]
+        except Exception as e:
+            for _, _, future in jobs:
+                future.set_exception(e)
+            return
+        self.counters['requests'] += len(jobs)
+        self.counters['batches'] += 1
+        self.counters['texts'] += len(texts)
+        offset = 0
+        for _, job_texts, future in jobs:
+            future.set_result(results[offset:offset + len(job_texts)])
+            offset += len(job_texts)
+
+
+    def stats(self):
+        return {
+            **self.counters,
+            'batch_size': self.batch_size,
+            'threads': self.threads,
+            'queued': self.queue.qsize(),
+        }
+
+
+    def _drain(self):
+        '''
+            Fails the jobs still queued when the service is closed, so that no caller waits for them forever.
+            The batch being embedded completes.
+        '''
+
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None:
+                job[2].set_exception(Exception('Error: the embedding service is closed'))
+
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._drain()
+            self.queue.put(None)
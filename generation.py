@@ -0,0 +1,367 @@
+import re
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError, wait
+from groq import RateLimitError, InternalServerError, APIConnectionError
+from wikifetch import retry_after
+from metrics import metrics
+
+
+# rate limits, overloaded servers and connection errors (including timeouts) are retried, other errors are raised at once
+RETRY_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+
+
+def parse_duration(value: str):
+    '''
+        Parses the reset durations of Groq's rate-limit headers, e.g. '2m59.56s' or '250ms'.
+            Returns:
+                float or None: The number of seconds, or None if the value is missing or invalid.
+    '''
+
+    matches = DURATION.findall(value or '')
+    if not matches:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in matches)
+
+
+def estimate_tokens(messages: list[dict]):
+    # about 4 characters per token, only used to pace the calls against the remaining token budget
+    return sum(len(message['content']) for message in messages) // 4
+
+
+class RateLimits:
+    '''
+        The request and token budgets of every model, as announced by the `x-ratelimit-*` headers of the last response
+        and decreased by the calls sent since then.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # model -> kind ('requests' or 'tokens') -> [remaining, monotonic time of the reset]
+        self.models = {}
+
+
+    def update(self, model: str, headers):
+        now = time.monotonic()
+        with self.lock:
+            limits = self.models.setdefault(model, {})
+            for kind in ('requests', 'tokens'):
+                reset = parse_duration(headers.get('x-ratelimit-reset-' + kind))
+                try:
+                    remaining = float(headers.get('x-ratelimit-remaining-' + kind))
+                except (TypeError, ValueError):
+                    continue
+                if reset is not None:
+                    limits[kind] = [remaining, now + reset]
+
+
+    def reserve(self, model: str, tokens: int):
+        '''
+            Takes a request and `tokens` tokens from the budgets of the model.
+                Returns:
+                    float: The number of seconds the caller has to wait for the budgets to be reset.
+        '''
+
+        now = time.monotonic()
+        delay = 0.0
+        with self.lock:
+            limits = self.models.get(model, {})
+            for kind, amount in (('requests', 1), ('tokens', tokens)):
+                limit = limits.get(kind)
+                if limit is None:
+                    continue
+                if limit[1] <= now:
+                    # the window was reset, the next response tells the new budget
+                    del limits[kind]
+                    continue
+                if limit[0] < amount:
+                    delay = max(delay, limit[1] - now)
+                limit[0] -= amount
+        return delay
+
+
+    def pause(self, model: str, seconds: float):
+        '''
+            Empties the request budget of the model for the given number of seconds, e.g. after a 429 with `Retry-After`.
+        '''
+
+        with self.lock:
+            limits = self.models.setdefault(model, {})
+            limits['requests'] = [0.0, max(limits.get('requests', [0.0, 0.0])[1], time.monotonic() + seconds)]
+
+
+class GenerationScheduler:
+    '''
+        Schedules the chat completions sent to Groq by the engine.
+
+        At most `max_concurrent` calls are sent at a time (a stream holds its slot until its first chunk), every call
+        waits for the budgets announced by the rate-limit headers of the previous responses of its model, and rate limits,
+        server and connection errors are retried with full jitter exponential backoff (or after the `Retry-After` of a 429).
+        The Groq clients are created without retries of their own.
+
+        With a fallback model, a call failing on every attempt is sent to the fallback model. With a latency SLO too
+        (seconds to the answer, or to the first chunk of a stream), a model whose recent calls were slower than the SLO
+        is replaced by the fallback model, and tried again every `probe_interval` seconds; with `hedge`, a call still
+        running after the SLO is raced against the same call to the fallback model and the first answer wins.
+    '''
+
+    def __init__(self,
+        max_concurrent: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+        probe_interval: float = 30.0,
+    ):
+        self.max_concurrent = max_concurrent
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe_interval = probe_interval
+        self.limits = RateLimits()
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self._async_slots = None
+        self.lock = threading.Lock()
+        # (model, stream) -> moving average of the latency in seconds
+        self.latencies = {}
+        # model -> monotonic time of the last call routed to it
+        self.routed = {}
+        # runs the hedged calls of `complete`
+        self.executor = ThreadPoolExecutor(max_workers=2 * max_concurrent, thread_name_prefix='generation')
+
+
+    @property
+    def async_slots(self):
+        # created in the event loop of the first asynchronous call
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_concurrent)
+        return self._async_slots
+
+
+    def observe(self, model: str, stream: bool, seconds: float):
+        with self.lock:
+            previous = self.latencies.get((model, stream))
+            self.latencies[(model, stream)] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+
+
+    def route(self, model: str, fallback_model: str, latency_slo: float, stream: bool):
+        '''
+            Returns the model a call is sent to: the fallback model while the recent calls of `model` exceed the SLO.
+        '''
+
+        if not fallback_model or not latency_slo or fallback_model == model:
+            return model
+        now = time.monotonic()
+        with self.lock:
+            if self.latencies.get((model, stream), 0.0) <= latency_slo or now - self.routed.get(model, 0.0) >= self.probe_interval:
+                self.routed[model] = now
+                return model
+        return fallback_model
+
+
+    def retry_delay(self, model: str, error: Exception, attempt: int):
+        metrics.count('widiscover_completion_retries_total', model=model, error=type(error).__name__)
+        delay = retry_after(error.response) if isinstance(error, RateLimitError) else None
+        if delay is not None:
+            # every call to this model waits, the next reserve() returns the delay
+            self.limits.pause(model, min(delay, self.max_backoff))
+            return 0.0
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+    def complete(self, client, messages: list[dict], model: str, fallback_model: str = None, latency_slo: float = 0.0,
+                 hedge: bool = False, stream: bool = False):
+        '''
+            Sends a chat completion.
+                Args:
+                    client (groq.Groq): The Groq client.
+                    messages (list): The chat messages.
+                    model (str): The generative model.
+                    fallback_model (str): The faster model answering when `model` fails or exceeds the SLO, or None.
+                    latency_slo (float): Seconds to the answer (to the first chunk for `stream`), 0 to disable.
+                    hedge (bool): Race a call still running after the SLO against the fallback model.
+                    stream (bool): Stream the completion.
+                Returns:
+                    tuple: The completion (for `stream`: the stream and its first chunk, or None) and a dictionary
+                    with the answering 'model', the 'retries' of its call and whether the call was 'hedged'.
+        '''
+
+        create = client.chat.completions.with_raw_response.create
+        chosen = self.route(model, fallback_model, latency_slo, stream)
+        if not (hedge and latency_slo and fallback_model) or chosen == fallback_model:
+            try:
+                result, retries = self._call(create, messages, chosen, stream)
+            except RETRY_ERRORS:
+                if not fallback_model or chosen == fallback_model:
+                    raise
+                chosen = fallback_model
+                result, retries = self._call(create, messages, chosen, stream)
+            return result, self._generation(model, chosen, retries, False)
+
+        primary = self.executor.submit(self._call, create, messages, chosen, stream)
+        try:
+            result, retries = primary.result(timeout=latency_slo)
+            return result, self._generation(model, chosen, retries, False)
+        except TimeoutError:
+            pass
+        except RETRY_ERRORS:
+            result, retries = self._call(create, messages, fallback_model, stream)
+            return result, self._generation(model, fallback_model, retries, False)
+        futures = {primary: chosen, self.executor.submit(self._call, create, messages, fallback_model, stream): fallback_model}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner is not None:
+                for future in futures:
+                    if future is not winner:
+                        future.add_done_callback(discard)
+                result, retries = winner.result()
+                return result, self._generation(model, futures[winner], retries, True)
+        raise primary.exception()
+
+
+    def _call(self, create, messages: list[dict], model: str, stream: bool):
+        tokens = estimate_tokens(messages)
+        attempt = 0
+        while True:
+            delay = self.limits.reserve(model, tokens)
+            if delay:
+                time.sleep(delay)
+            with self.slots:
+                start = time.perf_counter()
+                try:
+                    response = create(messages=messages, model=model, stream=stream)
+                    self.limits.update(model, response.headers)
+                    result = response.parse()
+                    if stream:
+                        result = (result, next(result, None))
+                except RETRY_ERRORS as e:
+                    error = e
+                else:
+                    self.observe(model, stream, time.perf_counter() - start)
+                    return result, attempt
+            if attempt >= self.retries:
+                raise error
+            time.sleep(self.retry_delay(model, error, attempt))
+            attempt += 1
+
+
+    async def acomplete(self, client, messages: list[dict], model: str, fallback_model: str = None, latency_slo: float = 0.0,
+                        hedge: bool = False, stream: bool = False):
+        '''
+            Asynchronous `complete` for a `groq.AsyncGroq` client; the losing call of a race is cancelled.
+        '''
+
+        create = client.chat.completions.with_raw_response.create
+        chosen = self.route(model, fallback_model, latency_slo, stream)
+        if not (hedge and latency_slo and fallback_model) or chosen == fallback_model:
+            try:
+                result, retries = await self._acall(create, messages, chosen, stream)
+            except RETRY_ERRORS:
+                if not fallback_model or chosen == fallback_model:
+                    raise
+                chosen = fallback_model
+                result, retries = await self._acall(create, messages, chosen, stream)
+            return result, self._generation(model, chosen, retries, False)
+
+        primary = asyncio.ensure_future(self._acall(create, messages, chosen, stream))
+        tasks = {primary: chosen}
+        winner = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=latency_slo)
+            if done and isinstance(primary.exception(), RETRY_ERRORS):
+                result, retries = await self._acall(create, messages, fallback_model, stream)
+                return result, self._generation(model, fallback_model, retries, False)
+            if not done:
+                tasks[asyncio.ensure_future(self._acall(create, messages, fallback_model, stream))] = fallback_model
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+            if winner is None:
+                raise primary.exception()
+            result, retries = winner.result()
+            return result, self._generation(model, tasks[winner], retries, len(tasks) > 1)
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    task.cancel()
+                    task.add_done_callback(discard_async)
+
+
+    async def _acall(self, create, messages: list[dict], model: str, stream: bool):
+        tokens = estimate_tokens(messages)
+        attempt = 0
+        while True:
+            delay = self.limits.reserve(model, tokens)
+            if delay:
+                await asyncio.sleep(delay)
+            async with self.async_slots:
+                start = time.perf_counter()
+                try:
+                    response = await create(messages=messages, model=model, stream=stream)
+                    self.limits.update(model, response.headers)
+                    result = await response.parse()
+                    if stream:
+                        try:
+                            result = (result, await result.__anext__())
+                        except StopAsyncIteration:
+                            result = (result, None)
+                except RETRY_ERRORS as e:
+                    error = e
+                except asyncio.CancelledError:
+                    # a hedged call losing the race: its latency is at least the time it ran
+                    self.observe(model, stream, time.perf_counter() - start)
+                    raise
+                else:
+                    self.observe(model, stream, time.perf_counter() - start)
+                    return result, attempt
+            if attempt >= self.retries:
+                raise error
+            await asyncio.sleep(self.retry_delay(model, error, attempt))
+            attempt += 1
+
+
+    def _generation(self, model: str, answered: str, retries: int, hedged: bool):
+        route = 'primary' if answered == model else 'hedge' if hedged else 'fallback'
+        metrics.count('widiscover_completions_total', model=answered, route=route)
+        return {
+            'model': answered,
+            'retries': retries,
+            'hedged': hedged,
+        }
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'latencies': {'{}{}'.format(model, ' (stream)' if stream else ''): round(seconds, 3)
+                              for (model, stream), seconds in self.latencies.items()},
+            }
+
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def discard(future):
+    '''
+        Closes the stream of a hedged call that lost the race.
+    '''
+
+    if not future.cancelled() and future.exception() is None:
+        result, _ = future.result()
+        if isinstance(result, tuple):
+            result[0].close()
+
+
+def discard_async(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is None:
+        result, _ = task.result()
+        if isinstance(result, tuple):
+            asyncio.ensure_future(result[0].close())
@@ -0,0 +1,185 @@
+import re
+import threading
+from html.parser import HTMLParser
+
+
+# sections that hold no prose of their own
+SKIPPED_SECTIONS = {
+    'references', 'notes', 'footnotes', 'citations', 'sources', 'works cited', 'bibliography',
+    'external links', 'see also', 'further reading',
+}
+# elements dropped with everything they contain
+SKIPPED_TAGS = {'head', 'style', 'script', 'table', 'figure', 'math', 'noscript', 'audio', 'video'}
+SKIPPED_CLASSES = {
+    'mw-references-wrap', 'references', 'reflist', 'reference', 'mw-ref', 'infobox', 'navbox', 'vertical-navbox',
+    'hatnote', 'metadata', 'ambox', 'shortdescription', 'thumb', 'gallery', 'noprint', 'mw-empty-elt', 'sidebar',
+}
+SKIPPED_ROLES = {'navigation', 'note'}
+# elements without content nor end tag, never skipped
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+HEADINGS = {'h1': 1, 'h2': 2, 'h3': 3, 'h4': 4, 'h5': 5, 'h6': 6}
+BLOCKS = {'p', 'li', 'dt', 'dd', 'blockquote', 'div', 'section', 'ul', 'ol', 'dl', 'pre', 'br'}
+HEADING_LINE = re.compile(r'^(#{1,6}) (.+)$', re.MULTILINE)
+WHITESPACE = re.compile(r'\s+')
+
+
+class _ProseParser(HTMLParser):
+    '''
+        Streaming parser of the Parsoid HTML of an article, writing the prose as markdown paragraphs, list items and headings.
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self.text = []
+        self.skipped_tag = None
+        self.skipped_depth = 0
+        self.skipped_level = None
+        self.heading = None
+        self.item = False
+
+
+    def handle_starttag(self, tag, attrs):
+        if self.skipped_tag:
+            if tag == self.skipped_tag:
+                self.skipped_depth += 1
+            return
+        if tag in VOID_TAGS:
+            if tag in BLOCKS:
+                self.flush()
+            return
+        attrs = dict(attrs)
+        classes = set((attrs.get('class') or '').split())
+        if tag in SKIPPED_TAGS or classes & SKIPPED_CLASSES or attrs.get('role') in SKIPPED_ROLES \
+                or 'display:none' in (attrs.get('style') or '').replace(' ', ''):
+            self.skipped_tag = tag
+            self.skipped_depth = 1
+            return
+        if tag in HEADINGS:
+            self.flush()
+            self.heading = HEADINGS[tag]
+        elif tag in BLOCKS:
+            self.flush()
+            self.item = tag in ('li', 'dd')
+
+
+    def handle_startendtag(self, tag, attrs):
+        # a self-closed element has no content to skip
+        if not self.skipped_tag and (tag in HEADINGS or tag in BLOCKS):
+            self.flush()
+
+
+    def handle_endtag(self, tag):
+        if self.skipped_tag:
+            if tag == self.skipped_tag:
+                self.skipped_depth -= 1
+                if not self.skipped_depth:
+                    self.skipped_tag = None
+            return
+        if tag in HEADINGS or tag in BLOCKS:
+            self.flush()
+
+
+    def handle_data(self, data):
+        if not self.skipped_tag:
+            self.text.append(data)
+
+
+    def flush(self):
+        text = WHITESPACE.sub(' ', ''.join(self.text)).strip()
+        self.text = []
+        heading, self.heading = self.heading, None
+        item, self.item = self.item, False
+        if heading:
+            # a skipped section lasts until the next heading of the same or a higher level
+            if self.skipped_level and heading > self.skipped_level:
+                return
+            self.skipped_level = heading if text.lower() in SKIPPED_SECTIONS else None
+            if text and not self.skipped_level:
+                self.blocks.append('{} {}'.format('#' * heading, text))
+            return
+        if text and not self.skipped_level:
+            self.blocks.append('- ' + text if item else text)
+
+
+class WikiTextExtractor:
+    '''
+        Extracts the prose of Wikipedia articles from their Parsoid HTML.
+
+        References, infoboxes, navigation boxes, tables, figures and hidden elements are dropped while the HTML is parsed,
+        as are the sections without prose of their own (references, external links, see also...).
+        The section headings are kept as markdown headings, so the section of every chunk can be found with `section_at`.
+        The sizes of the HTML and of the extracted text are counted to measure the reduction of the embedding work.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            'pages': 0,
+            'html_bytes': 0,
+            'text_bytes': 0,
+        }
+
+
+    def extract(self, html: str):
+        '''
+            Args:
+                html (str): The HTML of an article.
+            Returns:
+                str: The prose of the article as markdown.
+
+            Void elements never start a skipped element, they have no end tag to close it (`python -m doctest html_extract.py`):
+
+            >>> WikiTextExtractor().extract('<section><h2>Legacy</h2><p>A<img class="noprint" src=x>B</p><p>Kept?</p></section>'
+            ...                             '<section><h2>Later</h2><p>More text here.</p></section>')
+            '## Legacy\\n\\nAB\\n\\nKept?\\n\\n## Later\\n\\nMore text here.'
+        '''
+
+        parser = _ProseParser()
+        parser.feed(html)
+        parser.close()
+        parser.flush()
+        text = '\n\n'.join(parser.blocks)
+        with self.lock:
+            self.counters['pages'] += 1
+            self.counters['html_bytes'] += len(html.encode('utf-8'))
+            self.counters['text_bytes'] += len(text.encode('utf-8'))
+        return text
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                'reduction': round(1 - self.counters['text_bytes'] / self.counters['html_bytes'], 4) if self.counters['html_bytes'] else 0.0,
+            }
+
+
+def section_headings(markdown: str):
+    '''
+        Returns:
+            list: (offset, title) of the headings of a markdown text, where title is the path of the heading
+            joined with ' > ' (e.g. 'History > Early years').
+    '''
+
+    headings = []
+    path = []
+    for match in HEADING_LINE.finditer(markdown):
+        level = len(match.group(1))
+        path = [(l, title) for l, title in path if l < level] + [(level, match.group(2).strip())]
+        headings.append((match.start(), ' > '.join(title for _, title in path)))
+    return headings
+
+
+def section_at(headings: list, offset: int):
+    '''
+        Returns:
+            str or None: The section of the `headings` (see `section_headings`) containing `offset`, None for the lead section.
+    '''
+
+    section = None
+    for start, title in headings:
+        if start > offset:
+            break
+        section = title
+    return section
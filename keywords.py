@@ -0,0 +1,114 @@
+import os
+import re
+import json
+import math
+from functools import lru_cache
+
+
+# words, numbers, contractions and hyphenated words: "don't", "1984", "jean-paul"
+TOKEN = re.compile(r"[^\W_]+(?:['’-][^\W_]+)*")
+# "who's", "einstein's": the clitic is dropped from the words missing from the stopwords
+CLITIC = re.compile(r"'(?:s|re|ve|ll|d|m)$")
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# the lists named after the language, as in the corpora of NLTK
+LANGUAGE_NAMES = {
+    'en': 'english',
+    'de': 'german',
+    'fr': 'french',
+    'es': 'spanish',
+    'it': 'italian',
+    'pt': 'portuguese',
+    'nl': 'dutch',
+}
+
+
+@lru_cache(maxsize=None)
+def load_stopwords(language: str = 'en', directory: str = DIRECTORY):
+    '''
+        Loads the stopwords of a language once, from '{language}.stopwords.txt' (a JSON list)
+        and from the newline separated list named after the language (e.g. 'english').
+            Returns:
+                frozenset: The lower case stopwords of both lists.
+    '''
+
+    stopwords = set()
+    found = False
+    path = os.path.join(directory, '{}.stopwords.txt'.format(language))
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            stopwords.update(word.lower() for word in json.load(f))
+        found = True
+    path = os.path.join(directory, LANGUAGE_NAMES.get(language, language))
+    if os.path.isfile(path):
+        with open(path, encoding='utf-8') as f:
+            stopwords.update(line.strip().lower() for line in f if line.strip())
+        found = True
+    if not found:
+        raise Exception('Error: there is no stopword list for the language \'{}\''.format(language))
+    return frozenset(stopwords)
+
+
+class KeywordExtractor:
+    '''
+        Extracts the search keywords of a query: its lower case words in a single tokenizer pass, without the stopwords
+        of the language and without duplicates.
+
+        With `max_keywords`, only the rarest words are kept (in the order of the query), ranked by their inverse
+        document frequency in the word frequency table of the spelling dictionary; words missing from the table,
+        e.g. proper nouns, are the rarest. The keywords of the last `memo_size` queries are memoized.
+            Args:
+                frequency (callable): Returns the count of a word in the frequency table, None to disable the weighting.
+                total (int): The sum of the counts of the frequency table.
+                memo_size (int): The number of memoized queries.
+    '''
+
+    def __init__(self, frequency=None, total: int = 0, memo_size: int = 4096):
+        self.frequency = frequency
+        self.total = total
+        self.memoized = lru_cache(maxsize=memo_size)(self._extract)
+
+
+    def extract(self, text: str, language: str = 'en', max_keywords: int = 0):
+        '''
+            Args:
+                text (str): The query.
+                language (str): The language code of the stopwords.
+                max_keywords (int): The maximum number of keywords, 0 for all of them.
+            Returns:
+                list: The keywords.
+        '''
+
+        return list(self.memoized(text or '', language, max_keywords))
+
+
+    def _extract(self, text: str, language: str, max_keywords: int):
+        stopwords = load_stopwords(language)
+        keywords = []
+        for token in TOKEN.findall(text.lower().replace('’', "'")):
+            if token not in stopwords:
+                token = CLITIC.sub('', token)
+            if token not in stopwords and token not in keywords:
+                keywords.append(token)
+        if max_keywords and len(keywords) > max_keywords and self.frequency:
+            weights = {keyword: self.idf(keyword) for keyword in keywords}
+            kept = set(sorted(keywords, key=lambda keyword: -weights[keyword])[:max_keywords])
+            keywords = [keyword for keyword in keywords if keyword in kept]
+        return tuple(keywords)
+
+
+    def idf(self, word: str):
+        '''
+            Returns the inverse document frequency of a word, the highest for the words missing from the frequency table.
+        '''
+
+        return math.log((self.total + 1) / (self.frequency(word) + 1))
+
+
+    def stats(self):
+        info = self.memoized.cache_info()
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'memoized': info.currsize,
+            'stopword_lists': load_stopwords.cache_info().currsize,
+        }
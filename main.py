@@ -2,13 +2,27 @@
 import webbrowser
 import threading
 import time
+import asyncio
+import importlib
+import secrets
+import shutil
+import tempfile
+import multiprocessing
 import aiofiles
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse
 import json
 import os
 from widiscover_core import Widiscover
+from widiscover_async import AsyncWidiscover
+from page_cache import PageCache
+from vector_cache import VectorCache
+from answer_cache import AnswerCache
+from warmer import CacheWarmer
+import embedding_server
+from metrics import metrics
 import uvicorn
 import dotenv
 from groq import PermissionDeniedError, AuthenticationError, BadRequestError, RateLimitError
@@ -16,7 +30,142 @@ from pydantic import BaseModel, Field
 from typing import Literal
 
 
-app = FastAPI()
+def load_widiscover():
+    '''
+    Loads the embedding models once per process and warms them up.
+    '''
+    dotenv.load_dotenv(override=True)
+    load_profiler()
+    # the workers started by `serve` render the metrics of all of them
+    if os.getenv('WIDISCOVER_METRICS_DIR'):
+        metrics.share(os.environ['WIDISCOVER_METRICS_DIR'])
+    # the workers started by `serve` share the models and the vector cache of the embedding server
+    embedding_socket = os.getenv('WIDISCOVER_EMBEDDING_SOCKET')
+    embedding_service = embedding_server.RemoteEmbeddingService(
+        embedding_socket, bytes.fromhex(os.environ['WIDISCOVER_EMBEDDING_AUTHKEY']),
+        batch_size=int(os.getenv('WIDISCOVER_EMBED_BATCH_SIZE', 32)),
+    ) if embedding_socket else None
+    wd = Widiscover(
+        fetch_workers=int(os.getenv('WIDISCOVER_FETCH_WORKERS', 4)),
+        requests_per_second=float(os.getenv('WIDISCOVER_REQUESTS_PER_SECOND', 5.0)),
+        embed_batch_size=int(os.getenv('WIDISCOVER_EMBED_BATCH_SIZE', 32)),
+        embed_threads=int(os.getenv('WIDISCOVER_EMBED_THREADS', 0)) or None,
+        embedding_service=embedding_service,
+        wikipedia_url=os.getenv('WIDISCOVER_WIKIPEDIA_URL', 'https://{language}.wikipedia.org'),
+        groq_base_url=os.getenv('GROQ_BASE_URL') or None,
+        index_path=os.getenv('WIDISCOVER_INDEX_PATH') or None,
+        index_collection=os.getenv('WIDISCOVER_INDEX_COLLECTION', 'wikipedia'),
+        qdrant_location=os.getenv('WIDISCOVER_QDRANT_LOCATION', ':memory:'),
+        qdrant_on_disk=os.getenv('WIDISCOVER_QDRANT_ON_DISK', '0').lower() in ('1', 'true'),
+        qdrant_quantization=os.getenv('WIDISCOVER_QDRANT_QUANTIZATION') or None,
+        collection_prefix=os.getenv('WIDISCOVER_QDRANT_COLLECTION_PREFIX', 'widiscover'),
+        max_concurrent_completions=int(os.getenv('WIDISCOVER_MAX_CONCURRENT_COMPLETIONS', 4)),
+        completion_retries=int(os.getenv('WIDISCOVER_COMPLETION_RETRIES', 3)),
+        page_cache=PageCache(
+            path=os.path.join(os.getenv('WIDISCOVER_CACHE_DIR', '.cache'), 'pages.sqlite3'),
+            max_bytes=int(os.getenv('WIDISCOVER_PAGE_CACHE_MB', 256)) * 1024 * 1024,
+            search_ttl=float(os.getenv('WIDISCOVER_SEARCH_CACHE_TTL', 3600)),
+        ),
+        vector_cache=None if embedding_service else VectorCache(
+            directory=os.path.join(os.getenv('WIDISCOVER_CACHE_DIR', '.cache'), 'vectors'),
+            max_entries=int(os.getenv('WIDISCOVER_VECTOR_CACHE_ENTRIES', 50000)),
+        ),
+        answer_cache=AnswerCache(
+            max_entries=int(os.getenv('WIDISCOVER_ANSWER_CACHE_ENTRIES', 1000)),
+            ttl=float(os.getenv('WIDISCOVER_ANSWER_CACHE_TTL', 86400)),
+        ),
+    )
+    wd.warm_up()
+    return wd
+
+
+async def load_async_widiscover():
+    '''
+    Loads the engine in a worker thread and wraps it in its asynchronous API.
+    '''
+    wd = await asyncio.to_thread(load_widiscover)
+    awd = AsyncWidiscover(
+        wd,
+        max_concurrent_queries=int(os.getenv('WIDISCOVER_MAX_CONCURRENT_QUERIES', 8)),
+        cpu_workers=int(os.getenv('WIDISCOVER_CPU_WORKERS', 2)),
+    )
+    metrics.gauge('widiscover_queries_in_flight', lambda: awd.in_flight)
+    app.state.warmer = start_warmer(awd)
+    return awd
+
+
+def start_warmer(awd: AsyncWidiscover):
+    '''
+    Starts the background cache warmer when there is a list of pages to warm (WIDISCOVER_WARM_PAGES)
+    or a number of most searched pages to warm (WIDISCOVER_WARM_TOP_SEARCHED).
+    '''
+    keys_file = os.getenv('WIDISCOVER_WARM_PAGES') or None
+    top_searched = int(os.getenv('WIDISCOVER_WARM_TOP_SEARCHED', 0))
+    # the offline index has no pages to download
+    if awd.wd.index or not (keys_file or top_searched):
+        return None
+    warmer = CacheWarmer(
+        awd,
+        warm_settings,
+        keys_file=keys_file,
+        top_searched=top_searched,
+        cpu_budget=float(os.getenv('WIDISCOVER_WARM_CPU_BUDGET', 0.25)),
+        interval=float(os.getenv('WIDISCOVER_WARM_INTERVAL', 60)),
+        rewarm_after=float(os.getenv('WIDISCOVER_WARM_REFRESH', 3600)),
+        # the workers of a multi-worker server share their queries in flight through the metrics
+        activity=lambda: metrics.gauge_value('widiscover_queries_in_flight'),
+        lock_file=os.path.join(os.getenv('WIDISCOVER_CACHE_DIR', '.cache'), 'warmer.lock'),
+    )
+    warmer.start()
+    return warmer
+
+
+async def warm_settings():
+    '''
+    Returns the chunking arguments and the spelling distance of the queries, so that the cache warmer
+    prepares the chunks and the spelling index the queries will look up.
+    '''
+    try:
+        settings = await load_settings()
+    except Exception:
+        settings = DEFAULT_CONFIG
+    return {
+        **chunk_settings({**DEFAULT_CONFIG, **settings}),
+        'spelling': settings.get('configDistance', DEFAULT_CONFIG['configDistance']),
+    }
+
+
+def load_profiler():
+    '''
+    Adds the profiler hook named by WIDISCOVER_PROFILER ('module:callable') to the metrics.
+    The callable receives the name of every span and returns a context manager entered around it, or None.
+    '''
+    profiler = os.getenv('WIDISCOVER_PROFILER')
+    if not profiler:
+        return
+    module, _, name = profiler.partition(':')
+    try:
+        metrics.add_profiler(getattr(importlib.import_module(module), name))
+    except (ImportError, AttributeError) as e:
+        raise Exception('Error: cannot load the profiler \'{}\': {}'.format(profiler, e))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the engine is loaded in the background so that the UI is served while the models are warming up
+    app.state.warmer = None
+    app.state.widiscover = asyncio.create_task(load_async_widiscover())
+    yield
+    task = app.state.widiscover
+    if task.done() and not task.cancelled() and not task.exception():
+        if app.state.warmer:
+            await app.state.warmer.stop()
+        await task.result().aclose()
+    else:
+        task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 version = '2.0'
 app.mount("/_app", StaticFiles(directory="ui/build/_app"), name="_app")
 app.mount("/assets", StaticFiles(directory="ui/build/_app/immutable/assets"), name="assets")
@@ -25,33 +174,65 @@ DEFAULT_CONFIG = {
     'configResultNumberPerPage' : 3,
     'configChunkLength' : 1800,
     'configChunkOverlap' : 180,
+    'configChunkUnit' : 'tokens',
+    'configChunkTokens' : 256,
+    'configChunkTokenOverlap' : 32,
     'configTopKResults' : 4,
     'configThreshold' : 0.3,
+    'configRetriever' : 'numpy',
     'configDistance' : 1,
     'configGenerativeModel' : 'llama-3.3-70b-versatile',
+    'configContextTokenBudget' : 0,
+    'configAnswerCache' : False,
+    'configAnswerCacheSimilarity' : 0.95,
+    'configBatchConcurrency' : 4,
+    'configFallbackModel' : '',
+    'configLatencySLO' : 0.0,
+    'configHedgeRequests' : False,
+    'configFetchMode' : 'pages',
+    'configFetchSections' : 4,
+    'configFetchMaxKB' : 256,
+    'configMaxKeywords' : 0,
 }
 
+GenerativeModel = Literal[
+    "compound-beta",
+    "compound-beta-mini",
+    "gemma2-9b-it",
+    "llama-3.1-8b-instant",
+    "llama-3.3-70b-versatile",
+    "meta-llama/llama-4-maverick-17b-128e-instruct",
+    "meta-llama/llama-4-scout-17b-16e-instruct",
+    "meta-llama/llama-guard-4-12b",
+    "moonshotai/kimi-k2-instruct",
+    "openai/gpt-oss-120b",
+    "openai/gpt-oss-20b",
+    "qwen/qwen3-32b",
+]
+
 class ConfigModel(BaseModel):
     configResultNumberPerPage: int = Field(ge=1, le=10)
     configChunkLength: int = Field(ge=100, le=10000)
     configChunkOverlap: int = Field(ge=0, le=2000)
+    configChunkUnit: Literal["characters", "tokens"] = "tokens"
+    configChunkTokens: int = Field(default=256, ge=16, le=512)
+    configChunkTokenOverlap: int = Field(default=32, ge=0, le=256)
     configTopKResults: int = Field(ge=1, le=16)
     configThreshold: float = Field(ge=0.0, le=0.75)
+    configRetriever: Literal["numpy", "qdrant"] = "numpy"
     configDistance: int = Field(ge=0, le=2)
-    configGenerativeModel: Literal[
-        "compound-beta",
-        "compound-beta-mini",
-        "gemma2-9b-it",
-        "llama-3.1-8b-instant",
-        "llama-3.3-70b-versatile",
-        "meta-llama/llama-4-maverick-17b-128e-instruct",
-        "meta-llama/llama-4-scout-17b-16e-instruct",
-        "meta-llama/llama-guard-4-12b",
-        "moonshotai/kimi-k2-instruct",
-        "openai/gpt-oss-120b",
-        "openai/gpt-oss-20b",
-        "qwen/qwen3-32b",
-    ]
+    configGenerativeModel: GenerativeModel
+    configContextTokenBudget: int = Field(default=0, ge=0, le=32000)
+    configAnswerCache: bool = False
+    configAnswerCacheSimilarity: float = Field(default=0.95, ge=0.5, le=1.0)
+    configBatchConcurrency: int = Field(default=4, ge=1, le=32)
+    configFallbackModel: Literal["", GenerativeModel] = ""
+    configLatencySLO: float = Field(default=0.0, ge=0.0, le=60.0)
+    configHedgeRequests: bool = False
+    configFetchMode: Literal["pages", "sections"] = "pages"
+    configFetchSections: int = Field(default=4, ge=1, le=32)
+    configFetchMaxKB: int = Field(default=256, ge=16, le=4096)
+    configMaxKeywords: int = Field(default=0, ge=0, le=16)
 
 @app.get("/")
 async def render_index():
@@ -248,6 +429,13 @@ async def post_config(request: Request):
 
         # remove groq API key from the json before writing the config
         data.pop('envGroqKey')
+        # keep the settings the request doesn't mention
+        try:
+            async with aiofiles.open('config.json', 'r') as f:
+                previous = json.loads(await f.read())
+        except Exception:
+            previous = {}
+        data = {**previous, **data}
         # validate data
         try:
             valid_data = ConfigModel(**data)
@@ -260,6 +448,11 @@ async def post_config(request: Request):
         async with aiofiles.open('config.json', 'w') as f:
             # overwrite all settings
             await f.write(valid_data.model_dump_json(indent=2))
+        # cached answers were generated by the previous model
+        task = app.state.widiscover
+        if valid_data.configGenerativeModel != previous.get('configGenerativeModel') and task.done() \
+                and not task.cancelled() and not task.exception() and task.result().wd.answer_cache:
+            task.result().wd.answer_cache.clear()
         return {
                 'status' : 303,
                 'redirects' : '/main'
@@ -277,6 +470,102 @@ async def get_default_values():
     return DEFAULT_CONFIG
 
 
+@app.get('/api/ready')
+async def get_ready():
+    '''
+    GET /api/ready :
+    reports whether the embedding models are loaded and warm.
+
+    success:
+        {
+            status: 200,
+            message: "ok",
+        }
+
+    error:
+        HTTPException(503, "Models are still loading.")
+        HTTPException(503, "Models couldn't be loaded.")
+    '''
+    task = app.state.widiscover
+    if not task.done():
+        raise HTTPException(status_code=503, detail='Models are still loading.')
+    if task.cancelled() or task.exception():
+        raise HTTPException(status_code=503, detail='Models couldn\'t be loaded.')
+    return {
+        'status' : 200,
+        'message' : 'ok'
+    }
+
+
+async def get_widiscover():
+    '''
+    Returns the process-wide AsyncWidiscover engine, waiting for it if the models are still loading.
+    '''
+    try:
+        return await asyncio.shield(app.state.widiscover)
+    except Exception:
+        raise HTTPException(status_code=503, detail='Models couldn\'t be loaded.')
+
+
+@app.get('/api/cache')
+async def get_cache():
+    '''
+    GET /api/cache :
+    returns the hit/miss counters and the size of the page, vector and answer caches,
+    the HTML bytes read and the text bytes kept by the page extraction, the bytes downloaded and avoided by the section-level
+    fetching, the memoized spelling corrections and query keywords,
+    the searches, page downloads and embeddings shared by concurrent queries, the pages warmed by the cache warmer
+    and the number of queries in flight, of the worker process `worker` (its pid) that answered.
+
+    success:
+        {
+            status: 200,
+            message: <json object>
+        }
+    '''
+    awd = await get_widiscover()
+    wd = awd.wd
+    # the vector cache of the workers of a multi-worker server is the one of the embedding server
+    embedding = wd.embedder.stats()
+    return {
+        'status' : 200,
+        'message' : {
+            'worker': os.getpid(),
+            'pages': await awd.run_cache(wd.page_cache.stats) if wd.page_cache else {},
+            'vectors': wd.vector_cache.stats() if wd.vector_cache else embedding.pop('vectors', {}),
+            'answers': wd.answer_cache.stats() if wd.answer_cache else {},
+            'embedding': embedding,
+            'extraction': wd.extractor.stats(),
+            'sections': wd.section_stats.stats(),
+            'spelling': wd.spelling.stats(),
+            'keywords': wd.keywords.stats(),
+            'coalesced': wd.inflight.stats(),
+            'generation': wd.scheduler.stats(),
+            'warmer': app.state.warmer.stats() if app.state.warmer else {},
+            'queries': {
+                'in_flight': awd.in_flight,
+                'max_concurrent': awd.max_concurrent_queries,
+            },
+        }
+    }
+
+
+@app.get('/metrics')
+async def get_metrics():
+    '''
+    GET /metrics :
+    returns the counters and the latency histograms of the pipeline stages in the Prometheus text format.
+    '''
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+def timings_requested(request: Request, data: dict):
+    '''
+    Returns whether the client asked for the timings of its query, with '"timings": true' in the body or '?timings=1'.
+    '''
+    return bool(data.get('timings')) or request.query_params.get('timings', '').lower() in ('1', 'true')
+
+
 @app.post("/api/query")
 async def root_post(request: Request):
     '''
@@ -289,7 +578,8 @@ async def root_post(request: Request):
 
         {
             "query": "Your question here",
-            "topic": "Optional topic for context"
+            "topic": "Optional topic for context",
+            "timings": true to get the seconds spent in every stage (optional)
         }
 
     success:
@@ -297,7 +587,9 @@ async def root_post(request: Request):
         {
             "answer": "Generated answer from AI",
             "sources": [Array of source information],
-            "usage": {Usage statistics}
+            "usage": {Usage statistics},
+            "cached": true if the answer comes from the answer cache,
+            "timings": {stage: seconds} if requested
         }
 
     error:
@@ -305,40 +597,131 @@ async def root_post(request: Request):
         HTTPException(401, "Authentication error") - Invalid API key
         HTTPException(403, "Access denied") - Permission issues
         HTTPException(429, "Too Many Requests") - Rate limit exceeded
+        HTTPException(503, "Models couldn't be loaded.") - The engine failed to start
     '''
     try:
         data = await request.json()
-        result = await generate_answer(data)
+        awd = await get_widiscover()
+        # the pipeline task started by cancel_on_disconnect inherits the timings of the request
+        with metrics.request() as timings, metrics.span('query.total'):
+            result = await cancel_on_disconnect(request, generate_answer(data, awd))
+        metrics.count('widiscover_queries_total', endpoint='query', status='ok' if result else 'empty')
+        if result and timings_requested(request, data):
+            result = {**result, 'timings': timings.as_dict()}
         return result
     except HTTPException as e:
+        metrics.count('widiscover_queries_total', endpoint='query', status=e.status_code)
         raise e
 
-async def generate_answer(data):
+
+async def cancel_on_disconnect(request: Request, coroutine, interval: float = 0.5):
+    '''
+    Awaits a coroutine and cancels it if the client disconnects in the meantime.
+    '''
+    task = asyncio.ensure_future(coroutine)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                return None
+    finally:
+        task.cancel()
+
+async def load_settings():
+    async with aiofiles.open('config.json', 'r') as f:
+        content = await f.read()
+    return json.loads(content)
+
+
+def chunk_settings(settings):
+    '''
+    Returns the chunking arguments of `Widiscover.ingest` for the configured unit.
+    '''
+    if settings.get('configChunkUnit', DEFAULT_CONFIG['configChunkUnit']) == 'tokens':
+        return {
+            'length': settings.get('configChunkTokens', DEFAULT_CONFIG['configChunkTokens']),
+            'overlap': settings.get('configChunkTokenOverlap', DEFAULT_CONFIG['configChunkTokenOverlap']),
+            'unit': 'tokens',
+        }
+    return {
+        'length': settings.get('configChunkLength'),
+        'overlap': settings.get('configChunkOverlap'),
+        'unit': 'characters',
+    }
+
+
+async def ingest(awd: AsyncWidiscover, query: str, keys: list, settings):
+    '''
+    Downloads, chunks and embeds the pages found for a query: the whole pages, or only their sections most relevant
+    to the query when 'configFetchMode' is 'sections'.
+    '''
+    if settings.get('configFetchMode', DEFAULT_CONFIG['configFetchMode']) == 'sections':
+        return await awd.ingest_sections(query, keys, **chunk_settings(settings),
+                                         max_sections=settings.get('configFetchSections', DEFAULT_CONFIG['configFetchSections']),
+                                         max_bytes=settings.get('configFetchMaxKB', DEFAULT_CONFIG['configFetchMaxKB']) * 1024)
+    return await awd.ingest(keys, **chunk_settings(settings))
+
+
+def generation_settings(settings):
+    '''
+    Returns the fallback model, latency SLO and hedging arguments of `Widiscover.answer`.
+    '''
+    return {
+        'fallback_model': settings.get('configFallbackModel') or None,
+        'latency_slo': settings.get('configLatencySLO', DEFAULT_CONFIG['configLatencySLO']),
+        'hedge': settings.get('configHedgeRequests', DEFAULT_CONFIG['configHedgeRequests']),
+    }
+
+
+async def generate_answer(data, awd: AsyncWidiscover):
     '''
     Generates an answer based on the input data.
         Parameters:
             data (dict): A dictionary containing the keys 'query' and 'topic'.
+            awd (AsyncWidiscover): The shared engine.
         Returns:
-            dict: A dictionary containing the keys 'answer', 'sources' and 'usage'.
+            dict: A dictionary containing the keys 'answer', 'sources', 'usage' and 'cached'.
     '''
-    async with aiofiles.open('config.json', 'r') as f:
-        content = await f.read()
-    settings = json.loads(content)
+    settings = await load_settings()
+    wd = awd.wd
 
     try:
-        query = data.get('query')
-        topic = data.get('topic')
-        wd = Widiscover(generative_model=settings.get('configGenerativeModel'))
-        if not topic:
-            keywords = wd.extract_keywords(query)
-        else:
-            keywords = topic.split()
-        keys = wd.wikisearch(keywords, result_number_per_page=settings.get('configResultNumberPerPage'))
-        docs = wd.extract_text(keys)
-        chunks = wd.process_docs(docs, keys, length=settings.get('configChunkLength'), overlap=settings.get('configChunkOverlap'))
-        rel_docs = wd.search_chunks(query, chunks, top_k=settings.get('configTopKResults'), threshold=settings.get('configThreshold'))
-        wd.clear_data()
-        return wd.answer(query, rel_docs, spelling=settings.get('configDistance'))
+        async with awd.slot():
+            query = data.get('query')
+            topic = data.get('topic')
+            query_vector = None
+            if query and settings.get('configAnswerCache') and wd.answer_cache:
+                query_vector = (await awd.embed_dense_query(query))[0]
+                cached = wd.answer_cache.lookup(query_vector, settings.get('configGenerativeModel'), topic,
+                                                threshold=settings.get('configAnswerCacheSimilarity', 0.95))
+                if cached:
+                    return {**cached, 'cached': True}
+            if wd.index:
+                with metrics.span('query.retrieve'):
+                    rel_docs = await awd.search_index(query, top_k=settings.get('configTopKResults'), threshold=settings.get('configThreshold'))
+            else:
+                with metrics.span('query.keywords'):
+                    keywords = wd.extract_keywords(query, settings.get('configMaxKeywords', DEFAULT_CONFIG['configMaxKeywords'])) if not topic else topic.split()
+                with metrics.span('query.search'):
+                    keys = await awd.wikisearch(keywords, result_number_per_page=settings.get('configResultNumberPerPage')) or []
+                with metrics.span('query.ingest'):
+                    chunks = await ingest(awd, query, keys, settings)
+                with metrics.span('query.retrieve'):
+                    rel_docs = await awd.search_chunks(query, chunks, top_k=settings.get('configTopKResults'), threshold=settings.get('configThreshold'),
+                                                       retriever=settings.get('configRetriever', DEFAULT_CONFIG['configRetriever']))
+            with metrics.span('query.answer'):
+                result = await awd.answer(query, rel_docs, spelling=settings.get('configDistance'),
+                                          generative_model=settings.get('configGenerativeModel'),
+                                          token_budget=settings.get('configContextTokenBudget', DEFAULT_CONFIG['configContextTokenBudget']),
+                                          **generation_settings(settings))
+            if not result:
+                return result
+            if query_vector is not None:
+                wd.answer_cache.store(query_vector, settings.get('configGenerativeModel'), result, topic)
+            return {**result, 'cached': False}
     except BadRequestError:
         raise HTTPException(status_code=400, detail='Bad Request')
     except AuthenticationError:
@@ -349,12 +732,263 @@ async def generate_answer(data):
         raise HTTPException(status_code=429, detail='Too Many Requests')
 
 
+@app.post("/api/query/batch")
+async def root_post_batch(request: Request):
+    '''
+    POST /api/query/batch :
+    Answers many queries at once. The searches, page downloads, embeddings and retrieval are shared by the whole batch,
+    the answers are generated with at most 'configBatchConcurrency' requests to Groq at the same time.
+
+    request body:
+
+        {
+            "queries": ["Your question here", {"query": "Another question", "topic": "Optional topic"}, ...],
+            "timings": true to get the seconds spent in every stage (optional)
+        }
+
+    success:
+
+        {
+            "results": [
+                {"answer": "...", "sources": [...], "usage": {...}, "cached": false},
+                {"error": {"status": 429, "detail": "Too Many Requests"}},
+                ...
+            ]
+        }
+
+    The results are in the order of the queries, a failed query gets an 'error' instead of failing the batch.
+
+    error:
+        HTTPException(400, "Bad Request") - 'queries' is not a list, is empty or is too long
+        HTTPException(503, "Models couldn't be loaded.") - The engine failed to start
+    '''
+    data = await request.json()
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not queries:
+        raise HTTPException(status_code=400, detail='Bad Request: \'queries\' must be a non-empty list.')
+    max_queries = int(os.getenv('WIDISCOVER_MAX_BATCH_QUERIES', 500))
+    if len(queries) > max_queries:
+        raise HTTPException(status_code=400, detail='Bad Request: at most {} queries per batch.'.format(max_queries))
+    awd = await get_widiscover()
+    with metrics.request() as timings, metrics.span('query.total'):
+        results = await cancel_on_disconnect(request, generate_batch(queries, awd))
+    if results is None:
+        metrics.count('widiscover_queries_total', len(queries), endpoint='batch', status='disconnected')
+        return None
+    for result in results:
+        metrics.count('widiscover_queries_total', endpoint='batch', status=result.get('error', {}).get('status', 'ok'))
+    response = {'results': results}
+    if timings_requested(request, data):
+        response['timings'] = timings.as_dict()
+    return response
+
+
+async def generate_batch(queries: list, awd: AsyncWidiscover):
+    '''
+    Answers a batch of queries in a single query slot.
+        Returns:
+            list: The result of every query, or its 'error'.
+    '''
+    settings = await load_settings()
+    async with awd.slot():
+        results = await awd.answer_batch(
+            queries,
+            result_number_per_page=settings.get('configResultNumberPerPage'),
+            top_k=settings.get('configTopKResults'),
+            threshold=settings.get('configThreshold'),
+            retriever=settings.get('configRetriever', DEFAULT_CONFIG['configRetriever']),
+            spelling=settings.get('configDistance'),
+            generative_model=settings.get('configGenerativeModel'),
+            token_budget=settings.get('configContextTokenBudget', DEFAULT_CONFIG['configContextTokenBudget']),
+            max_concurrent_answers=settings.get('configBatchConcurrency', DEFAULT_CONFIG['configBatchConcurrency']),
+            max_keywords=settings.get('configMaxKeywords', DEFAULT_CONFIG['configMaxKeywords']),
+            **generation_settings(settings),
+            **chunk_settings(settings))
+    return [{'error': batch_error(result)} if isinstance(result, BaseException) else {**(result or {}), 'cached': False}
+            for result in results]
+
+
+def batch_error(e: BaseException):
+    '''
+    Returns the status and the detail of the error of a query of a batch, like the HTTPException of POST /api/query.
+    '''
+    for error, status, detail in (
+        (BadRequestError, 400, 'Bad Request'),
+        (ValueError, 400, 'Bad Request'),
+        (AuthenticationError, 401, 'Authentication error'),
+        (PermissionDeniedError, 403, 'Access denied'),
+        (RateLimitError, 429, 'Too Many Requests'),
+    ):
+        if isinstance(e, error):
+            return {'status': status, 'detail': detail}
+    return {'status': 500, 'detail': str(e) or type(e).__name__}
+
+
+@app.post("/api/query/stream")
+async def root_post_stream(request: Request):
+    '''
+    POST /api/query/stream :
+    Accepts the same JSON payload as POST /api/query and streams the progress of the pipeline
+    as Server-Sent Events, followed by the tokens of the answer as the model generates them.
+
+    events:
+
+        event: keywords   data: {"keywords": [...]}
+        event: pages      data: {"pages": [...]}
+        event: chunks     data: {"chunks": <number of indexed chunks>}
+        event: contexts   data: {"contexts": <number of selected chunks>, "sources": [...]}
+        event: token      data: {"token": "..."}
+        event: done       data: {"answer": "...", "sources": [...], "usage": {...}, "cached": false, "timings": {...} if requested}
+
+    error:
+        event: error      data: {"status": <http status>, "detail": "..."}
+    '''
+    data = await request.json()
+    awd = await get_widiscover()
+    settings = await load_settings()
+    # Starlette cancels the generator when the client disconnects
+    return StreamingResponse(
+        stream_answer(data, settings, awd, timings_requested(request, data)),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def server_sent_event(event: str, data: dict):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+
+async def stream_answer(data, settings, awd: AsyncWidiscover, with_timings: bool = False):
+    '''
+    Runs the pipeline of `generate_answer` and yields a Server-Sent Event after every stage.
+    '''
+    status = 'disconnected'
+    try:
+        with metrics.request() as timings:
+            async for event in stream_events(data, settings, awd):
+                if event[0] == 'done':
+                    status = 'ok'
+                    if with_timings:
+                        event = ('done', {**event[1], 'timings': timings.as_dict()})
+                elif event[0] == 'error':
+                    status = event[1]['status']
+                yield server_sent_event(*event)
+    finally:
+        metrics.count('widiscover_queries_total', endpoint='stream', status=status)
+
+
+async def stream_events(data, settings, awd: AsyncWidiscover):
+    '''
+    Yields the (event, data) pairs of `stream_answer`.
+    '''
+    wd = awd.wd
+    start = time.perf_counter()
+    try:
+        async with awd.slot():
+            query = data.get('query')
+            topic = data.get('topic')
+            query_vector = None
+            if query and settings.get('configAnswerCache') and wd.answer_cache:
+                query_vector = (await awd.embed_dense_query(query))[0]
+                cached = wd.answer_cache.lookup(query_vector, settings.get('configGenerativeModel'), topic,
+                                                threshold=settings.get('configAnswerCacheSimilarity', 0.95))
+                if cached:
+                    yield 'done', {**cached, 'cached': True}
+                    return
+            if wd.index:
+                # the offline index has no keywords, pages or chunks of its own to report
+                with metrics.span('query.retrieve'):
+                    rel_docs = await awd.search_index(query, top_k=settings.get('configTopKResults'), threshold=settings.get('configThreshold'))
+            else:
+                with metrics.span('query.keywords'):
+                    keywords = wd.extract_keywords(query, settings.get('configMaxKeywords', DEFAULT_CONFIG['configMaxKeywords'])) if not topic else topic.split()
+                yield 'keywords', {'keywords': keywords}
+                with metrics.span('query.search'):
+                    keys = await awd.wikisearch(keywords, result_number_per_page=settings.get('configResultNumberPerPage')) or []
+                yield 'pages', {'pages': keys}
+                with metrics.span('query.ingest'):
+                    chunks = await ingest(awd, query, keys, settings)
+                yield 'chunks', {'chunks': len(chunks)}
+                with metrics.span('query.retrieve'):
+                    rel_docs = await awd.search_chunks(query, chunks, top_k=settings.get('configTopKResults'), threshold=settings.get('configThreshold'),
+                                                       retriever=settings.get('configRetriever', DEFAULT_CONFIG['configRetriever']))
+            yield 'contexts', {'contexts': len(rel_docs), 'sources': wd.source_urls(rel_docs)}
+            # the answer span includes the time the client takes to read the tokens
+            answer_start = time.perf_counter()
+            async for event, value in awd.answer_stream(query, rel_docs, spelling=settings.get('configDistance'),
+                                                        generative_model=settings.get('configGenerativeModel'),
+                                                        token_budget=settings.get('configContextTokenBudget', DEFAULT_CONFIG['configContextTokenBudget']),
+                                                        **generation_settings(settings)):
+                if event == 'token':
+                    yield 'token', {'token': value}
+                else:
+                    if query_vector is not None:
+                        wd.answer_cache.store(query_vector, settings.get('configGenerativeModel'), value, topic)
+                    metrics.record('query.answer', time.perf_counter() - answer_start)
+                    metrics.record('query.total', time.perf_counter() - start)
+                    yield 'done', {**value, 'cached': False}
+    except BadRequestError:
+        yield 'error', {'status': 400, 'detail': 'Bad Request'}
+    except AuthenticationError:
+        yield 'error', {'status': 401, 'detail': 'Authentication error'}
+    except PermissionDeniedError:
+        yield 'error', {'status': 403, 'detail': 'Access denied'}
+    except RateLimitError:
+        yield 'error', {'status': 429, 'detail': 'Too Many Requests'}
+    except Exception as e:
+        # e.g. a Groq server or connection error left after the retries, or a failed Wikipedia request
+        yield 'error', batch_error(e)
+
+
 def open_browser():
     time.sleep(1.5)  # Wait for server to start
     webbrowser.open("http://127.0.0.1:7454")
 
 
+def serve(host: str = "0.0.0.0", port: int = 7454, workers: int = 1):
+    '''
+    Runs the server. With several workers, the embedding models and the vector cache are loaded once
+    in an embedding server process shared by the workers (forking after the ONNX sessions are created isn't safe),
+    the page cache is shared through SQLite, and the rate limit towards Wikipedia is split between the workers.
+    A local Qdrant directory can only be opened by one process, the workers need the URL of a Qdrant server instead.
+    '''
+    if workers <= 1:
+        uvicorn.run("main:app", host=host, port=port)
+        return
+    dotenv.load_dotenv(override=True)
+    for name in ('WIDISCOVER_QDRANT_LOCATION', 'WIDISCOVER_INDEX_PATH'):
+        location = os.getenv(name) or ':memory:'
+        if location != ':memory:' and not location.startswith(('http://', 'https://')):
+            raise Exception('Error: {} is the local Qdrant directory \'{}\', which only one of the {} workers can open, '
+                            'set it to the URL of a Qdrant server'.format(name, location, workers))
+    address = os.path.join(tempfile.mkdtemp(prefix='widiscover-'), 'embedding.sock')
+    authkey = secrets.token_bytes(16)
+    server = multiprocessing.get_context('spawn').Process(
+        target=embedding_server.run,
+        args=(address, authkey),
+        kwargs={
+            'batch_size': int(os.getenv('WIDISCOVER_EMBED_BATCH_SIZE', 32)),
+            'threads': int(os.getenv('WIDISCOVER_EMBED_THREADS', 0)) or None,
+            'cache_directory': os.getenv('WIDISCOVER_CACHE_DIR', '.cache'),
+            'max_entries': int(os.getenv('WIDISCOVER_VECTOR_CACHE_ENTRIES', 50000)),
+        },
+        name='widiscover-embedding',
+        daemon=True,
+    )
+    server.start()
+    try:
+        embedding_server.wait_ready(address, authkey, server)
+        os.environ['WIDISCOVER_EMBEDDING_SOCKET'] = address
+        os.environ['WIDISCOVER_EMBEDDING_AUTHKEY'] = authkey.hex()
+        os.environ['WIDISCOVER_METRICS_DIR'] = os.path.join(os.path.dirname(address), 'metrics')
+        os.environ['WIDISCOVER_REQUESTS_PER_SECOND'] = str(float(os.getenv('WIDISCOVER_REQUESTS_PER_SECOND', 5.0)) / workers)
+        uvicorn.run("main:app", host=host, port=port, workers=workers)
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+
+
 if __name__ == "__main__":
     threading.Thread(target=open_browser).start()
-    uvicorn.run("main:app", host="0.0.0.0", port=7454)
+    serve(workers=int(os.getenv('WIDISCOVER_WORKERS', 1)))
 
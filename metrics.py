@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import atexit
+import inspect
+import itertools
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager, ExitStack
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# the timings of the request being processed, set by `Metrics.request`
+_timings = contextvars.ContextVar('widiscover_timings', default=None)
+
+
+class RequestTimings:
+    '''
+        The time spent in every span of a single request. Spans running in parallel (e.g. page downloads) add up.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+
+    def as_dict(self):
+        with self.lock:
+            return {name: round(seconds, 4) for name, seconds in self.spans.items()}
+
+
+class Metrics:
+    '''
+        Process-wide counters and histograms rendered in the Prometheus text format.
+
+        `span` times a block of code into the `widiscover_span_seconds` histogram and into the timings of the current request,
+        and enters the context managers of the profilers added with `add_profiler`.
+        The worker processes of a multi-worker server `share` a directory where every worker writes its metrics,
+        so that any worker renders the metrics of all of them.
+    '''
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.help = {}
+        self.profilers = []
+        self.directory = None
+
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+
+    def gauge(self, name: str, function):
+        '''
+            Registers a gauge whose value is read from `function` when the metrics are rendered.
+        '''
+
+        self.gauges[name] = function
+
+
+    def add_profiler(self, profiler):
+        '''
+            Adds a profiler hook: a callable receiving the name of every span and returning a context manager
+            entered around the span, or None to leave the span alone.
+        '''
+
+        self.profilers.append(profiler)
+
+
+    @contextmanager
+    def span(self, name: str):
+        with ExitStack() as stack:
+            for profiler in self.profilers:
+                manager = profiler(name)
+                if manager is not None:
+                    stack.enter_context(manager)
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+
+    def timed(self, name: str):
+        '''
+            Decorates a function or a coroutine function so that every call runs in a span.
+        '''
+
+        def decorator(function):
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await function(*args, **kwargs)
+            else:
+                @functools.wraps(function)
+                def wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    def record(self, name: str, seconds: float):
+        self.observe('widiscover_span_seconds', seconds, span=name)
+        timings = _timings.get()
+        if timings is not None:
+            timings.add(name, seconds)
+
+
+    @contextmanager
+    def request(self):
+        '''
+            Collects the timings of the spans run in the current context (and the tasks and threads it starts).
+        '''
+
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        try:
+            yield timings
+        finally:
+            _timings.reset(token)
+
+
+    def share(self, directory: str, interval: float = 1.0):
+        '''
+            Writes the metrics of this process to `directory` every `interval` seconds and when it exits,
+            and renders the sum of the metrics written there by all the processes.
+            The metrics of a stopped worker are kept, so the counters never go back.
+        '''
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.dump()
+
+        threading.Thread(target=run, name='widiscover-metrics', daemon=True).start()
+        atexit.register(self.dump)
+
+
+    def snapshot(self):
+        '''
+            Returns the counters, histograms and current gauge values of this process.
+        '''
+
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {name: {key: {'buckets': list(histogram['buckets']), 'sum': histogram['sum'], 'count': histogram['count']}
+                                 for key, histogram in series.items()} for name, series in self.histograms.items()}
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = {(): function()}
+            except Exception:
+                continue
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+
+    def dump(self):
+        # the gauges are written to a file of their own, so that reading one gauge of all the workers stays cheap
+        snapshot = {kind: {name: [[list(map(list, key)), value] for key, value in series.items()] for name, series in named.items()}
+                    for kind, named in self.snapshot().items()}
+        gauges = {'gauges': snapshot.pop('gauges')}
+        for suffix, content in (('.json', snapshot), ('.gauges.json', gauges)):
+            path = os.path.join(self.directory, '{}{}'.format(os.getpid(), suffix))
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(content, f)
+            os.replace(path + '.tmp', path)
+
+
+    def shared(self, gauges: bool = False):
+        '''
+            Yields the snapshots written by the other processes sharing the directory: their gauges if `gauges`
+            (only of the processes still running), their counters and histograms otherwise.
+        '''
+
+        if not self.directory:
+            return
+        pid = str(os.getpid())
+        suffix = '.gauges.json' if gauges else '.json'
+        for filename in os.listdir(self.directory):
+            owner, _, rest = filename.partition('.')
+            if '.' + rest != suffix or owner == pid or not owner.isdigit() or (gauges and not running(int(owner))):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), encoding='utf-8') as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+
+    def gauge_value(self, name: str):
+        '''
+            Returns the sum of a gauge over the processes sharing the directory, without collecting the other metrics.
+        '''
+
+        total = self.gauges[name]() if name in self.gauges else 0
+        for snapshot in self.shared(gauges=True):
+            total += sum(value for _, value in snapshot['gauges'].get(name, []))
+        return total
+
+
+    def collect(self):
+        '''
+            Returns the snapshot of this process, added to the ones of the other processes sharing the directory
+            (without the gauges of the processes that stopped).
+        '''
+
+        total = self.snapshot()
+        for snapshot in itertools.chain(self.shared(), self.shared(gauges=True)):
+            for kind, named in snapshot.items():
+                for name, series in named.items():
+                    merged = total[kind].setdefault(name, {})
+                    for key, value in series:
+                        key = tuple(map(tuple, key))
+                        if kind != 'histograms':
+                            merged[key] = merged.get(key, 0) + value
+                        elif key not in merged:
+                            merged[key] = value
+                        else:
+                            merged[key] = {'buckets': [a + b for a, b in zip(merged[key]['buckets'], value['buckets'])],
+                                           'sum': merged[key]['sum'] + value['sum'], 'count': merged[key]['count'] + value['count']}
+        return total
+
+
+    def render(self):
+        lines = []
+        collected = self.collect()
+        for name, series in sorted(collected['counters'].items()):
+            lines += self._header(name, 'counter')
+            for key, value in series.items():
+                lines.append('{}{} {}'.format(name, labels(key), value))
+        for name, series in sorted(collected['histograms'].items()):
+            lines += self._header(name, 'histogram')
+            for key, histogram in series.items():
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    lines.append('{}_bucket{} {}'.format(name, labels(key + (('le', str(bound)),)), count))
+                lines.append('{}_bucket{} {}'.format(name, labels(key + (('le', '+Inf'),)), histogram['count']))
+                lines.append('{}_sum{} {}'.format(name, labels(key), histogram['sum']))
+                lines.append('{}_count{} {}'.format(name, labels(key), histogram['count']))
+        for name, series in sorted(collected['gauges'].items()):
+            lines += self._header(name, 'gauge')
+            for key, value in series.items():
+                lines.append('{}{} {}'.format(name, labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+
+    def _header(self, name: str, kind: str):
+        header = ['# HELP {} {}'.format(name, self.help[name])] if name in self.help else []
+        return header + ['# TYPE {} {}'.format(name, kind)]
+
+
+def labels(key: tuple):
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in key) + '}'
+
+
+def running(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def timings():
+    '''
+        Returns the timings of the current request, or None outside of `Metrics.request`.
+    '''
+
+    return _timings.get()
+
+
+metrics = Metrics()
+metrics.describe('widiscover_span_seconds', 'Time spent in every method and pipeline stage.')
+metrics.describe('widiscover_queries_total', 'Queries answered, by endpoint and status.')
+metrics.describe('widiscover_pages_fetched_total', 'Wikipedia pages downloaded, revalidated or served from the page cache.')
+metrics.describe('widiscover_downloaded_bytes_total', 'Bytes downloaded from Wikipedia.')
+metrics.describe('widiscover_progressive_bytes_total', 'Bytes downloaded by the section-level fetching, and bytes it avoided downloading.')
+metrics.describe('widiscover_chunks_total', 'Chunks created, and chunks actually embedded (not found in the vector cache).')
+metrics.describe('widiscover_tokens_total', 'Prompt and completion tokens of the generative model.')
+metrics.describe('widiscover_completions_total', 'Completions by the model that answered and its route (primary, fallback or hedge).')
+metrics.describe('widiscover_completion_retries_total', 'Completions retried, by model and error.')
+metrics.describe('widiscover_pages_warmed_total', 'Pages warmed, or failed, by the background cache warmer.')
+metrics.describe('widiscover_queries_in_flight', 'Queries holding a processing slot.')
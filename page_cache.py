@@ -0,0 +1,231 @@
+import os
+import re
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+
+# the version of the page conversion, pages converted by another version are dropped when the cache is opened
+PAGE_FORMAT = 2
+
+
+class PageCache:
+    '''
+        On-disk cache of the converted Wikipedia pages and of the search results, stored in a single SQLite file.
+
+        Pages are keyed by language and page key and keep the ETag / revision they were converted from,
+        so stale entries are revalidated with a conditional request instead of being downloaded again.
+        The page table is bounded by the total size of the compressed markdown and evicts the least recently used pages.
+        Search results expire after `search_ttl` seconds.
+    '''
+
+    def __init__(self,
+        path: str = '.cache/pages.sqlite3',
+        max_bytes: int = 256 * 1024 * 1024,
+        page_max_age: float = 3600.0,
+        search_ttl: float = 3600.0,
+    ):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.page_max_age = page_max_age
+        self.search_ttl = search_ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                language TEXT NOT NULL,
+                key TEXT NOT NULL,
+                etag TEXT,
+                revision INTEGER,
+                markdown BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (language, key)
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS pages_used_at ON pages (used_at)')
+        # the total size of the pages is kept up to date by triggers, so that storing a page never scans the table
+        # (the workers of a multi-worker server share the database, an in-memory total would miss their writes)
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS page_bytes (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total INTEGER NOT NULL
+            )''')
+        self.connection.execute('INSERT OR IGNORE INTO page_bytes SELECT 0, COALESCE(SUM(size), 0) FROM pages')
+        self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS pages_inserted AFTER INSERT ON pages
+            BEGIN UPDATE page_bytes SET total = total + new.size; END''')
+        self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS pages_deleted AFTER DELETE ON pages
+            BEGIN UPDATE page_bytes SET total = total - old.size; END''')
+        self.connection.execute('''
+            CREATE TRIGGER IF NOT EXISTS pages_resized AFTER UPDATE OF size ON pages
+            BEGIN UPDATE page_bytes SET total = total + new.size - old.size; END''')
+        self.connection.execute('COMMIT')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != PAGE_FORMAT:
+            self.connection.execute('DELETE FROM pages')
+            self.connection.execute('PRAGMA user_version={}'.format(PAGE_FORMAT))
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS searches (
+                language TEXT NOT NULL,
+                query TEXT NOT NULL,
+                keys TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (language, query)
+            )''')
+        self.counters = {
+            'page_hits': 0,
+            'page_misses': 0,
+            'page_revalidations': 0,
+            'page_stale': 0,
+            'page_evictions': 0,
+            'search_hits': 0,
+            'search_misses': 0,
+        }
+
+
+    def _count(self, counter: str):
+        self.counters[counter] += 1
+
+
+    def get_page(self, language: str, key: str):
+        '''
+            Looks up a converted page.
+                Returns:
+                    dict or None: The keys 'markdown', 'etag', 'revision' and 'fresh'
+                    ('fresh' is False when the entry is older than `page_max_age` and must be revalidated).
+        '''
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT markdown, etag, revision, fetched_at FROM pages WHERE language = ? AND key = ?',
+                (language, key)).fetchone()
+            if row is None:
+                self._count('page_misses')
+                return None
+            now = time.time()
+            self.connection.execute(
+                'UPDATE pages SET used_at = ? WHERE language = ? AND key = ?', (now, language, key))
+            fresh = now - row[3] < self.page_max_age
+            self._count('page_hits' if fresh else 'page_stale')
+        return {
+            'markdown': zlib.decompress(row[0]).decode('utf-8'),
+            'etag': row[1],
+            'revision': row[2],
+            'fresh': fresh,
+        }
+
+
+    def put_page(self, language: str, key: str, markdown: str, etag: str = None):
+        '''
+            Stores a converted page and evicts the least recently used pages if the cache grew beyond `max_bytes`.
+        '''
+
+        blob = zlib.compress(markdown.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            # an upsert rather than a replace, the replaced row would be deleted without firing the delete trigger
+            self.connection.execute(
+                '''INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (language, key) DO UPDATE SET
+                    etag = excluded.etag, revision = excluded.revision, markdown = excluded.markdown, size = excluded.size,
+                    fetched_at = excluded.fetched_at, used_at = excluded.used_at''',
+                (language, key, etag, revision_from_etag(etag), blob, len(blob), now, now))
+            self._evict()
+
+
+    def revalidated(self, language: str, key: str):
+        '''
+            Marks a cached page as fresh again after the server answered `304 Not Modified`.
+        '''
+
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'UPDATE pages SET fetched_at = ?, used_at = ? WHERE language = ? AND key = ?', (now, now, language, key))
+            self._count('page_revalidations')
+
+
+    def _total(self):
+        return self.connection.execute('SELECT total FROM page_bytes').fetchone()[0]
+
+
+    def _evict(self, batch_size: int = 64):
+        total = self._total()
+        while total > self.max_bytes:
+            rows = self.connection.execute(
+                'SELECT language, key, size FROM pages ORDER BY used_at LIMIT ?', (batch_size,)).fetchall()
+            if not rows:
+                break
+            for language, key, size in rows:
+                self.connection.execute('DELETE FROM pages WHERE language = ? AND key = ?', (language, key))
+                self._count('page_evictions')
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+
+    def get_search(self, language: str, query: str):
+        '''
+            Looks up the page keys of a previous search.
+                Returns:
+                    list or None: The page keys, or None if the search isn't cached or has expired.
+        '''
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT keys, created_at FROM searches WHERE language = ? AND query = ?', (language, query)).fetchone()
+            if row is None or time.time() - row[1] >= self.search_ttl:
+                self._count('search_misses')
+                return None
+            self._count('search_hits')
+        return json.loads(row[0])
+
+
+    def put_search(self, language: str, query: str, keys: list[str]):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)', (language, query, json.dumps(keys), now))
+            self.connection.execute('DELETE FROM searches WHERE created_at < ?', (now - self.search_ttl,))
+
+
+    def stats(self):
+        '''
+            Returns the hit/miss counters together with the number of entries and the size of the page table.
+        '''
+
+        with self.lock:
+            pages = self.connection.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+            size = self._total()
+            searches = self.connection.execute('SELECT COUNT(*) FROM searches').fetchone()[0]
+            return {
+                **self.counters,
+                'pages': pages,
+                'page_bytes': size,
+                'max_bytes': self.max_bytes,
+                'searches': searches,
+            }
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def revision_from_etag(etag: str):
+    '''
+        Extracts the revision id from a Parsoid ETag such as `W/"1234567/5f0e..."`.
+    '''
+
+    if not etag:
+        return None
+    match = re.search(r'"?(\d+)/', etag)
+    return int(match.group(1)) if match else None
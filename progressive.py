@@ -0,0 +1,228 @@
+import re
+import json
+import threading
+import numpy as np
+from html_extract import SKIPPED_SECTIONS
+
+
+TAG = re.compile(r'<[^>]+>')
+# a section's score mixes the relevance of its page (the lead) and of its own headings
+LEAD_WEIGHT = 0.5
+
+
+def lead_params(keys: list[str]):
+    '''
+        Returns the query parameters of the single request fetching the plain text lead and the wikitext length
+        of every page of `keys` (the 'extracts' and 'info' properties of the MediaWiki action API).
+    '''
+
+    return {
+        'action': 'query',
+        'prop': 'extracts|info',
+        'exintro': 1,
+        'explaintext': 1,
+        'exlimit': 'max',
+        'titles': '|'.join(keys),
+        'redirects': 1,
+        'format': 'json',
+        'formatversion': 2,
+    }
+
+
+def loads(body):
+    '''
+        Parses the body of an action API response.
+            Returns:
+                dict: The response, or None if the body isn't a JSON object (e.g. an HTML error page).
+    '''
+
+    try:
+        response = json.loads(body)
+    except ValueError:
+        return None
+    return response if isinstance(response, dict) else None
+
+
+def parse_leads(keys: list[str], response: dict):
+    '''
+        Matches the pages of a `lead_params` response to the keys they were requested with.
+            Returns:
+                dict: key -> {'title', 'lead', 'length'} for the pages that exist.
+    '''
+
+    query = response.get('query') or {}
+    renamed = {}
+    for rename in query.get('normalized', []) + query.get('redirects', []):
+        renamed[rename['from']] = rename['to']
+    pages = {page['title']: page for page in query.get('pages', []) if not page.get('missing') and not page.get('invalid')}
+    leads = {}
+    for key in keys:
+        title = key
+        seen = set()
+        # a key is normalized (underscores), then possibly redirected
+        while title in renamed and title not in pages and title not in seen:
+            seen.add(title)
+            title = renamed[title]
+        page = pages.get(title)
+        if page:
+            leads[key] = {
+                'title': page['title'],
+                'lead': page.get('extract') or '',
+                'length': page.get('length') or 0,
+            }
+    return leads
+
+
+def sections_params(key: str):
+    return {
+        'action': 'parse',
+        'page': key,
+        'prop': 'sections',
+        'redirects': 1,
+        'format': 'json',
+        'formatversion': 2,
+    }
+
+
+def section_params(key: str, index: str):
+    return {
+        'action': 'parse',
+        'page': key,
+        'section': index,
+        'prop': 'text',
+        'disableeditsection': 1,
+        'disabletoc': 1,
+        'redirects': 1,
+        'format': 'json',
+        'formatversion': 2,
+    }
+
+
+def parse_sections(title: str, response: dict, length: int):
+    '''
+        Builds the top level sections of a page from a `sections_params` response.
+            Args:
+                title (str): The title of the page, the first part of the section labels.
+                response (dict): The response of the parse API.
+                length (int): The wikitext length of the page, which bounds its last section.
+            Returns:
+                list: {'index', 'heading', 'label', 'size', 'skipped'} of every top level section, where 'label'
+                    (title, heading and subsection headings) is the text ranked against the query and 'size' the number
+                    of wikitext bytes of the section with its subsections.
+    '''
+
+    sections = []
+    for section in (response.get('parse') or {}).get('sections', []):
+        heading = TAG.sub('', section.get('line') or '').strip()
+        if section.get('toclevel') == 1:
+            sections.append({
+                'index': section['index'],
+                'heading': heading,
+                'label': '{} — {}'.format(title, heading),
+                'offset': section.get('byteoffset'),
+                'skipped': heading.lower() in SKIPPED_SECTIONS or section.get('byteoffset') is None,
+            })
+        elif sections and heading:
+            sections[-1]['label'] += '; ' + heading
+    for section, following in zip(sections, sections[1:] + [None]):
+        end = following['offset'] if following and following['offset'] is not None else length
+        section['size'] = max(0, end - section['offset']) if section['offset'] is not None else 0
+        del section['offset']
+    return sections
+
+
+def rank_sections(query_vector, lead_vectors: dict, label_vectors: list, max_sections: int):
+    '''
+        Ranks the sections of every page against the query.
+            Args:
+                query_vector: The dense vector of the query.
+                lead_vectors (dict): Page key -> dense vector of its lead.
+                label_vectors (list): (page key, section, dense vector of its label) of every candidate section.
+                max_sections (int): The number of sections kept.
+            Returns:
+                list: (score, page key, section) of the `max_sections` best sections, best first.
+    '''
+
+    query_vector = normalized(query_vector)
+    lead_scores = {key: float(np.dot(query_vector, normalized(vector))) for key, vector in lead_vectors.items()}
+    ranked = sorted(
+        ((LEAD_WEIGHT * lead_scores.get(key, 0.0) + (1 - LEAD_WEIGHT) * float(np.dot(query_vector, normalized(vector))), key, section)
+         for key, section, vector in label_vectors),
+        key=lambda item: -item[0])
+    return ranked[:max_sections]
+
+
+def normalized(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def assemble(lead: str, sections: list):
+    '''
+        Returns the markdown document of a partially fetched page: its lead, then its fetched sections in page order.
+            Args:
+                lead (str): The plain text lead.
+                sections (list): (section, markdown) of the fetched sections.
+    '''
+
+    parts = [lead] if lead else []
+    for section, markdown in sorted(sections, key=lambda item: int(item[0]['index'])):
+        # the section text starts with its own heading when the extractor kept it
+        if markdown and not markdown.startswith('#'):
+            markdown = '## {}\n\n{}'.format(section['heading'], markdown)
+        if markdown:
+            parts.append(markdown)
+    return '\n\n'.join(parts)
+
+
+class ProgressiveStats:
+    '''
+        Counters of the section-level fetching: the requests made, the bytes downloaded and the bytes avoided
+        compared to downloading the whole pages.
+
+        The bytes avoided are estimated from the wikitext length of the pages and of the sections that weren't fetched,
+        scaled by the ratio of response bytes to wikitext bytes measured on the sections that were.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            'queries': 0,
+            'pages': 0,
+            'whole_pages': 0,
+            'sections': 0,
+            'sections_cached': 0,
+            'capped': 0,
+            'bytes_downloaded': 0,
+            'bytes_avoided': 0,
+            'section_bytes': 0,
+            'section_wikitext_bytes': 0,
+        }
+
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+
+
+    def ratio(self):
+        '''
+            Returns the measured bytes downloaded per wikitext byte, 1.0 before any section was measured.
+        '''
+
+        with self.lock:
+            if not self.counters['section_wikitext_bytes']:
+                return 1.0
+            return self.counters['section_bytes'] / self.counters['section_wikitext_bytes']
+
+
+    def stats(self):
+        with self.lock:
+            downloaded = self.counters['bytes_downloaded']
+            avoided = self.counters['bytes_avoided']
+            return {
+                **self.counters,
+                'saving': round(avoided / (downloaded + avoided), 4) if downloaded + avoided else 0.0,
+            }
@@ -0,0 +1,356 @@
+import re
+import time
+import uuid
+from abc import ABC, abstractmethod
+import threading
+import numpy as np
+from qdrant_client import QdrantClient, models
+from metrics import metrics
+
+
+def qdrant_client(location: str = ':memory:'):
+    '''
+        Returns a Qdrant client for ':memory:', the directory of a local storage or the URL of a Qdrant server.
+    '''
+
+    if location == ':memory:':
+        return QdrantClient(':memory:')
+    if location.startswith(('http://', 'https://')):
+        return QdrantClient(url=location)
+    return QdrantClient(path=location)
+
+
+def collection_config(dense_dimension: int, on_disk: bool = False, quantization: str = None):
+    '''
+        Returns the arguments of `create_collection` for the dense and sparse vectors of the chunks.
+            Args:
+                dense_dimension (int): The dimension of the dense vectors.
+                on_disk (bool): Keep the dense vectors, the sparse index and the payloads on disk (memory-mapped) instead of in RAM.
+                quantization (str): 'int8' to keep a scalar quantized copy of the dense vectors in RAM, searched first
+                    and rescored with the original vectors, or None.
+        The local mode of qdrant-client (':memory:' or a directory) accepts these settings but ignores them,
+        they take effect on a Qdrant server.
+    '''
+
+    if quantization not in (None, 'int8'):
+        raise Exception('Error: unknown quantization \'{}\', expected \'int8\' or none'.format(quantization))
+    return {
+        'vectors_config': {'dense': models.VectorParams(
+            size=dense_dimension,
+            distance=models.Distance.COSINE,
+            on_disk=on_disk,
+            quantization_config=models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True,
+            )) if quantization == 'int8' else None,
+        )},
+        'sparse_vectors_config': {
+            'sparse': models.SparseVectorParams(index=models.SparseIndexParams(on_disk=on_disk))
+        },
+        'on_disk_payload': on_disk,
+    }
+
+
+def dense_search_params(quantization: str = None):
+    '''
+        Returns the search parameters of the dense prefetch: the quantized candidates are oversampled and rescored.
+    '''
+
+    if not quantization:
+        return None
+    return models.SearchParams(quantization=models.QuantizationSearchParams(rescore=True, oversampling=2.0))
+
+
+class Retriever(ABC):
+    '''
+        Ranks the chunks of a single query: the `prefetch_limit` chunks closest to the dense query vector
+        are rescored with the sparse (SPLADE) dot product, and the `top_k` best chunks scoring at least
+        `threshold` are returned. Chunks sharing no sparse index with the query are never returned.
+    '''
+
+    def search(self, chunks: list[dict], query_vectors: tuple, top_k=4, threshold=0.3, prefetch_limit=32):
+        '''
+            Args:
+                chunks (list): Chunks with their 'metadata' and 'vectors' (see `Widiscover.embed_chunks`).
+                query_vectors (tuple): The dense vector, the sparse indices and the sparse values of the query.
+                top_k (int): The maximum number of chunks returned.
+                threshold (float): The minimum sparse score of a returned chunk.
+                prefetch_limit (int): The number of dense candidates rescored with the sparse vectors.
+            Returns:
+                list: The metadata of the best chunks with their 'score', best first.
+        '''
+
+        return self.search_many(chunks, [query_vectors], top_k=top_k, threshold=threshold, prefetch_limit=prefetch_limit)[0]
+
+
+    @abstractmethod
+    def search_many(self, chunks: list[dict], query_vectors: list[tuple], subsets: list = None, top_k=4, threshold=0.3, prefetch_limit=32):
+        '''
+            Ranks a shared pool of chunks for several queries at once.
+                Args:
+                    chunks (list): The chunk pool.
+                    query_vectors (list): The vectors of every query (see `search`).
+                    subsets (list): For every query, the indices of the chunks it may return (e.g. the chunks of its own pages),
+                        or None for the whole pool.
+                Returns:
+                    list: The result of `search` for every query.
+        '''
+
+
+class QdrantRetriever(Retriever):
+    '''
+        Uploads the chunks into a temporary collection of a Qdrant client and queries it
+        with a dense prefetch rescored by the sparse vectors. The collections are named after `collection_prefix`
+        and their creation time, and stored as set by `on_disk` and `quantization` (see `collection_config`).
+        The collections older than `stale_after` seconds are left behind by a stopped process and deleted at startup,
+        the younger ones may belong to another worker or instance sharing the Qdrant server and are kept.
+    '''
+
+    def __init__(self, client: QdrantClient, dense_dimension: int = 384, collection_prefix: str = 'widiscover',
+                 on_disk: bool = False, quantization: str = None, stale_after: float = 3600.0):
+        self.client = client
+        self.dense_dimension = dense_dimension
+        self.collection_prefix = collection_prefix
+        self.collection_name = re.compile(r'^{}-(\d+)-[0-9a-f]{{32}}$'.format(re.escape(collection_prefix)))
+        self.stale_after = stale_after
+        self.on_disk = on_disk
+        self.quantization = quantization
+        self.lock = threading.Lock()
+        self.clear_stale()
+
+
+    def clear_stale(self):
+        '''
+            Deletes the collections left behind by a process that stopped in the middle of a query (persistent storage only):
+            the collections of the prefix created more than `stale_after` seconds ago.
+        '''
+
+        now = time.time()
+        with self.lock:
+            for collection in self.client.get_collections().collections:
+                match = self.collection_name.match(collection.name)
+                if match and now - int(match.group(1)) > self.stale_after:
+                    self.client.delete_collection(collection.name)
+
+
+    def create_collection(self):
+        '''
+            Creates a collection holding the chunks of a single query.
+                Returns:
+                    str: The name of the new collection.
+        '''
+
+        collection_name = '{}-{}-{}'.format(self.collection_prefix, int(time.time()), uuid.uuid4().hex)
+        with self.lock:
+            self.client.create_collection(
+                    collection_name=collection_name,
+                    **collection_config(self.dense_dimension, self.on_disk, self.quantization)
+                )
+        return collection_name
+
+
+    def clear_data(self, collection_name: str):
+        with self.lock:
+            self.client.delete_collection(collection_name)
+
+
+    def search_many(self, chunks, query_vectors, subsets=None, top_k=4, threshold=0.3, prefetch_limit=32):
+        # every call gets its own collection so that concurrent requests sharing the engine never see each other's chunks
+        collection_name = self.create_collection()
+        try:
+            with metrics.span('qdrant.upload'):
+                self.client.upload_collection(
+                    collection_name=collection_name,
+                    vectors=[{
+                        'dense': chunk['vectors']['dense'].tolist(),
+                        'sparse': models.SparseVector(
+                            indices=chunk['vectors']['sparse_indices'].tolist(),
+                            values=chunk['vectors']['sparse_values'].tolist()),
+                    } for chunk in chunks],
+                    payload=[chunk['metadata'] for chunk in chunks],
+                    ids=list(range(len(chunks))))
+            requests = []
+            for i, (dense_query, sparse_indices, sparse_values) in enumerate(query_vectors):
+                subset = subsets[i] if subsets is not None else None
+                query_filter = models.Filter(must=[models.HasIdCondition(has_id=[int(j) for j in subset])]) if subset is not None else None
+                requests.append(models.QueryRequest(
+                    prefetch=[
+                        models.Prefetch(
+                            query=np.asarray(dense_query).tolist(),
+                            using='dense',
+                            filter=query_filter,
+                            params=dense_search_params(self.quantization),
+                            limit=prefetch_limit
+                        ),
+                    ],
+                    query=models.SparseVector(indices=np.asarray(sparse_indices).tolist(), values=np.asarray(sparse_values).tolist()),
+                    using='sparse',
+                    filter=query_filter,
+                    with_payload=True,
+                    limit=top_k
+                    ))
+            with metrics.span('qdrant.query'):
+                search_results = self.client.query_batch_points(collection_name=collection_name, requests=requests) if requests else []
+        finally:
+            self.clear_data(collection_name)
+
+        return [[{**point.payload, 'score': point.score} for point in result.points[:top_k] if point.score >= threshold]
+                for result in search_results]
+
+
+class NumpyRetriever(Retriever):
+    '''
+        Pure NumPy retrieval for the few dozen chunks of a query: dense cosine similarity with a single
+        matrix product (for all the queries of a batch) and the SPLADE dot product over the CSR arrays of the sparse vectors.
+    '''
+
+    def search_many(self, chunks, query_vectors, subsets=None, top_k=4, threshold=0.3, prefetch_limit=32):
+        if not chunks or not query_vectors:
+            return [[] for _ in query_vectors]
+        dense = np.stack([chunk['vectors']['dense'] for chunk in chunks]).astype(np.float32, copy=False)
+        norms = np.linalg.norm(dense, axis=1)
+        norms[norms == 0] = 1
+        # the dense scores of all the queries with a single matrix product
+        dense_queries = np.stack([np.asarray(vectors[0], dtype=np.float32) for vectors in query_vectors])
+        query_norms = np.linalg.norm(dense_queries, axis=1)
+        query_norms[query_norms == 0] = 1
+        dense_scores = (dense_queries @ dense.T) / np.outer(query_norms, norms)
+
+        results = []
+        for i, (_, sparse_indices, sparse_values) in enumerate(query_vectors):
+            pool = np.asarray(subsets[i], dtype=np.int64) if subsets is not None else np.arange(len(chunks))
+            if len(pool) > prefetch_limit:
+                candidates = pool[np.argpartition(-dense_scores[i, pool], prefetch_limit - 1)[:prefetch_limit]]
+            else:
+                candidates = pool
+            results.append(self.rescore(chunks, candidates, sparse_indices, sparse_values, top_k, threshold))
+        return results
+
+
+    def rescore(self, chunks, candidates, sparse_indices, sparse_values, top_k=4, threshold=0.3):
+        '''
+            Ranks the candidate chunks by their sparse dot product with the query.
+        '''
+
+        if not len(candidates):
+            return []
+        # CSR arrays of the candidates' sparse vectors
+        lengths = np.array([len(chunks[i]['vectors']['sparse_indices']) for i in candidates])
+        indices = np.concatenate([chunks[i]['vectors']['sparse_indices'] for i in candidates]).astype(np.int64)
+        values = np.concatenate([chunks[i]['vectors']['sparse_values'] for i in candidates]).astype(np.float32)
+        rows = np.repeat(np.arange(len(candidates)), lengths)
+
+        query_indices = np.asarray(sparse_indices, dtype=np.int64)
+        query_values = np.asarray(sparse_values, dtype=np.float32)
+        order = np.argsort(query_indices)
+        query_indices, query_values = query_indices[order], query_values[order]
+        positions = np.clip(np.searchsorted(query_indices, indices), 0, max(len(query_indices) - 1, 0))
+        matches = query_indices[positions] == indices if len(query_indices) else np.zeros(len(indices), dtype=bool)
+        sparse_scores = np.bincount(rows[matches], weights=values[matches] * query_values[positions[matches]],
+                                    minlength=len(candidates))
+        overlaps = np.bincount(rows[matches], minlength=len(candidates)) > 0
+
+        ranked = sorted((i for i in range(len(candidates)) if overlaps[i]), key=lambda i: -sparse_scores[i])[:top_k]
+        return [{**chunks[candidates[i]]['metadata'], 'score': float(sparse_scores[i])} for i in ranked if sparse_scores[i] >= threshold]
+
+
+class QdrantIndex:
+    '''
+        A persistent collection of chunks (e.g. the articles of a Wikipedia dump, see `dump_index.py`) in a local
+        Qdrant directory or on a Qdrant server. Queries are ranked like `QdrantRetriever` ranks them, without uploading anything.
+            Args:
+                location (str): The directory of the local collection, or the URL of a Qdrant server.
+                collection_name (str): The name of the collection.
+                dense_dimension (int): The dimension of the dense vectors.
+                on_disk (bool), quantization (str): The storage of a new collection, see `collection_config`.
+                    An existing collection is searched with its own quantization.
+    '''
+
+    def __init__(self, location: str, collection_name: str = 'wikipedia', dense_dimension: int = 384,
+                 on_disk: bool = True, quantization: str = None):
+        self.location = location
+        self.collection_name = collection_name
+        self.dense_dimension = dense_dimension
+        self.on_disk = on_disk
+        self.quantization = quantization
+        self.client = qdrant_client(location)
+        if self.exists():
+            dense = self.client.get_collection(collection_name).config.params.vectors['dense']
+            self.quantization = 'int8' if dense.quantization_config else None
+
+
+    def exists(self):
+        return self.client.collection_exists(self.collection_name)
+
+
+    def create(self, recreate: bool = False):
+        '''
+            Creates the collection if it doesn't exist, or empties it when `recreate` is set.
+        '''
+
+        if recreate and self.exists():
+            self.client.delete_collection(self.collection_name)
+        if not self.exists():
+            self.client.create_collection(
+                collection_name=self.collection_name,
+                **collection_config(self.dense_dimension, self.on_disk, self.quantization)
+            )
+
+
+    def upsert(self, points: list[tuple]):
+        '''
+            Writes chunks to the collection, replacing the chunks having the same id.
+                Args:
+                    points (list): (id, dense vector, sparse indices, sparse values, metadata) tuples.
+        '''
+
+        if not points:
+            return
+        with metrics.span('qdrant.upsert'):
+            self.client.upsert(
+                collection_name=self.collection_name,
+                points=[models.PointStruct(
+                    id=point_id,
+                    vector={
+                        'dense': np.asarray(dense).tolist(),
+                        'sparse': models.SparseVector(indices=np.asarray(indices).tolist(), values=np.asarray(values).tolist()),
+                    },
+                    payload=metadata,
+                ) for point_id, dense, indices, values, metadata in points],
+                wait=True)
+
+
+    def count(self):
+        return self.client.count(self.collection_name, exact=True).count if self.exists() else 0
+
+
+    def search_many(self, query_vectors: list[tuple], top_k=4, threshold=0.3, prefetch_limit=32):
+        '''
+            Ranks the chunks of the collection for several queries, see `Retriever.search_many`.
+        '''
+
+        requests = [models.QueryRequest(
+            prefetch=[
+                models.Prefetch(
+                    query=np.asarray(dense_query).tolist(),
+                    using='dense',
+                    params=dense_search_params(self.quantization),
+                    limit=prefetch_limit
+                ),
+            ],
+            query=models.SparseVector(indices=np.asarray(sparse_indices).tolist(), values=np.asarray(sparse_values).tolist()),
+            using='sparse',
+            with_payload=True,
+            limit=top_k
+            ) for dense_query, sparse_indices, sparse_values in query_vectors]
+        if not requests:
+            return []
+        with metrics.span('qdrant.query'):
+            search_results = self.client.query_batch_points(collection_name=self.collection_name, requests=requests)
+        return [[{**point.payload, 'score': point.score} for point in result.points[:top_k] if point.score >= threshold]
+                for result in search_results]
+
+
+    def close(self):
+        self.client.close()
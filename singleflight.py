@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    '''
+        Deduplicates identical work in flight: the first caller of a key does the work and the concurrent callers
+        of the same key wait for its result instead of repeating it. Threads and coroutines share the same calls.
+
+        Keys are tuples whose first item is the kind of work ('search', 'page', 'vectors'...),
+        the calls done and the calls coalesced are counted per kind.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.counters = {}
+
+
+    def claim(self, keys: list):
+        '''
+            Claims the keys that aren't in flight.
+                Returns:
+                    tuple: The futures of the claimed keys, to be resolved with `release`, and the futures of the keys
+                    already in flight, to be waited for (dicts key -> concurrent.futures.Future).
+        '''
+
+        claimed = {}
+        waiting = {}
+        with self.lock:
+            for key in keys:
+                if key in claimed or key in waiting:
+                    continue
+                counters = self.counters.setdefault(key[0], {'calls': 0, 'coalesced': 0})
+                if key in self.calls:
+                    waiting[key] = self.calls[key]
+                    counters['coalesced'] += 1
+                else:
+                    claimed[key] = self.calls[key] = Future()
+                    counters['calls'] += 1
+        return claimed, waiting
+
+
+    def release(self, key, result=None, exception: BaseException = None):
+        '''
+            Resolves a claimed key for the callers waiting for it.
+        '''
+
+        with self.lock:
+            future = self.calls.pop(key)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+    def do(self, key, function, *args, **kwargs):
+        '''
+            Calls `function` unless a call with the same key is in flight, in which case its result is returned.
+        '''
+
+        claimed, waiting = self.claim([key])
+        if waiting:
+            return waiting[key].result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            self.release(key, exception=e)
+            raise
+        self.release(key, result)
+        return result
+
+
+    async def do_async(self, key, function, *args, **kwargs):
+        '''
+            Asynchronous `do` for a coroutine function. The shared call runs in its own task, so cancelling one
+            of the callers (e.g. when its client disconnects) doesn't cancel the others.
+        '''
+
+        claimed, waiting = self.claim([key])
+        if claimed:
+            task = asyncio.ensure_future(function(*args, **kwargs))
+            task.add_done_callback(lambda task: self._release_task(key, task))
+            future = claimed[key]
+        else:
+            future = waiting[key]
+        result = asyncio.wrap_future(future)
+        # the outcome is retrieved even if the caller was cancelled while waiting for it
+        result.add_done_callback(lambda result: result.cancelled() or result.exception())
+        return await asyncio.shield(result)
+
+
+    def _release_task(self, key, task: asyncio.Task):
+        if task.cancelled():
+            with self.lock:
+                self.calls.pop(key).cancel()
+        elif task.exception() is not None:
+            self.release(key, exception=task.exception())
+        else:
+            self.release(key, task.result())
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.calls),
+                **{kind: dict(counters) for kind, counters in self.counters.items()},
+            }
@@ -0,0 +1,207 @@
+import re
+import threading
+from functools import lru_cache
+import numpy as np
+from spellchecker import SpellChecker
+
+
+WORD = re.compile(r'[^\W\d_]+')
+
+
+class SpellingCorrector:
+    '''
+        Symmetric delete (SymSpell) spelling correction over the word frequency dictionary of pyspellchecker.
+
+        For every distance the deletes of the dictionary words (of their first `prefix_length` characters) are hashed
+        once into a sorted array, so a correction only looks up the deletes of the misspelled word instead of generating
+        and checking all of its edits. The index of a distance is built on its first use and the corrections are memoized.
+        Words added with `add_words` (e.g. the words of the Wikipedia titles already seen) are never corrected.
+        A memoized correction is keyed on the last added word it could be corrected to, so adding words only recomputes
+        the corrections of the words close to them.
+    '''
+
+    def __init__(self, language: str = 'en', prefix_length: int = 7, memo_size: int = 65536):
+        frequencies = SpellChecker(language=language, distance=1).word_frequency.dictionary
+        self.words = list(frequencies)
+        self.frequencies = np.fromiter(frequencies.values(), dtype=np.int64, count=len(self.words))
+        self.ids = {word: i for i, word in enumerate(self.words)}
+        self.total = int(self.frequencies.sum())
+        self.prefix_length = prefix_length
+        self.longest_word = max(len(word) for word in self.words)
+        self.indexes = {}
+        self.lock = threading.Lock()
+        # the words added after the indexes were built, with their deletes
+        self.added = {}
+        self.added_deletes = {}
+        self.memoized = lru_cache(maxsize=memo_size)(self._correction)
+
+
+    def deletes(self, word: str, distance: int):
+        '''
+            Returns the strings obtained by deleting up to `distance` characters of the prefix of `word`.
+        '''
+
+        edits = {word[:self.prefix_length]}
+        layer = edits
+        for _ in range(distance):
+            layer = {edit[:i] + edit[i + 1:] for edit in layer for i in range(len(edit))}
+            edits |= layer
+        return edits
+
+
+    def index(self, distance: int):
+        '''
+            Returns the sorted hashes of the deletes of the dictionary words for a distance and the id of their word.
+        '''
+
+        with self.lock:
+            if distance not in self.indexes:
+                hashes = []
+                ids = []
+                # built in blocks of words to keep the temporary lists small
+                for block in range(0, len(self.words), 10000):
+                    block_hashes = []
+                    block_ids = []
+                    for i in range(block, min(block + 10000, len(self.words))):
+                        deletes = self.deletes(self.words[i], distance)
+                        block_hashes += [hash(delete) for delete in deletes]
+                        block_ids += [i] * len(deletes)
+                    hashes.append(np.array(block_hashes, dtype=np.int64))
+                    ids.append(np.array(block_ids, dtype=np.int32))
+                hashes = np.concatenate(hashes)
+                order = np.argsort(hashes, kind='stable')
+                self.indexes[distance] = (hashes[order], np.concatenate(ids)[order])
+            return self.indexes[distance]
+
+
+    def add_words(self, text: str):
+        '''
+            Adds the words of a text (e.g. a page title such as 'Alexander_Graham_Bell') to the dictionary.
+        '''
+
+        words = [word for word in WORD.findall(text.lower()) if len(word) > 1 and word not in self.ids and word not in self.added]
+        if not words:
+            return
+        with self.lock:
+            for word in words:
+                self.added[word] = len(self.added)
+                for delete in self.deletes(word, 2):
+                    self.added_deletes.setdefault(delete, set()).add(word)
+
+
+    def last_added(self, word: str, distance: int):
+        '''
+            Returns the order of the last added word sharing a delete with `word`, i.e. that its correction may return, or -1.
+        '''
+
+        if not self.added:
+            return -1
+        return max((self.added[added] for delete in self.deletes(word, distance) for added in self.added_deletes.get(delete, ())),
+                   default=-1)
+
+
+    def correction(self, word: str, distance: int = 1):
+        '''
+            Memoized `_correction`.
+        '''
+
+        word = word.lower()
+        return self.memoized(word, distance, self.last_added(word, distance))
+
+
+    def frequency(self, word: str):
+        '''
+            Returns the count of a word in the frequency dictionary, 0 for the unknown and added words.
+        '''
+
+        i = self.ids.get(word)
+        return int(self.frequencies[i]) if i is not None else 0
+
+
+    def known(self, word: str):
+        return word in self.ids or word in self.added
+
+
+    def _correction(self, word: str, distance: int = 1, last_added: int = -1):
+        '''
+            Returns the correction of a word like `SpellChecker.correction`: the word itself if it is known,
+            otherwise the most frequent word at the smallest distance (up to `distance`), or None.
+            `last_added` (see `last_added`) only keys the memo.
+        '''
+
+        word = word.lower()
+        if self.known(word):
+            return word
+        if len(word) > self.longest_word + 3 or not distance:
+            return None
+        try:
+            float(word)
+            return None
+        except ValueError:
+            pass
+
+        hashes, ids = self.index(distance)
+        deletes = self.deletes(word, distance)
+        keys = np.array([hash(delete) for delete in deletes], dtype=np.int64)
+        starts = np.searchsorted(hashes, keys, side='left')
+        ends = np.searchsorted(hashes, keys, side='right')
+        candidates = {self.words[i] for start, end in zip(starts, ends) for i in ids[start:end]}
+        candidates |= {candidate for delete in deletes for candidate in self.added_deletes.get(delete, ())}
+
+        best = None
+        for candidate in candidates:
+            if abs(len(candidate) - len(word)) > distance:
+                continue
+            edit_distance = osa_distance(word, candidate, distance)
+            if edit_distance > distance:
+                continue
+            # the added words rank below every word of the dictionary at the same distance
+            frequency = self.frequencies[self.ids[candidate]] if candidate in self.ids else 0
+            key = (edit_distance, -frequency)
+            if best is None or key < best[0]:
+                best = (key, candidate)
+        return best[1] if best else None
+
+
+    def correct(self, query: str, distance: int = 1):
+        '''
+            Corrects the lower case words of a query, words containing an upper case character are left unchanged.
+        '''
+
+        words = query.strip().split()
+        return ' '.join(self.correction(word, distance) or word
+                        if (word.islower() or word[0] == "'" or word[0] == '"') else word
+                        for word in words)
+
+
+    def stats(self):
+        info = self.memoized.cache_info()
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'memoized': info.currsize,
+            'words': len(self.words) + len(self.added),
+            'added_words': len(self.added),
+            'indexed_distances': sorted(self.indexes),
+        }
+
+
+def osa_distance(a: str, b: str, limit: int):
+    '''
+        Optimal string alignment distance (insertions, deletions, substitutions and transpositions of adjacent characters),
+        or `limit` + 1 as soon as it exceeds `limit`.
+    '''
+
+    previous = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(row[j] + 1, current[j - 1] + 1, row[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous, row = row, current
+    return row[-1]
@@ -0,0 +1,184 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from metrics import metrics
+
+
+class VectorCache:
+    '''
+        Content addressed cache of chunk embeddings, so that unchanged chunks are never embedded twice.
+
+        Dense vectors live in a memory-mapped float32 array of `max_entries` slots, sparse vectors are stored
+        as index/value arrays next to the slot table in SQLite. Entries are keyed by a hash of the model names
+        and the chunk text, so switching either model never returns vectors of the other one.
+        When every slot is taken the least recently used entries are evicted.
+
+        The free slots are tracked in memory, so a cache directory is written by a single process: the workers
+        of a multi-worker server share the cache of the embedding server (see embedding_server.py).
+    '''
+
+    def __init__(self, directory: str = '.cache/vectors', dense_dimension: int = 384, max_entries: int = 50000):
+        os.makedirs(directory, exist_ok=True)
+        self.dense_dimension = dense_dimension
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        dense_path = os.path.join(directory, 'dense-{}.f32'.format(dense_dimension))
+        mode = 'r+' if os.path.exists(dense_path) else 'w+'
+        if mode == 'r+' and os.path.getsize(dense_path) != max_entries * dense_dimension * 4:
+            # the number of slots changed: the slot table no longer matches the array
+            os.remove(dense_path)
+            mode = 'w+'
+        self.dense = np.memmap(dense_path, dtype=np.float32, mode=mode, shape=(max_entries, dense_dimension))
+        self.connection = sqlite3.connect(
+            os.path.join(directory, 'index-{}.sqlite3'.format(dense_dimension)), check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        if mode == 'w+':
+            self.connection.execute('DROP TABLE IF EXISTS vectors')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS vectors (
+                key BLOB PRIMARY KEY,
+                slot INTEGER NOT NULL UNIQUE,
+                sparse_indices BLOB NOT NULL,
+                sparse_values BLOB NOT NULL,
+                used_at REAL NOT NULL
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS vectors_used_at ON vectors (used_at)')
+        used = {row[0] for row in self.connection.execute('SELECT slot FROM vectors')}
+        self.free_slots = [slot for slot in range(max_entries - 1, -1, -1) if slot not in used]
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+
+    @staticmethod
+    def key(text: str, dense_model_name: str, sparse_model_name: str):
+        return hashlib.blake2b('\0'.join((dense_model_name, sparse_model_name, text)).encode('utf-8'), digest_size=20).digest()
+
+
+    def get_many(self, keys: list[bytes]):
+        '''
+            Looks up the vectors of the given keys.
+                Returns:
+                    dict: key -> (dense vector, sparse indices, sparse values) for every cached key.
+        '''
+
+        found = {}
+        unique_keys = list(set(keys))
+        with self.lock:
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                rows = self.connection.execute(
+                    'SELECT key, slot, sparse_indices, sparse_values FROM vectors WHERE key IN ({})'.format(','.join('?' * len(batch))),
+                    batch).fetchall()
+                for key, slot, indices, values in rows:
+                    found[key] = (
+                        np.array(self.dense[slot]),
+                        np.frombuffer(indices, dtype=np.int32),
+                        np.frombuffer(values, dtype=np.float32),
+                    )
+            if found:
+                now = time.time()
+                self.connection.executemany('UPDATE vectors SET used_at = ? WHERE key = ?', [(now, key) for key in found])
+            self.counters['hits'] += len(found)
+            self.counters['misses'] += len(unique_keys) - len(found)
+        return found
+
+
+    def put_many(self, items: list[tuple]):
+        '''
+            Stores vectors, evicting the least recently used entries when the cache is full.
+                Args:
+                    items (list): (key, dense vector, sparse indices, sparse values) tuples.
+        '''
+
+        now = time.time()
+        with self.lock:
+            rows = []
+            seen = set()
+            for key, dense, indices, values in items:
+                if key in seen or self.connection.execute('SELECT 1 FROM vectors WHERE key = ?', (key,)).fetchone():
+                    continue
+                seen.add(key)
+                if not self.free_slots:
+                    self._evict(max(1, len(items) - len(rows)))
+                    if not self.free_slots:
+                        # the batch alone is larger than the cache
+                        break
+                slot = self.free_slots.pop()
+                self.dense[slot] = dense
+                rows.append((
+                    key, slot,
+                    np.asarray(indices, dtype=np.int32).tobytes(),
+                    np.asarray(values, dtype=np.float32).tobytes(),
+                    now))
+            self.connection.executemany('INSERT INTO vectors VALUES (?, ?, ?, ?, ?)', rows)
+
+
+    def _evict(self, count: int):
+        rows = self.connection.execute('SELECT key, slot FROM vectors ORDER BY used_at LIMIT ?', (count,)).fetchall()
+        self.connection.executemany('DELETE FROM vectors WHERE key = ?', [(key,) for key, _ in rows])
+        self.free_slots.extend(slot for _, slot in rows)
+        self.counters['evictions'] += len(rows)
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                'entries': self.max_entries - len(self.free_slots),
+                'max_entries': self.max_entries,
+            }
+
+
+    def close(self):
+        with self.lock:
+            self.dense.flush()
+            self.connection.close()
+
+
+def embed_cached(embedder, texts: list[str], vector_cache: VectorCache, inflight, dense_model_name: str, sparse_model_name: str):
+    '''
+        Embeds chunks, reusing the vectors of the cache and of the same chunks being embedded for another query.
+            Args:
+                embedder: The `EmbeddingService` (or `RemoteEmbeddingService`) computing the missing vectors.
+                texts (list): The chunks to embed.
+                vector_cache (VectorCache): The cache of the vectors, or None.
+                inflight (SingleFlight): The embeddings in flight.
+                dense_model_name (str): The dense model, part of the cache key.
+                sparse_model_name (str): The sparse model, part of the cache key.
+            Returns:
+                list: (dense vector, sparse indices, sparse values) for every text.
+    '''
+
+    keys = [VectorCache.key(text, dense_model_name, sparse_model_name) for text in texts]
+    found = vector_cache.get_many(keys) if vector_cache else {}
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found:
+            missing.setdefault(key, text)
+    # the chunks another query is already embedding are waited for instead of being embedded twice
+    claimed, waiting = inflight.claim([('vectors', key) for key in missing])
+    if claimed:
+        metrics.count('widiscover_chunks_total', len(claimed), kind='embedded')
+        claimed_keys = [key for _, key in claimed]
+        try:
+            computed = [(key, dense, indices, values) for key, (dense, indices, values) in
+                        zip(claimed_keys, embedder.embed([missing[key] for key in claimed_keys]))]
+            if vector_cache:
+                vector_cache.put_many(computed)
+        except BaseException as e:
+            for key in claimed:
+                inflight.release(key, exception=e)
+            raise
+        for key, dense, indices, values in computed:
+            found[key] = (dense, indices, values)
+            inflight.release(('vectors', key), found[key])
+    for (_, key), future in waiting.items():
+        found[key] = future.result()
+    return [found[key] for key in keys]
@@ -0,0 +1,247 @@
+import os
+import time
+import asyncio
+import logging
+import collections
+from metrics import metrics
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWarmer:
+    '''
+        Prefetches, chunks and embeds popular pages in the background, so that the first queries on them find
+        the page and vector caches warm.
+
+        The pages are the keys listed in a local file and the `top_searched` pages most frequent in the recent
+        searches of the engine. A page is warmed only while no query is in flight, one page at a time,
+        and after every page the warmer pauses long enough to keep the time it spent warming under `cpu_budget`
+        of the elapsed time, so it never competes with the live queries. The time spent is measured on the wall clock,
+        so that it includes the embedding done by an embedding server. Before the first page, the spelling
+        indexes of the configured distance are built, the other cold start cost of a first query.
+
+        The workers of a multi-worker server all build their own spelling indexes, but the pages shared through
+        the caches are only warmed by the worker holding the lock on `lock_file`, watching the queries of all the workers.
+            Args:
+                awd (AsyncWidiscover): The engine.
+                settings: Coroutine function returning the ingest arguments of the queries (chunk length, overlap and unit),
+                    so that the warmed chunks are the ones the queries look up in the vector cache, and the spelling distance.
+                keys_file (str): A file of page keys, one per line ('#' starts a comment), or None.
+                top_searched (int): The number of most searched pages warmed, 0 for none.
+                cpu_budget (float): The share of the time the warmer may spend warming, between 0 and 1.
+                interval (float): Seconds between two rounds looking for pages to warm.
+                idle_delay (float): Seconds without any query before a page is warmed.
+                activity: Function returning the number of queries in flight (of all the workers), `awd.in_flight` by default.
+                lock_file (str): The file locked by the warmer warming the pages, or None to always warm them.
+                retry_backoff (float), max_retry_backoff (float): A page that couldn't be warmed is tried again after
+                    `retry_backoff` seconds, doubled after every failure up to `max_retry_backoff`.
+                rewarm_after (float): Seconds after which a warmed page is warmed again, so that a page that went stale
+                    or was evicted from the caches since is revalidated or fetched again.
+    '''
+
+    def __init__(self, awd, settings, keys_file: str = None, top_searched: int = 0, cpu_budget: float = 0.25,
+                 interval: float = 60.0, idle_delay: float = 2.0, activity=None, lock_file: str = None,
+                 retry_backoff: float = 60.0, max_retry_backoff: float = 86400.0, rewarm_after: float = 3600.0):
+        if not 0 < cpu_budget <= 1:
+            raise Exception('Error: the CPU budget of the cache warmer must be in ]0, 1], not {}'.format(cpu_budget))
+        if keys_file and not os.path.isfile(keys_file):
+            raise Exception('Error: the page list \'{}\' of the cache warmer doesn\'t exist'.format(keys_file))
+        self.awd = awd
+        self.settings = settings
+        self.keys_file = keys_file
+        self.top_searched = top_searched
+        self.cpu_budget = cpu_budget
+        self.interval = interval
+        self.idle_delay = idle_delay
+        self.activity = activity or (lambda: awd.in_flight)
+        self.lock_file = lock_file
+        self.lock = None
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.rewarm_after = rewarm_after
+        # key -> time the page was last warmed
+        self.warmed = {}
+        # key -> (failures, time of the next attempt)
+        self.failed = {}
+        self.counters = {
+            'rounds': 0,
+            'warmed': 0,
+            'failed': 0,
+            'errors': 0,
+            'chunks': 0,
+            'spelling_indexes': 0,
+            'busy_seconds': 0.0,
+            'paused_seconds': 0.0,
+        }
+        self.pending = 0
+        self.last_error = None
+        self.idle_since = None
+        self.task = None
+
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.lock:
+            self.lock.close()
+            self.lock = None
+
+
+    def acquire(self):
+        '''
+            Takes the lock of the warmer warming the pages, without waiting.
+                Returns:
+                    bool: Whether this warmer holds the lock.
+        '''
+
+        if self.lock or not self.lock_file or fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_file)), exist_ok=True)
+        lock = open(self.lock_file, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        self.lock = lock
+        return True
+
+
+    def candidates(self):
+        '''
+            Returns the keys of the pages to warm: the keys of the file, then the most searched ones, without the pages
+            warmed or failed recently, and not yet due for another attempt.
+        '''
+
+        keys = []
+        if self.keys_file:
+            try:
+                with open(self.keys_file, encoding='utf-8') as f:
+                    keys += [line.split('#', 1)[0].strip() for line in f]
+            except (OSError, ValueError) as e:
+                self.error('cannot read the page list \'{}\': {}'.format(self.keys_file, e))
+        if self.top_searched:
+            keys += [key for key, _ in collections.Counter(list(self.awd.wd.searched_pages)).most_common(self.top_searched)]
+        now = time.monotonic()
+        return [key for key in dict.fromkeys(keys)
+                if key and self.warmed.get(key, now - self.rewarm_after) <= now - self.rewarm_after
+                and (key not in self.failed or self.failed[key][1] <= now)]
+
+
+    async def run(self):
+        while True:
+            self.counters['rounds'] += 1
+            try:
+                await self.round()
+            except Exception as e:
+                self.error('round failed: {!r}'.format(e))
+            self.pending = 0
+            await asyncio.sleep(self.interval)
+
+
+    async def round(self):
+        settings = await self.settings()
+        await self.warm_spelling(settings.pop('spelling', 0))
+        # another worker warms the pages, it is taken over when that worker stops
+        if not self.acquire():
+            return
+        keys = self.candidates()
+        self.pending = len(keys)
+        for key in keys:
+            await self.budgeted(self.warm_page, key, settings)
+            self.pending -= 1
+
+
+    def error(self, message: str):
+        self.counters['errors'] += 1
+        self.last_error = message
+        logger.warning('cache warmer: %s', message)
+
+
+    async def wait_idle(self):
+        '''
+            Waits until no query was in flight for `idle_delay` seconds.
+        '''
+
+        while True:
+            if self.activity():
+                self.idle_since = None
+            elif self.idle_since is None:
+                self.idle_since = time.monotonic()
+            elif time.monotonic() - self.idle_since >= self.idle_delay:
+                return
+            await asyncio.sleep(min(0.5, self.idle_delay))
+
+
+    async def budgeted(self, function, *args):
+        '''
+            Runs a warming step once the engine is idle, then pauses so that the time it took stays within the budget.
+        '''
+
+        await self.wait_idle()
+        start = time.perf_counter()
+        await function(*args)
+        used = time.perf_counter() - start
+        if self.activity():
+            self.idle_since = None
+        pause = used * (1 - self.cpu_budget) / self.cpu_budget
+        self.counters['busy_seconds'] += used
+        self.counters['paused_seconds'] += pause
+        await asyncio.sleep(pause)
+
+
+    async def warm_spelling(self, distance: int):
+        wd = self.awd.wd
+        for d in range(1, int(distance) + 1):
+            if d not in wd.spelling.indexes:
+                await self.budgeted(self.awd.run, wd.spelling.index, d)
+                self.counters['spelling_indexes'] += 1
+
+
+    async def warm_page(self, key: str, settings: dict):
+        try:
+            with metrics.span('warm'):
+                chunks = await self.awd.ingest([key], **settings)
+        except Exception as e:
+            self.error('cannot warm \'{}\': {!r}'.format(key, e))
+            chunks = []
+        # a page that couldn't be fetched has no chunks, it is tried again later with an exponential backoff
+        if not chunks:
+            failures = self.failed.get(key, (0, 0))[0] + 1
+            backoff = min(self.retry_backoff * 2 ** (failures - 1), self.max_retry_backoff)
+            self.failed[key] = (failures, time.monotonic() + backoff)
+            self.counters['failed'] += 1
+            metrics.count('widiscover_pages_warmed_total', result='failed')
+            return
+        self.failed.pop(key, None)
+        self.warmed[key] = time.monotonic()
+        self.counters['warmed'] += 1
+        self.counters['chunks'] += len(chunks)
+        metrics.count('widiscover_pages_warmed_total', result='warmed')
+
+
+    def stats(self):
+        return {
+            **self.counters,
+            'busy_seconds': round(self.counters['busy_seconds'], 3),
+            'paused_seconds': round(self.counters['paused_seconds'], 3),
+            'pending': self.pending,
+            'retrying': len(self.failed),
+            'last_error': self.last_error,
+            'warming_pages': bool(self.lock) or not self.lock_file or fcntl is None,
+            'cpu_budget': self.cpu_budget,
+        }
@@ -0,0 +1,437 @@
+import os
+import time
+import asyncio
+import functools
+import contextvars
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from groq import AsyncGroq
+from widiscover_core import Widiscover, revalidation_headers, usage_dict, count_tokens, batch_page_keys
+from wikifetch import AsyncWikiFetcher
+from metrics import metrics
+import progressive
+
+
+class AsyncWidiscover:
+    '''
+        Asynchronous API of a `Widiscover` engine for the FastAPI endpoints.
+
+        Wikipedia requests are awaited on an `httpx.AsyncClient` sharing the engine's rate limiter and caches,
+        the answer is generated with the async Groq client, and the CPU bound work (markdown conversion, chunking,
+        embedding, retrieval, spell checking) runs on a bounded thread pool. The lookups and updates of the page and search
+        cache (SQLite, zlib, JSON) run on a thread pool of their own, so that they neither wait behind the CPU bound work
+        nor block the event loop while another thread holds the lock of the cache.
+        At most `max_concurrent_queries` queries run at the same time, the others wait for a slot.
+    '''
+
+    def __init__(self, wd: Widiscover, max_concurrent_queries: int = 8, cpu_workers: int = 2, cache_workers: int = 4):
+        self.wd = wd
+        self.fetcher = AsyncWikiFetcher(
+            wd.fetcher.limiter,
+            headers=wd.headers,
+            max_connections=wd.fetcher.max_workers,
+            timeout=wd.fetcher.timeout,
+            retries=wd.fetcher.retries,
+            backoff=wd.fetcher.backoff,
+            max_backoff=wd.fetcher.max_backoff)
+        self.executor = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix='widiscover-cpu')
+        self.cache_executor = ThreadPoolExecutor(max_workers=cache_workers, thread_name_prefix='widiscover-cache')
+        self.queries = asyncio.Semaphore(max_concurrent_queries)
+        self.max_concurrent_queries = max_concurrent_queries
+        self.in_flight = 0
+        self._groq = None
+        self._groq_key = None
+        self._groq_lock = threading.Lock()
+
+
+    @property
+    def groq(self):
+        '''
+            Returns an async Groq client for the current API key (see `Widiscover.groq`).
+        '''
+
+        api_key = self.wd.groq_api_key or os.getenv('GROQ_API_KEY')
+        with self._groq_lock:
+            if self._groq is None or api_key != self._groq_key:
+                self._groq = AsyncGroq(api_key=api_key, base_url=self.wd.groq_base_url, max_retries=0) if api_key \
+                    else AsyncGroq(base_url=self.wd.groq_base_url, max_retries=0)
+                self._groq_key = api_key
+            return self._groq
+
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        '''
+            Holds one of the `max_concurrent_queries` processing slots, `in_flight` counts the queries holding one.
+        '''
+
+        async with self.queries:
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+
+
+    async def run(self, function, *args, **kwargs):
+        '''
+            Runs a blocking function of the engine on the bounded thread pool, in a copy of the current context
+            so that its spans are added to the timings of the request.
+        '''
+
+        call = functools.partial(contextvars.copy_context().run, function, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+
+    async def run_cache(self, function, *args, **kwargs):
+        '''
+            Runs a blocking call to the page and search cache on the cache thread pool, like `run`.
+        '''
+
+        call = functools.partial(contextvars.copy_context().run, function, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.cache_executor, call)
+
+
+    @metrics.timed('wikisearch')
+    async def wikisearch(self, search_keywords, result_number_per_page = 3):
+        '''
+            Asynchronous `Widiscover.wikisearch`.
+        '''
+
+        params, cache_key = self.wd.search_params(search_keywords, result_number_per_page)
+        urls = await self.run_cache(self.wd.cached_search, cache_key)
+        if urls is not None:
+            return urls
+        return await self.wd.inflight.do_async(('search', self.wd.language_code, cache_key), self.request_search,
+                                               params, cache_key, result_number_per_page)
+
+
+    async def request_search(self, params: dict, cache_key: str, result_number_per_page = 3):
+        with metrics.span('download'):
+            response = await self.fetcher.get(self.wd.search_url(), params=params)
+        metrics.count('widiscover_downloaded_bytes_total', len(response.content))
+        if response.status_code != 200:
+            return
+        return await self.run_cache(lambda: self.wd.parse_search(response.json(), cache_key, result_number_per_page))
+
+
+    async def fetch_page(self, key: str):
+        '''
+            Asynchronous `Widiscover.fetch_page`.
+        '''
+
+        cached = await self.run_cache(self.wd.cached_page, key)
+        if cached and cached['fresh']:
+            metrics.count('widiscover_pages_fetched_total', result='cached')
+            return cached['markdown']
+        return await self.wd.inflight.do_async(('page', self.wd.language_code, key), self.download_page, key, cached)
+
+
+    async def download_page(self, key: str, cached):
+        async with self.fetcher.downloads:
+            try:
+                with metrics.span('download'):
+                    response = await self.fetcher.get(self.wd.page_url(key), headers=revalidation_headers(cached))
+            except httpx.HTTPError:
+                metrics.count('widiscover_pages_fetched_total', result='failed')
+                return cached['markdown'] if cached else ''
+        metrics.count('widiscover_downloaded_bytes_total', len(response.content))
+        return await self.run(self.wd.convert_page, key, cached, response.status_code, response.text, response.headers.get('ETag'))
+
+
+    @metrics.timed('ingest')
+    async def ingest(self, keys: list[str], length=1800, overlap=180, unit='characters', batch_size=None, max_pending_pages=4):
+        '''
+            Asynchronous `Widiscover.ingest`: pages download concurrently while the chunks of the pages
+            already downloaded are embedded on the thread pool.
+        '''
+
+        batch_size = batch_size or self.wd.embedder.batch_size
+        remaining = iter(keys or [])
+        pending = {}
+
+        def submit_next():
+            key = next(remaining, None)
+            if key is not None:
+                pending[asyncio.ensure_future(self.fetch_page(key))] = key
+
+        for _ in range(max_pending_pages):
+            submit_next()
+        chunks = []
+        batch = []
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key = pending.pop(task)
+                    submit_next()
+                    batch += await self.run(self.wd.process_docs, [task.result()], [key], length=length, overlap=overlap, unit=unit)
+                while len(batch) >= batch_size:
+                    chunks += await self.run(self.wd.embed_chunks, batch[:batch_size])
+                    batch = batch[batch_size:]
+            if batch:
+                chunks += await self.run(self.wd.embed_chunks, batch)
+        finally:
+            for task in pending:
+                task.cancel()
+        return chunks
+
+
+    @metrics.timed('ingest')
+    async def ingest_sections(self, query: str, keys: list[str], length=1800, overlap=180, unit='characters', max_sections=4, max_bytes=262144):
+        '''
+            Asynchronous `Widiscover.ingest_sections`.
+        '''
+
+        docs, sources, outlined = await self.run_cache(self.wd.cached_pages, keys)
+        outlines, downloaded = await self.fetch_outlines(outlined)
+        whole = [key for key in outlined if key not in outlines]
+        docs += await asyncio.gather(*[self.fetch_page(key) for key in whole])
+        sources += whole
+        ranked = await self.run(self.wd.rank_sections, query, outlines, max_sections)
+        fetched, section_bytes, capped = await self.fetch_sections(ranked, max_bytes - downloaded)
+        self.wd.record_progressive(outlines, whole, fetched, downloaded + section_bytes, capped)
+        partial_docs, partial_sources = self.wd.progressive_docs(outlines, fetched)
+        chunks = await self.run(self.wd.process_docs, docs + partial_docs, sources + partial_sources, length=length, overlap=overlap, unit=unit)
+        return await self.run(self.wd.embed_chunks, chunks) if chunks else []
+
+
+    async def fetch_outlines(self, keys: list[str]):
+        '''
+            Asynchronous `Widiscover.fetch_outlines`.
+        '''
+
+        outlines = {}
+        missing = []
+        for key, outline in zip(keys, await self.run_cache(lambda: [self.wd.cached_outline(key) for key in keys])):
+            if outline:
+                outlines[key] = outline
+            else:
+                missing.append(key)
+        if not missing:
+            return outlines, 0
+        try:
+            with metrics.span('download'):
+                response = await self.fetcher.get(self.wd.api_url(), params=progressive.lead_params(missing))
+        except httpx.HTTPError:
+            return outlines, 0
+        downloaded = len(response.content)
+        metrics.count('widiscover_downloaded_bytes_total', downloaded)
+        if response.status_code != 200:
+            return outlines, downloaded
+        leads = progressive.parse_leads(missing, progressive.loads(response.content) or {})
+        results = await asyncio.gather(*[self.fetch_outline(key, lead) for key, lead in leads.items()])
+        for key, (outline, size) in zip(leads, results):
+            downloaded += size
+            if outline:
+                outlines[key] = outline
+        return outlines, downloaded
+
+
+    async def fetch_outline(self, key: str, lead: dict):
+        async with self.fetcher.downloads:
+            try:
+                with metrics.span('download'):
+                    response = await self.fetcher.get(self.wd.api_url(), params=progressive.sections_params(key))
+            except httpx.HTTPError:
+                return None, 0
+        metrics.count('widiscover_downloaded_bytes_total', len(response.content))
+        outline = await self.run_cache(self.wd.convert_outline, key, lead, response.status_code, response.content)
+        return outline, len(response.content)
+
+
+    async def fetch_sections(self, ranked: list, max_bytes: int):
+        '''
+            Asynchronous `Widiscover.fetch_sections`.
+        '''
+
+        remaining = list(ranked)
+        pending = {}
+        fetched = []
+        downloaded = 0
+
+        def submit_next():
+            if remaining and downloaded < max_bytes:
+                _, key, section = remaining.pop(0)
+                pending[asyncio.ensure_future(self.fetch_section(key, section))] = (key, section)
+
+        for _ in range(self.wd.fetcher.max_workers):
+            submit_next()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key, section = pending.pop(task)
+                    markdown, size = task.result()
+                    downloaded += size
+                    fetched.append((key, section, markdown))
+                    submit_next()
+        finally:
+            for task in pending:
+                task.cancel()
+        return fetched, downloaded, len(remaining)
+
+
+    async def fetch_section(self, key: str, section: dict):
+        '''
+            Asynchronous `Widiscover.fetch_section`.
+        '''
+
+        cache_key = '{}#{}'.format(key, section['index'])
+        cached = await self.run_cache(self.wd.page_cache.get_page, self.wd.language_code, cache_key) if self.wd.page_cache else None
+        if cached and cached['fresh']:
+            self.wd.section_stats.add(sections_cached=1)
+            return cached['markdown'], 0
+        return await self.wd.inflight.do_async(('section', self.wd.language_code, cache_key), self.download_section, key, section)
+
+
+    async def download_section(self, key: str, section: dict):
+        async with self.fetcher.downloads:
+            try:
+                with metrics.span('download'):
+                    response = await self.fetcher.get(self.wd.api_url(), params=progressive.section_params(key, section['index']))
+            except httpx.HTTPError:
+                return '', 0
+        metrics.count('widiscover_downloaded_bytes_total', len(response.content))
+        markdown = await self.run(self.wd.convert_section, key, section, response.status_code, response.content)
+        return markdown, len(response.content)
+
+
+    async def search_chunks(self, query, chunks, top_k=4, threshold=0.3, retriever='numpy'):
+        return await self.run(self.wd.search_chunks, query, chunks, top_k=top_k, threshold=threshold, retriever=retriever)
+
+
+    async def embed_dense_query(self, query: str):
+        return await asyncio.wrap_future(self.wd.embedder.submit('dense_query', [query]))
+
+
+    async def search_index(self, query: str, top_k=4, threshold=0.3):
+        '''
+            Asynchronous `Widiscover.search_index` for a single query.
+        '''
+
+        return (await self.run(self.wd.search_index, [query], top_k=top_k, threshold=threshold))[0]
+
+
+    async def answer(self, query: str, context: list[dict], spelling=0, generative_model=None, token_budget=0,
+                     fallback_model=None, latency_slo=0.0, hedge=False):
+        '''
+            Asynchronous `Widiscover.answer`.
+        '''
+
+        if not query:
+            return
+        if int(spelling):
+            query = await self.run(self.wd.check_spelling, query, spelling)
+        context, packing = await self.run(self.wd.pack_context, context, generative_model, token_budget)
+        with metrics.span('generate'):
+            response, generation = await self.wd.scheduler.acomplete(
+                self.groq,
+                self.wd.messages(query, [item['text'] for item in context]),
+                generative_model or self.wd.generative_model,
+                fallback_model=fallback_model,
+                latency_slo=latency_slo,
+                hedge=hedge,
+            )
+        count_tokens(response.usage)
+        return {
+            'answer': response.choices[0].message.content,
+            'sources': self.wd.source_urls(context),
+            'usage': {**usage_dict(response.usage), **packing, **generation},
+        }
+
+
+    async def answer_stream(self, query: str, context: list[dict], spelling=0, generative_model=None, token_budget=0,
+                            fallback_model=None, latency_slo=0.0, hedge=False):
+        '''
+            Asynchronous `Widiscover.answer_stream`.
+        '''
+
+        if not query:
+            return
+        if int(spelling):
+            query = await self.run(self.wd.check_spelling, query, spelling)
+        context, packing = await self.run(self.wd.pack_context, context, generative_model, token_budget)
+        start = time.perf_counter()
+        (stream, first), generation = await self.wd.scheduler.acomplete(
+            self.groq,
+            self.wd.messages(query, [item['text'] for item in context]),
+            generative_model or self.wd.generative_model,
+            fallback_model=fallback_model,
+            latency_slo=latency_slo,
+            hedge=hedge,
+            stream=True,
+        )
+        parts = []
+        usage = None
+        async for chunk in prepend(first, stream):
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield 'token', chunk.choices[0].delta.content
+            if chunk.x_groq and chunk.x_groq.usage:
+                usage = chunk.x_groq.usage
+            elif chunk.usage:
+                usage = chunk.usage
+        metrics.record('generate', time.perf_counter() - start)
+        count_tokens(usage)
+        yield 'answer', {
+            'answer': ''.join(parts),
+            'sources': self.wd.source_urls(context),
+            'usage': {**usage_dict(usage), **packing, **generation},
+        }
+
+
+    async def answer_batch(self, queries: list, result_number_per_page=3, length=1800, overlap=180, unit='characters',
+                           top_k=4, threshold=0.3, retriever='numpy', spelling=0, generative_model=None, token_budget=0,
+                           fallback_model=None, latency_slo=0.0, hedge=False, max_concurrent_answers=4, max_keywords=0):
+        '''
+            Asynchronous `Widiscover.answer_batch`.
+        '''
+
+        items = await self.run(self.wd.batch_items, queries, max_keywords)
+        if self.wd.index:
+            ready = [i for i, item in enumerate(items) if not isinstance(item, Exception)]
+            contexts = await self.run(self.wd.search_index, [items[i][0] for i in ready], top_k=top_k, threshold=threshold)
+        else:
+            searches = list(dict.fromkeys(tuple(item[2]) for item in items if not isinstance(item, Exception)))
+            found = await asyncio.gather(*[self.wikisearch(list(keywords), result_number_per_page) for keywords in searches],
+                                         return_exceptions=True)
+            items, keys = batch_page_keys(items, dict(zip(searches, found)))
+
+            chunks = await self.ingest(keys, length=length, overlap=overlap, unit=unit)
+            ready = [i for i, item in enumerate(items) if not isinstance(item, Exception)]
+            contexts = await self.run(self.wd.search_chunks_batch, [items[i][0] for i in ready], [items[i][2] for i in ready], chunks,
+                                      top_k=top_k, threshold=threshold, retriever=retriever)
+
+        slots = asyncio.Semaphore(max_concurrent_answers)
+
+        async def answer(query, context):
+            async with slots:
+                return await self.answer(query, context, spelling=spelling, generative_model=generative_model, token_budget=token_budget,
+                                         fallback_model=fallback_model, latency_slo=latency_slo, hedge=hedge)
+
+        answers = await asyncio.gather(*[answer(items[i][0], context) for i, context in zip(ready, contexts)], return_exceptions=True)
+        results = list(items)
+        for i, result in zip(ready, answers):
+            results[i] = result
+        return results
+
+
+    async def aclose(self):
+        await self.fetcher.aclose()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.cache_executor.shutdown(wait=False, cancel_futures=True)
+        self.wd.close()
+
+
+async def prepend(first, stream):
+    '''
+        Yields the first chunk of a stream, already read by the scheduler, and then the rest of the stream.
+    '''
+
+    if first is not None:
+        yield first
+    async for chunk in stream:
+        yield chunk
@@ -1,14 +1,36 @@
 ### version = 2.4
 
+import os
 import re
+import json
 import time
+import itertools
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import urllib.parse as urlparse
 import requests
-from qdrant_client import QdrantClient, models
-from fastembed import TextEmbedding, SparseTextEmbedding
 from groq import Groq
-from markdownify import markdownify as md
-from spellchecker import SpellChecker
+from wikifetch import WikiFetcher
+from chunker import TokenChunker
+from embedding_service import EmbeddingService
+from html_extract import WikiTextExtractor, section_headings, section_at
+from context_packer import ContextPacker, model_token_budget
+from spelling import SpellingCorrector
+from keywords import KeywordExtractor
+import progressive
+from singleflight import SingleFlight
+from vector_cache import embed_cached
+from retrievers import QdrantRetriever, NumpyRetriever, QdrantIndex, qdrant_client
+from metrics import metrics
+from generation import GenerationScheduler
+
+
+SYSTEM_PROMPT = '''
+You are an assistant that answers questions strictly based on the CONTEXTS below.
+Do not use external knowledge or guess. If the answer is missing, say: "I don't know the answer."
+Keep responses concise (1-2 sentences unless more detail is needed).
+'''
 
 
 class Widiscover:
@@ -18,76 +40,154 @@ class Widiscover:
         sparse_model_name='prithivida/Splade_PP_en_v1',
         generative_model='llama-3.3-70b-versatile',
         groq_api_key=None,
+        fetch_workers=4,
+        requests_per_second=5.0,
+        page_cache=None,
+        vector_cache=None,
+        answer_cache=None,
+        embed_batch_size=32,
+        embed_threads=None,
+        embedding_service=None,
+        wikipedia_url='https://{language}.wikipedia.org',
+        groq_base_url=None,
+        index_path=None,
+        index_collection='wikipedia',
+        qdrant_location=':memory:',
+        qdrant_on_disk=False,
+        qdrant_quantization=None,
+        collection_prefix='widiscover',
+        max_concurrent_completions=4,
+        completion_retries=3,
+        searched_pages=1000,
     ):
         self.headers = {
                 "User-Agent": "Widiscover 2.4"
             }
-        self.ENGLISH = {
-            "i", "me", "my", "myself", "we", "our", "ours", "ourselves", "you", "you're", "you've", "you'll", "you'd",
-            "your", "yours", "yourself", "yourselves", "he", "him", "his", "himself", "she", "she's", "her", "hers", "herself",
-            "it", "it's", "its", "itself", "they", "them", "their", "theirs", "themselves", "what", "which", "who", "whom", 
-            "this", "that", "that'll", "these", "those", "am", "is", "are", "was", "were", "be", "been", "being", "have", 
-            "has", "had", "having", "do", "does", "did", "doing", "a", "an", "the", "and", "but", "if", "or", "because", "as", 
-            "until", "while", "of", "at", "by", "for", "with", "about", "against", "between", "into", "through", "during", 
-            "before", "after", "above", "below", "to", "from", "up", "down", "in", "out", "on", "off", "over", "under", "again", 
-            "further", "then", "once", "here", "there", "when", "where", "why", "how", "all", "any", "both", "each", "few", 
-            "more", "most", "other", "some", "such", "no", "nor", "not", "only", "own", "same", "so", "than", "too", "very", "s",
-            "t", "can", "will", "just", "don", "don't", "should", "should've", "now", "d", "ll", "m", "o", "re", "ve", "y", 
-            "ain", "aren", "aren't", "couldn", "couldn't", "didn", "didn't", "doesn", "doesn't", "hadn", "hadn't", "hasn", 
-            "hasn't", "haven", "haven't", "isn", "isn't", "ma", "mightn", "mightn't", "mustn", "mustn't", "needn", "needn't", 
-            "shan", "shan't", "shouldn", "shouldn't", "wasn", "wasn't", "weren", "weren't", "won", "won't", "wouldn", "wouldn't"
-        }
+        self.fetcher = WikiFetcher(headers=self.headers, requests_per_second=requests_per_second, max_workers=fetch_workers)
+        self.extractor = WikiTextExtractor()
+        # bytes downloaded and avoided by `ingest_sections`
+        self.section_stats = progressive.ProgressiveStats()
+        self.spelling = SpellingCorrector()
+        # the rarest words of a query are its best search keywords, by the frequencies of the spelling dictionary
+        self.keywords = KeywordExtractor(frequency=self.spelling.frequency, total=self.spelling.total)
+        # the page keys of the recent searches, the most frequent ones are warmed by the cache warmer (see warmer.py)
+        self.searched_pages = collections.deque(maxlen=searched_pages)
+        # concurrent queries share the searches, page downloads and embeddings in flight
+        self.inflight = SingleFlight()
+        self.page_cache = page_cache
+        self.vector_cache = vector_cache
+        self.answer_cache = answer_cache
         self.database_client = None
-        self.collection_name = 'Widiscover 2.4'
         self.DENSE_MODEL_DIMENSION = 384
         self.vectorizer = None
         self.sparse_vectorizer = None
-        if groq_api_key:
-            self.groq = Groq(
-                    api_key=groq_api_key
-                )
-        else:
-            self.groq = Groq()
-        if not self.groq:
-            raise Exception('Error: Groq client couldn\'t be loaded')
-        self.database_client = QdrantClient(":memory:")
+        # the Groq client is created lazily so the engine can be warmed up before
+        # the user has provided an API key, and rebuilt when the key changes
+        self.groq_api_key = groq_api_key
+        self.groq_base_url = groq_base_url
+        self._groq = None
+        self._groq_key = None
+        self._groq_lock = threading.Lock()
+        # caps, paces and retries the completions of both APIs, with the fallback model and hedging of `answer`
+        self.scheduler = GenerationScheduler(max_concurrent=max_concurrent_completions, retries=completion_retries)
+        # ':memory:', a directory or the URL of a Qdrant server
+        self.database_client = qdrant_client(qdrant_location)
         if not self.database_client:
             raise Exception('Error: QDrant client couldn\'t be loaded')
-        time.sleep(0.02)
-        if not self.database_client.collection_exists(collection_name=self.collection_name):
-            self.database_client.create_collection(
-                    collection_name= self.collection_name,
-                    vectors_config={'dense': models.VectorParams(
-                        size=self.DENSE_MODEL_DIMENSION,
-                        distance=models.Distance.COSINE
-                    )},
-                    sparse_vectors_config={
-                        'sparse': models.SparseVectorParams()
-                    }
-                )
+        self.retrievers = {
+            'qdrant': QdrantRetriever(self.database_client, dense_dimension=self.DENSE_MODEL_DIMENSION, collection_prefix=collection_prefix,
+                                      on_disk=qdrant_on_disk, quantization=qdrant_quantization),
+            'numpy': NumpyRetriever(),
+        }
+        # the offline index of a Wikipedia dump (see dump_index.py), queried instead of searching Wikipedia
+        self.index = None
+        if index_path:
+            self.index = QdrantIndex(index_path, index_collection, dense_dimension=self.DENSE_MODEL_DIMENSION)
+            if not self.index.exists():
+                raise Exception('Error: there is no collection \'{}\' in the index \'{}\''.format(index_collection, index_path))
         self.dense_model_name = dense_model_name
         self.sparse_model_name = sparse_model_name
-        self.vectorizer = TextEmbedding(model_name=dense_model_name)
-        self.sparse_vectorizer = SparseTextEmbedding(model_name=sparse_model_name)
-        if not self.vectorizer:
-            raise Exception('Error: FastEmbed vectorizer couldn\'t be loaded')
+        # the workers of a multi-worker server share the models of an embedding server instead (see embedding_server.py)
+        self.embedder = embedding_service or EmbeddingService(dense_model_name, sparse_model_name, batch_size=embed_batch_size, threads=embed_threads)
+        self.vectorizer = self.embedder.vectorizer
+        self.sparse_vectorizer = self.embedder.sparse_vectorizer
+        self._token_chunker = None
+        self._context_packer = None
         self.generative_model = generative_model
         self.language_code = 'en'
+        # '{language}' is replaced by the language code, e.g. a local mirror or stub server can be used instead of Wikipedia
+        self.wikipedia_url = wikipedia_url
+        self.ready = False
+
+
+    @property
+    def groq(self):
+        '''
+            Returns a Groq client for the current API key.
+            The key given to the constructor takes precedence over the GROQ_API_KEY environment variable.
+            The client doesn't retry, the calls are retried by the scheduler.
+        '''
+
+        api_key = self.groq_api_key or os.getenv('GROQ_API_KEY')
+        with self._groq_lock:
+            if self._groq is None or api_key != self._groq_key:
+                self._groq = Groq(api_key=api_key, base_url=self.groq_base_url, max_retries=0) if api_key \
+                    else Groq(base_url=self.groq_base_url, max_retries=0)
+                self._groq_key = api_key
+                if not self._groq:
+                    raise Exception('Error: Groq client couldn\'t be loaded')
+            return self._groq
+
+
+    def warm_up(self):
+        '''
+            Runs the dense and the sparse model once so that the ONNX sessions are fully initialized
+            before the first query arrives.
+        '''
 
+        self.embedder.embed(['Widiscover'])
+        self.embedder.embed_query('Widiscover')
+        self.ready = True
 
-    def extract_keywords(self, text: str):
+
+    @property
+    def token_chunker(self):
+        if self._token_chunker is None:
+            self._token_chunker = TokenChunker(self.embedder.tokenizer())
+        return self._token_chunker
+
+
+    @property
+    def context_packer(self):
+        if self._context_packer is None:
+            self._context_packer = ContextPacker(self.token_chunker)
+        return self._context_packer
+
+
+    def close(self):
+        self.embedder.close()
+        self.fetcher.close()
+        self.scheduler.close()
+        if self.page_cache:
+            self.page_cache.close()
+        if self.vector_cache:
+            self.vector_cache.close()
+        if self.index:
+            self.index.close()
+        self.database_client.close()
+
+
+    def extract_keywords(self, text: str, max_keywords=0):
         '''
             Extracts a list of words from a given string excluding stopwords.
                 Args:
                     text (str): The input string from which to extract keywords.
+                    max_keywords (int): The maximum number of keywords, the rarest words of the text are kept. 0 keeps them all.
                 Returns:
                     list: A list of keywords extracted from the input string.
         '''
 
-        keywords = text.lower().replace(',', ' ').replace('.',' ').replace(':', ' ').replace('?', ' ').split(' ')
-        stripped_keywords = [keyword.strip() for keyword in keywords if keyword]
-
-        return [keyword for keyword in stripped_keywords if keyword not in self.ENGLISH and keyword]
+        return self.keywords.extract(text, language=self.language_code, max_keywords=max_keywords)
 
 
     def extract_text(self, keys: list[str]):
@@ -96,18 +196,77 @@ class Widiscover:
             Args:
                 keys: List of Wikipedia page titles/keys to fetch.
             Yields:
-                Markdown-formatted content for each successfully fetched page.
+                Markdown-formatted content for each page, in the order of `keys`
+                (an empty string for pages that couldn't be fetched).
         '''
 
-        for key in keys:
-            response = requests.get(
-                "https://en.wikipedia.org/api/rest_v1/page/html/{}".format(key),
-                headers=self.headers)
-            if response.ok:
-                yield md(response.text, autolinks=False, )
-            time.sleep(0.5)
+        yield from self.fetcher.map(self.fetch_page, keys)
+
+
+    def fetch_page(self, key: str):
+        '''
+            Fetches a single Wikipedia page and converts it to markdown.
+            Args:
+                key: The Wikipedia page title/key.
+            Returns:
+                The markdown content of the page, or an empty string if the page couldn't be fetched.
+        '''
+
+        cached = self.cached_page(key)
+        if cached and cached['fresh']:
+            metrics.count('widiscover_pages_fetched_total', result='cached')
+            return cached['markdown']
+        return self.inflight.do(('page', self.language_code, key), self.download_page, key, cached)
+
+
+    def download_page(self, key: str, cached):
+        try:
+            with metrics.span('download'):
+                response = self.fetcher.get(self.page_url(key), headers=revalidation_headers(cached))
+        except requests.RequestException:
+            metrics.count('widiscover_pages_fetched_total', result='failed')
+            return cached['markdown'] if cached else ''
+        metrics.count('widiscover_downloaded_bytes_total', len(response.content))
+        return self.convert_page(key, cached, response.status_code, response.text, response.headers.get('ETag'))
 
 
+    def page_url(self, key: str):
+        return self.base_url() + "/api/rest_v1/page/html/" + urlparse.quote(key, safe='')
+
+
+    def cached_page(self, key: str):
+        return self.page_cache.get_page(self.language_code, key) if self.page_cache else None
+
+
+    @metrics.timed('extract')
+    def convert_page(self, key: str, cached, status_code: int, html: str, etag: str = None):
+        '''
+            Turns the response to a page request into markdown, updating the page cache.
+            Args:
+                key: The Wikipedia page title/key.
+                cached: The entry of the page cache the request was revalidating, if any.
+                status_code: The HTTP status of the response.
+                html: The body of the response.
+                etag: The ETag header of the response.
+            Returns:
+                The markdown content of the page, or an empty string if the page couldn't be fetched.
+        '''
+
+        if status_code == 304 and cached:
+            metrics.count('widiscover_pages_fetched_total', result='revalidated')
+            self.page_cache.revalidated(self.language_code, key)
+            return cached['markdown']
+        if not 200 <= status_code < 300:
+            metrics.count('widiscover_pages_fetched_total', result='failed')
+            return cached['markdown'] if cached else ''
+        metrics.count('widiscover_pages_fetched_total', result='downloaded')
+        markdown = self.extractor.extract(html)
+        if self.page_cache:
+            self.page_cache.put_page(self.language_code, key, markdown, etag=etag)
+        return markdown
+
+
+    @metrics.timed('wikisearch')
     def wikisearch(self, search_keywords, result_number_per_page = 3):
         '''
             Searches over the wikipedia API for topics related to the keywords and returns the results in URL form.
@@ -119,19 +278,57 @@ class Widiscover:
                     list: A list of URLs of the search results.
         '''
 
+        params, cache_key = self.search_params(search_keywords, result_number_per_page)
+        urls = self.cached_search(cache_key)
+        if urls is not None:
+            return urls
+        return self.inflight.do(('search', self.language_code, cache_key), self.request_search, params, cache_key, result_number_per_page)
+
+
+    def request_search(self, params: dict, cache_key: str, result_number_per_page = 3):
+        response = self.fetcher.get(self.search_url(), params=params)
+        metrics.count('widiscover_downloaded_bytes_total', len(response.content))
+        if response.status_code == 200:
+            search_results = response.json()
+        else:
+            return
+        return self.parse_search(search_results, cache_key, result_number_per_page)
+
+
+    def search_url(self):
+        return self.base_url() + "/w/rest.php/v1/search/page"
+
+
+    def base_url(self):
+        return self.wikipedia_url.format(language=self.language_code).rstrip('/')
+
+
+    def search_params(self, search_keywords, result_number_per_page = 3):
+        '''
+            Returns the query parameters of a search request and the key of its result in the search cache.
+        '''
+
         search_keywords = [search_keywords] if type(search_keywords) == str else search_keywords
         params = {
             'q': '+'.join(search_keywords),
             'limit': result_number_per_page + 1
         }
+        return params, '{}|{}'.format(params['q'], result_number_per_page)
+
+
+    def cached_search(self, cache_key: str):
+        urls = self.page_cache.get_search(self.language_code, cache_key) if self.page_cache else None
+        for key in urls or []:
+            self.spelling.add_words(key)
+        self.searched_pages.extend(urls or [])
+        return urls
+
+
+    def parse_search(self, search_results: dict, cache_key: str, result_number_per_page = 3):
+        '''
+            Extracts the page keys from the response of the search API, skipping disambiguation pages, and caches them.
+        '''
 
-        request = "https://{}.wikipedia.org/w/rest.php/v1/search/page".format(self.language_code)
-        
-        response = requests.get(request, headers=self.headers, params=params)
-        if response.status_code == 200:
-            search_results = response.json()
-        else:
-            return
         urls = []
         cnt = 0
         for result in search_results['pages']:
@@ -140,133 +337,762 @@ class Widiscover:
             urls.append(
                 result['key']
             )
+            # the words of the titles are proper nouns of the topic, they must not be corrected
+            self.spelling.add_words(result['key'])
             cnt+=1
             if cnt == result_number_per_page:
                 break
+        self.searched_pages.extend(urls)
+        if self.page_cache:
+            self.page_cache.put_search(self.language_code, cache_key, urls)
         return urls
     
 
-    def process_docs(self, docs: list, sources: list, length=1800, overlap=180):
-        
+    @metrics.timed('chunk')
+    def process_docs(self, docs: list, sources: list, length=1800, overlap=180, unit='characters'):
+        '''
+            Splits the documents into overlapping chunks.
+                Args:
+                    docs (list): The markdown documents.
+                    sources (list): The page key of every document.
+                    length (int): The maximum length of a chunk.
+                    overlap (int): The length shared by consecutive chunks.
+                    unit (str): 'characters' for fixed character windows, or 'tokens' to measure `length` and `overlap`
+                        in tokens of the dense model and cut chunks at headings, paragraphs or sentences.
+                Returns:
+                    list: The chunks with their 'metadata' (text, source and the section the chunk starts in).
+        '''
+
         chunks = []
         for text, source in zip(docs, sources):
-            offset = 0
-            text_len = len(text)
-            while True:
-                chunk = text[offset:offset+length]
-                chunks.append({
-                    'metadata':{
-                        'text':chunk,
-                        'source':source
-                        },
-                    'vectors':{
-                        'dense': models.Document(text=chunk, model=self.dense_model_name),
-                        'sparse': models.Document(text=chunk, model=self.sparse_model_name)
-                    }
-                })
-                if offset + length >= text_len:
-                    break
-                offset += length - overlap
+            chunks += chunk_document(text, source, length=length, overlap=overlap, unit=unit,
+                                     token_chunker=self.token_chunker if unit == 'tokens' else None)
+        metrics.count('widiscover_chunks_total', len(chunks), kind='created')
+        return chunks
+
+
+    @metrics.timed('ingest')
+    def ingest(self, keys: list[str], length=1800, overlap=180, unit='characters', batch_size=None, max_pending_pages=4):
+        '''
+            Downloads, chunks and embeds pages as a pipeline: every page is chunked as soon as it arrives and the chunks
+            are embedded in batches while the next pages are still downloading.
+            At most `max_pending_pages` pages are downloading or waiting to be chunked at any time, so a slow
+            embedder holds back the downloads instead of buffering markdown without bound.
+                Args:
+                    keys (list): The Wikipedia page titles/keys.
+                    length (int): The chunk length.
+                    overlap (int): The overlap between consecutive chunks.
+                    unit (str): The unit of `length` and `overlap`, see `process_docs`.
+                    batch_size (int): The number of chunks embedded at once, the batch size of the embedding service by default.
+                    max_pending_pages (int): The bound of the download window.
+                Returns:
+                    list: The chunks of `process_docs` with their 'vectors' already computed.
+        '''
+
+        batch_size = batch_size or self.embedder.batch_size
+        remaining = iter(keys or [])
+        pending = {}
+
+        def submit_next():
+            key = next(remaining, None)
+            if key is not None:
+                pending[self.fetcher.executor.submit(self.fetch_page, key)] = key
+
+        for _ in range(max_pending_pages):
+            submit_next()
+        chunks = []
+        batch = []
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    submit_next()
+                    batch += self.process_docs([future.result()], [key], length=length, overlap=overlap, unit=unit)
+                while len(batch) >= batch_size:
+                    chunks += self.embed_chunks(batch[:batch_size])
+                    batch = batch[batch_size:]
+            if batch:
+                chunks += self.embed_chunks(batch)
+        finally:
+            for future in pending:
+                future.cancel()
         return chunks
 
 
-    def search_chunks(self, query, chunks, top_k=4, threshold=0.3):
+    @metrics.timed('ingest')
+    def ingest_sections(self, query: str, keys: list[str], length=1800, overlap=180, unit='characters', max_sections=4, max_bytes=262144):
+        '''
+            Progressive alternative to `ingest` downloading only the parts of the pages relevant to the query:
+            the leads and outlines of the pages are fetched first, the sections are ranked against the query with
+            the dense model, and only the best `max_sections` sections are downloaded, until `max_bytes` bytes
+            were downloaded for the query.
+            Pages fresh in the page cache are used whole, and pages without an outline are downloaded whole.
+                Args:
+                    query (str): The query the sections are ranked against.
+                    keys (list): The Wikipedia page titles/keys.
+                    length (int): The chunk length.
+                    overlap (int): The overlap between consecutive chunks.
+                    unit (str): The unit of `length` and `overlap`, see `process_docs`.
+                    max_sections (int): The number of sections downloaded.
+                    max_bytes (int): The bytes downloaded for the query after which no section download is started.
+                Returns:
+                    list: The embedded chunks, as returned by `ingest`.
+        '''
+
+        docs, sources, outlined = self.cached_pages(keys)
+        outlines, downloaded = self.fetch_outlines(outlined)
+        # e.g. a mirror without the action API, or a missing page
+        whole = [key for key in outlined if key not in outlines]
+        docs += list(self.fetcher.map(self.fetch_page, whole))
+        sources += whole
+        ranked = self.rank_sections(query, outlines, max_sections)
+        fetched, section_bytes, capped = self.fetch_sections(ranked, max_bytes - downloaded)
+        self.record_progressive(outlines, whole, fetched, downloaded + section_bytes, capped)
+        partial_docs, partial_sources = self.progressive_docs(outlines, fetched)
+        chunks = self.process_docs(docs + partial_docs, sources + partial_sources, length=length, overlap=overlap, unit=unit)
+        return self.embed_chunks(chunks) if chunks else []
+
+
+    def cached_pages(self, keys: list[str]):
+        '''
+            Returns:
+                tuple: The markdown and the keys of the pages fresh in the page cache, and the keys of the others.
+        '''
+
+        docs = []
+        sources = []
+        missing = []
+        for key in keys or []:
+            cached = self.cached_page(key)
+            if cached and cached['fresh']:
+                metrics.count('widiscover_pages_fetched_total', result='cached')
+                docs.append(cached['markdown'])
+                sources.append(key)
+            else:
+                missing.append(key)
+        return docs, sources, missing
+
+
+    def fetch_outlines(self, keys: list[str]):
+        '''
+            Fetches the outlines of pages: the leads and lengths of all the pages in one request, then the sections of every page.
+                Returns:
+                    tuple: A dictionary of page key -> outline ({'title', 'lead', 'length', 'sections'}, see `progressive.parse_sections`)
+                        without the pages that couldn't be outlined, and the number of bytes downloaded.
+        '''
+
+        outlines = {}
+        missing = []
+        for key in keys:
+            outline = self.cached_outline(key)
+            if outline:
+                outlines[key] = outline
+            else:
+                missing.append(key)
+        if not missing:
+            return outlines, 0
+        try:
+            with metrics.span('download'):
+                response = self.fetcher.get(self.api_url(), params=progressive.lead_params(missing))
+        except requests.RequestException:
+            return outlines, 0
+        downloaded = len(response.content)
+        metrics.count('widiscover_downloaded_bytes_total', downloaded)
+        if response.status_code != 200:
+            return outlines, downloaded
+        leads = progressive.parse_leads(missing, progressive.loads(response.content) or {})
+        for key, (outline, size) in zip(leads, self.fetcher.map(lambda key: self.fetch_outline(key, leads[key]), leads)):
+            downloaded += size
+            if outline:
+                outlines[key] = outline
+        return outlines, downloaded
+
+
+    def fetch_outline(self, key: str, lead: dict):
+        try:
+            with metrics.span('download'):
+                response = self.fetcher.get(self.api_url(), params=progressive.sections_params(key))
+        except requests.RequestException:
+            return None, 0
+        metrics.count('widiscover_downloaded_bytes_total', len(response.content))
+        return self.convert_outline(key, lead, response.status_code, response.content), len(response.content)
+
+
+    def api_url(self):
+        return self.base_url() + '/w/api.php'
+
+
+    def cached_outline(self, key: str):
+        cached = self.page_cache.get_page(self.language_code, key + '#outline') if self.page_cache else None
+        return json.loads(cached['markdown']) if cached and cached['fresh'] else None
+
+
+    def convert_outline(self, key: str, lead: dict, status_code: int, body: bytes):
+        '''
+            Builds the outline of a page from its lead and the response to its sections request, updating the page cache
+            (the outline and the sections are stored next to the pages, under '{key}#outline' and '{key}#{index}').
+        '''
+
+        if status_code != 200:
+            return None
+        response = progressive.loads(body)
+        if not response or 'parse' not in response:
+            return None
+        outline = {**lead, 'sections': progressive.parse_sections(lead['title'], response, lead['length'])}
+        if self.page_cache:
+            self.page_cache.put_page(self.language_code, key + '#outline', json.dumps(outline))
+        return outline
+
+
+    @metrics.timed('rank_sections')
+    def rank_sections(self, query: str, outlines: dict, max_sections: int):
+        '''
+            Ranks the sections of the outlined pages against the query with the dense model.
+                Returns:
+                    list: (score, page key, section) of the best `max_sections` sections, best first.
+        '''
+
+        candidates = [(key, section) for key, outline in outlines.items() for section in outline['sections'] if not section['skipped']]
+        if not candidates or max_sections < 1:
+            return []
+        leads = [key for key, outline in outlines.items() if outline['lead']]
+        vectors = self.embedder.submit('dense_query', [query] + [outlines[key]['lead'] for key in leads]
+                                       + [section['label'] for _, section in candidates]).result()
+        lead_vectors = dict(zip(leads, vectors[1:1 + len(leads)]))
+        label_vectors = [(key, section, vector) for (key, section), vector in zip(candidates, vectors[1 + len(leads):])]
+        return progressive.rank_sections(vectors[0], lead_vectors, label_vectors, max_sections)
+
+
+    def fetch_sections(self, ranked: list, max_bytes: int):
+        '''
+            Downloads the ranked sections best first, `fetch_workers` at a time, starting no download once `max_bytes` bytes were downloaded.
+                Returns:
+                    tuple: The (page key, section, markdown) of the sections fetched, the number of bytes downloaded,
+                        and the number of sections left out by the byte cap.
+        '''
+
+        remaining = list(ranked)
+        pending = {}
+        fetched = []
+        downloaded = 0
+
+        def submit_next():
+            if remaining and downloaded < max_bytes:
+                _, key, section = remaining.pop(0)
+                pending[self.fetcher.executor.submit(self.fetch_section, key, section)] = (key, section)
+
+        for _ in range(self.fetcher.max_workers):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, section = pending.pop(future)
+                markdown, size = future.result()
+                downloaded += size
+                fetched.append((key, section, markdown))
+                submit_next()
+        return fetched, downloaded, len(remaining)
+
+
+    def fetch_section(self, key: str, section: dict):
+        '''
+            Fetches a section of a page and converts it to markdown.
+                Returns:
+                    tuple: The markdown of the section (an empty string if it couldn't be fetched) and the number of bytes downloaded.
+        '''
+
+        cache_key = '{}#{}'.format(key, section['index'])
+        cached = self.page_cache.get_page(self.language_code, cache_key) if self.page_cache else None
+        if cached and cached['fresh']:
+            self.section_stats.add(sections_cached=1)
+            return cached['markdown'], 0
+        return self.inflight.do(('section', self.language_code, cache_key), self.download_section, key, section)
+
+
+    def download_section(self, key: str, section: dict):
+        try:
+            with metrics.span('download'):
+                response = self.fetcher.get(self.api_url(), params=progressive.section_params(key, section['index']))
+        except requests.RequestException:
+            return '', 0
+        metrics.count('widiscover_downloaded_bytes_total', len(response.content))
+        return self.convert_section(key, section, response.status_code, response.content), len(response.content)
+
+
+    @metrics.timed('extract')
+    def convert_section(self, key: str, section: dict, status_code: int, body: bytes):
+        '''
+            Turns the response to a section request into markdown, updating the page cache.
+        '''
+
+        response = progressive.loads(body) if status_code == 200 else None
+        if response is None:
+            return ''
+        html = (response.get('parse') or {}).get('text') or ''
+        markdown = self.extractor.extract(html)
+        self.section_stats.add(sections=1, section_bytes=len(body), section_wikitext_bytes=section['size'])
+        if self.page_cache:
+            self.page_cache.put_page(self.language_code, '{}#{}'.format(key, section['index']), markdown)
+        return markdown
+
+
+    def progressive_docs(self, outlines: dict, fetched: list):
+        '''
+            Returns:
+                tuple: The documents of the outlined pages (their lead and fetched sections) and their page keys.
+        '''
+
+        sections = {key: [] for key in outlines}
+        for key, section, markdown in fetched:
+            sections[key].append((section, markdown))
+        docs = []
+        sources = []
+        for key, outline in outlines.items():
+            doc = progressive.assemble(outline['lead'], sections[key])
+            if doc:
+                docs.append(doc)
+                sources.append(key)
+        return docs, sources
+
+
+    def record_progressive(self, outlines: dict, whole: list, fetched: list, downloaded: int, capped: int):
+        '''
+            Adds a query to the progressive fetching stats. The bytes avoided are the estimated size of the outlined pages,
+            had they been downloaded whole, minus the bytes actually downloaded for them.
+        '''
+
+        estimated = sum(outline['length'] for outline in outlines.values()) * self.section_stats.ratio()
+        avoided = max(0, round(estimated) - downloaded) if outlines else 0
+        self.section_stats.add(queries=1, pages=len(outlines), whole_pages=len(whole), capped=capped,
+                             bytes_downloaded=downloaded, bytes_avoided=avoided)
+        metrics.count('widiscover_progressive_bytes_total', downloaded, kind='downloaded')
+        metrics.count('widiscover_progressive_bytes_total', avoided, kind='avoided')
+
+
+    def embed_chunks(self, chunks: list[dict]):
+        '''
+            Embeds the chunks with the dense and the sparse model already loaded by the engine.
+                Args:
+                    chunks (list): The chunks returned by `process_docs`.
+                Returns:
+                    list: The chunks with a 'vectors' entry holding the dense and sparse vectors.
+        '''
+
+        texts = [chunk['metadata']['text'] for chunk in chunks]
+        vectors = self.embed_texts(texts)
+        for chunk, (dense, indices, values) in zip(chunks, vectors):
+            chunk['vectors'] = {
+                'dense': dense,
+                'sparse_indices': indices,
+                'sparse_values': values,
+            }
+        return chunks
+
+
+    @metrics.timed('embed')
+    def embed_texts(self, texts: list[str]):
+        '''
+            Embeds passages with the dense and the sparse model, reusing the vectors of the vector cache when possible.
+                Returns:
+                    list: (dense vector, sparse indices, sparse values) tuples in the order of `texts`.
+        '''
+
+        return embed_cached(self.embedder, texts, self.vector_cache, self.inflight, self.dense_model_name, self.sparse_model_name)
+
+
+    @metrics.timed('embed_query')
+    def embed_query(self, query: str):
+        '''
+            Embeds a query with the dense and the sparse model.
+                Returns:
+                    tuple: The dense vector, the sparse indices and the sparse values.
+        '''
+
+        return self.embedder.embed_query(query)
+
+
+    @metrics.timed('embed_query')
+    def embed_queries(self, queries: list[str]):
+        '''
+            Embeds several queries with the dense and the sparse model in a single batch.
+                Returns:
+                    list: (dense vector, sparse indices, sparse values) tuples in the order of `queries`.
+        '''
+
+        return self.embedder.submit('query', queries).result()
+
+
+    def embed_dense_query(self, query: str):
+        '''
+            Embeds a query with the dense model only.
+                Returns:
+                    numpy.ndarray: The dense vector.
+        '''
+
+        return self.embedder.embed_dense_query(query)
+
+
+    @metrics.timed('retrieve')
+    def search_chunks(self, query, chunks, top_k=4, threshold=0.3, retriever='numpy'):
+        '''
+            Retrieves the chunks most relevant to the query.
+                Args:
+                    query (str): The query.
+                    chunks (list): The chunks of `process_docs` or `ingest`.
+                    top_k (int): The maximum number of chunks returned.
+                    threshold (float): The minimum sparse score of a returned chunk.
+                    retriever (str): The retrieval backend, 'qdrant' or 'numpy'.
+                Returns:
+                    list: The metadata of the most relevant chunks.
+        '''
+
+        if not chunks:
+            return []
         if chunks.__len__() < top_k:
             top_k = chunks.__len__()
-            
-        self.database_client.upload_collection(
-            collection_name=self.collection_name,
-            vectors=[chunk['vectors'] for chunk in chunks],
-            payload=[chunk['metadata'] for chunk in chunks],
-            parallel=4)
-        search_results = self.database_client.query_points(
-            collection_name=self.collection_name,
-            prefetch=[
-                models.Prefetch(
-                    query=models.Document(text=query, model=self.dense_model_name),
-                    using='dense',
-                    limit=32
-                ),
-            ],
-            query=models.Document(text=query, model=self.sparse_model_name),
-            using='sparse',
-            with_payload=True,
-            limit=top_k
-            )
-            
-        return [search_results.points[k].payload for k in range(top_k) if search_results.points[k].score >= threshold]
-        
 
-    def clear_data(self):
-        self.database_client.delete_collection(self.collection_name)
+        # chunks coming from `ingest` are already embedded
+        self.embed_chunks([chunk for chunk in chunks if 'vectors' not in chunk])
+        return self.retrievers[retriever].search(chunks, self.embed_query(query), top_k=top_k, threshold=threshold)
+
+
+    @metrics.timed('retrieve')
+    def search_chunks_batch(self, queries: list[str], keys: list[list], chunks, top_k=4, threshold=0.3, retriever='numpy'):
+        '''
+            Retrieves the chunks most relevant to several queries from a shared chunk pool with a single batched search,
+            every query only seeing the chunks of its own pages.
+                Args:
+                    queries (list): The queries.
+                    keys (list): The page keys of every query.
+                    chunks (list): The chunks of the pages of all the queries.
+                    top_k (int): The maximum number of chunks returned per query.
+                    threshold (float): The minimum sparse score of a returned chunk.
+                    retriever (str): The retrieval backend, 'qdrant' or 'numpy'.
+                Returns:
+                    list: The metadata of the most relevant chunks of every query.
+        '''
+
+        if not queries:
+            return []
+        self.embed_chunks([chunk for chunk in chunks if 'vectors' not in chunk])
+        pages = {}
+        for i, chunk in enumerate(chunks):
+            pages.setdefault(chunk['metadata']['source'], []).append(i)
+        subsets = [[i for key in dict.fromkeys(page_keys) for i in pages.get(key, [])] for page_keys in keys]
+        return self.retrievers[retriever].search_many(chunks, self.embed_queries(queries), subsets, top_k=top_k, threshold=threshold)
+
+
+    @metrics.timed('retrieve')
+    def search_index(self, queries: list[str], top_k=4, threshold=0.3):
+        '''
+            Retrieves the chunks most relevant to every query from the offline index instead of searching Wikipedia.
+                Args:
+                    queries (list): The queries.
+                    top_k (int): The maximum number of chunks returned per query.
+                    threshold (float): The minimum sparse score of a returned chunk.
+                Returns:
+                    list: The metadata of the most relevant chunks of every query.
+        '''
+
+        if not queries:
+            return []
+        contexts = self.index.search_many(self.embed_queries(queries), top_k=top_k, threshold=threshold)
+        for context in contexts:
+            for item in context:
+                # like the titles of the search results, the titles of the pages retrieved must not be corrected
+                self.spelling.add_words(item['source'])
+        return contexts
+
+
+    def batch_items(self, queries: list, max_keywords=0):
+        '''
+            Returns the query, the topic and the search keywords of every query of a batch, or the exception raised
+            while extracting its keywords.
+                Args:
+                    queries (list): The queries, as strings or as dictionaries with a 'query' and an optional 'topic'.
+                    max_keywords (int): See `extract_keywords`.
+        '''
+
+        items = []
+        for item in queries:
+            try:
+                query, topic = (item, None) if isinstance(item, str) else (item.get('query'), item.get('topic'))
+                if not query:
+                    raise ValueError('Error: empty query.')
+                items.append((query, topic, self.extract_keywords(query, max_keywords) if not topic else topic.split()))
+            except Exception as e:
+                items.append(e)
+        return items
+
+
+    @metrics.timed('spelling')
+    def check_spelling(self, query: str, spelling=1):
+        return self.spelling.correct(query, int(spelling))
+
+
+    def messages(self, query: str, context: list[str]):
+        '''
+            Builds the chat messages sent to the generative model: the system prompt with the contexts and the user query.
+        '''
+
+        assert type(context) == list
+        system_prompt = SYSTEM_PROMPT + ''.join(['\n\n<CONTEXT>\n' + item + '\n</CONTEXT>' for item in context])
+        return [
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": query
+                }
+        ]
+
+
+    def source_urls(self, context: list[dict]):
+        sources = {item['source'] for item in context}
+        return [self.base_url() + "/wiki/" + source for source in sources]
+
+
+    @metrics.timed('pack')
+    def pack_context(self, context: list[dict], generative_model=None, token_budget=0):
+        '''
+            Merges, deduplicates and trims the retrieved chunks to the context token budget of the generative model
+            (see `ContextPacker.pack`).
+        '''
+
+        return self.context_packer.pack(context, model_token_budget(generative_model or self.generative_model, token_budget))
 
 
-    def answer(self, query: str, context: list[dict], spelling=0):
+    @metrics.timed('generate')
+    def answer(self, query: str, context: list[dict], spelling=0, generative_model=None, token_budget=0,
+               fallback_model=None, latency_slo=0.0, hedge=False):
         '''
         Generates an answer based on the retrieved context.
 
             Params:
                 * **query (str)**: The query string to search for in the database.
                 * **context (list[str])**: A list of dictionaries containing `text` and `source` fields.
+                * **generative_model (str)**: The Groq model to use instead of the engine's default.
+                * **token_budget (int)**: The maximum number of context tokens, 0 for the default of the model.
+                * **fallback_model (str)**: The faster model answering when the generative model fails or exceeds the SLO.
+                * **latency_slo (float)**: Seconds to the answer (to the first token when streamed), 0 to disable.
+                * **hedge (bool)**: Also ask the fallback model when the answer takes longer than the SLO (see `GenerationScheduler`).
 
             Returns:
-                A dictionary containing the generated answer, its sources and usage statistics.
-        '''
-
-        def check_spelling(query):
-            spell = SpellChecker(distance=spelling)
-            words = query.strip().split()
-            # If a word contains at least one upper case character or is inside quotes ignore correction for this word
-            corrected_words = [spell.correction(word) or word 
-                            if (word.islower() or word[0] == "'" or word[0] == '"') else word 
-                            for word in words]
-            return " ".join(corrected_words)
-            
-        def generate(query: str, context: list[str], model=self.generative_model):
-            assert type(context) == list
-            system_prompt = '''
-You are an assistant that answers questions strictly based on the CONTEXTS below.
-Do not use external knowledge or guess. If the answer is missing, say: "I don't know the answer."
-Keep responses concise (1-2 sentences unless more detail is needed).
-'''
-            system_prompt += ''.join(['\n\n<CONTEXT>\n' + item + '\n</CONTEXT>' for item in context])
-            
-            response = self.groq.chat.completions.create(
-                messages=[
-                        {
-                            "role": "system",
-                            "content": system_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": query
-                        }
-                ],
-                model=model,
-            )
-            return {
-                'answer' : response.choices[0].message.content,
-                'usage' : {
-                    'completion_time': response.usage.completion_time,
-                    'prompt_time': response.usage.prompt_time,
-                    'total_time': response.usage.total_time,
-
-                    'completion_tokens': response.usage.completion_tokens,
-                    'prompt_tokens': response.usage.prompt_tokens,
-                    'total_tokens': response.usage.total_tokens,
-                }
-            }
-        
+                A dictionary containing the generated answer, its sources and usage statistics,
+                including the `model` that answered.
+        '''
+
         if not query:
             return
         if int(spelling):
-            query = check_spelling(query)
-        text_results = [item['text'] for item in context]
-        sources = {item['source'] for item in context}
-        results = generate(query=query, context=text_results)
+            query = self.check_spelling(query, spelling)
+        context, packing = self.pack_context(context, generative_model, token_budget)
+        response, generation = self.scheduler.complete(
+            self.groq,
+            self.messages(query, [item['text'] for item in context]),
+            generative_model or self.generative_model,
+            fallback_model=fallback_model,
+            latency_slo=latency_slo,
+            hedge=hedge,
+        )
+        count_tokens(response.usage)
         return {
-            'answer': results['answer'],
-            'sources': ["https://{}.wikipedia.org/wiki/".\
-                format(self.language_code) + source for source in sources],
-            'usage': results['usage'],
-        }
\ No newline at end of file
+            'answer': response.choices[0].message.content,
+            'sources': self.source_urls(context),
+            'usage': {**usage_dict(response.usage), **packing, **generation},
+        }
+
+
+    def answer_stream(self, query: str, context: list[dict], spelling=0, generative_model=None, token_budget=0,
+                      fallback_model=None, latency_slo=0.0, hedge=False):
+        '''
+        Generates an answer like `answer` but relays the tokens of the generative model as they arrive.
+
+            Yields:
+                * **('token', str)** for every piece of the answer.
+                * **('answer', dict)** once at the end, with the same keys as the result of `answer`.
+        '''
+
+        if not query:
+            return
+        if int(spelling):
+            query = self.check_spelling(query, spelling)
+        context, packing = self.pack_context(context, generative_model, token_budget)
+        start = time.perf_counter()
+        (stream, first), generation = self.scheduler.complete(
+            self.groq,
+            self.messages(query, [item['text'] for item in context]),
+            generative_model or self.generative_model,
+            fallback_model=fallback_model,
+            latency_slo=latency_slo,
+            hedge=hedge,
+            stream=True,
+        )
+        parts = []
+        usage = None
+        for chunk in itertools.chain([first] if first else [], stream):
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield 'token', chunk.choices[0].delta.content
+            # Groq reports the usage of a streamed completion in the last chunk
+            if chunk.x_groq and chunk.x_groq.usage:
+                usage = chunk.x_groq.usage
+            elif chunk.usage:
+                usage = chunk.usage
+        # the time spent by the consumer between two tokens is included
+        metrics.record('generate', time.perf_counter() - start)
+        count_tokens(usage)
+        yield 'answer', {
+            'answer': ''.join(parts),
+            'sources': self.source_urls(context),
+            'usage': {**usage_dict(usage), **packing, **generation},
+        }
+
+
+
+    def answer_batch(self, queries: list, result_number_per_page=3, length=1800, overlap=180, unit='characters',
+                     top_k=4, threshold=0.3, retriever='numpy', spelling=0, generative_model=None, token_budget=0,
+                     fallback_model=None, latency_slo=0.0, hedge=False, max_concurrent_answers=4, max_keywords=0):
+        '''
+        Answers many queries sharing their retrieval: the distinct searches run once, the union of their pages
+        is downloaded, chunked and embedded once, all the queries are retrieved with a single batched search
+        and at most `max_concurrent_answers` answers are generated at the same time.
+        With an offline index, all the queries are retrieved from it with a single batched search instead.
+
+            Params:
+                * **queries (list)**: The queries, as strings or as dictionaries with a `query` and an optional `topic`.
+                * **result_number_per_page (int)**, **length**, **overlap**, **unit**: See `wikisearch` and `ingest`.
+                * **top_k (int)**, **threshold (float)**, **retriever (str)**: See `search_chunks`.
+                * **spelling (int)**, **generative_model (str)**, **token_budget (int)**, **fallback_model (str)**,
+                  **latency_slo (float)**, **hedge (bool)**: See `answer`.
+                * **max_concurrent_answers (int)**: The number of answers generated at the same time.
+                * **max_keywords (int)**: See `extract_keywords`.
+
+            Returns:
+                A list with the result of `answer` for every query, in order, or the exception raised while answering it.
+        '''
+
+        items = self.batch_items(queries, max_keywords)
+        if self.index:
+            ready = [i for i, item in enumerate(items) if not isinstance(item, Exception)]
+            contexts = self.search_index([items[i][0] for i in ready], top_k=top_k, threshold=threshold)
+        else:
+            searches = {}
+            for item in items:
+                if not isinstance(item, Exception) and tuple(item[2]) not in searches:
+                    searches[tuple(item[2])] = self.fetcher.executor.submit(self.wikisearch, item[2], result_number_per_page)
+            searches = {keywords: future.exception() or future.result() for keywords, future in searches.items()}
+            items, keys = batch_page_keys(items, searches)
+
+            chunks = self.ingest(keys, length=length, overlap=overlap, unit=unit)
+            ready = [i for i, item in enumerate(items) if not isinstance(item, Exception)]
+            contexts = self.search_chunks_batch([items[i][0] for i in ready], [items[i][2] for i in ready], chunks,
+                                                top_k=top_k, threshold=threshold, retriever=retriever)
+
+        results = list(items)
+        with ThreadPoolExecutor(max_workers=max_concurrent_answers, thread_name_prefix='widiscover-answer') as executor:
+            answers = {i: executor.submit(self.answer, items[i][0], context, spelling=spelling,
+                                          generative_model=generative_model, token_budget=token_budget,
+                                          fallback_model=fallback_model, latency_slo=latency_slo, hedge=hedge)
+                       for i, context in zip(ready, contexts)}
+            for i, future in answers.items():
+                results[i] = future.exception() or future.result()
+        return results
+
+
+def chunk_document(text: str, source: str, length=1800, overlap=180, unit='characters', token_chunker: TokenChunker = None):
+    '''
+        Splits a markdown document into overlapping chunks, see `Widiscover.process_docs`.
+        The offline index build (`dump_index.py`) uses it without an engine.
+    '''
+
+    if not text:
+        return []
+    headings = section_headings(text)
+    if unit == 'tokens':
+        return [{
+            'metadata':{
+                'text':text[start:end],
+                'source':source,
+                'section':section_at(headings, start),
+                'start':start,
+                'end':end,
+                },
+        } for start, end in token_chunker.spans(text, length=length, overlap=overlap)]
+    chunks = []
+    offset = 0
+    text_len = len(text)
+    while True:
+        chunk = text[offset:offset+length]
+        chunks.append({
+            'metadata':{
+                'text':chunk,
+                'source':source,
+                'section':section_at(headings, offset),
+                'start':offset,
+                'end':offset + len(chunk),
+                },
+        })
+        if offset + length >= text_len:
+            break
+        offset += length - overlap
+    return chunks
+
+
+def batch_page_keys(items: list, searches: dict):
+    '''
+        Resolves the items of `Widiscover.batch_items` with the results of their searches (keywords tuple -> page keys or exception).
+            Returns:
+                tuple: The items with the page keys of every query (or its exception), and the union of all the page keys.
+    '''
+
+    resolved = []
+    for item in items:
+        if not isinstance(item, Exception):
+            found = searches[tuple(item[2])]
+            item = found if isinstance(found, Exception) else (item[0], item[1], found or [])
+        resolved.append(item)
+    keys = list(dict.fromkeys(key for item in resolved if not isinstance(item, Exception) for key in item[2]))
+    return resolved, keys
+
+
+def revalidation_headers(cached):
+    '''
+        Returns the headers revalidating a stale page cache entry with its ETag,
+        so that an unchanged page isn't downloaded and converted again.
+    '''
+
+    if cached and cached['etag']:
+        return {'If-None-Match': cached['etag']}
+    return None
+
+
+def count_tokens(usage):
+    '''
+        Adds the tokens of a Groq completion to the `widiscover_tokens_total` counter.
+    '''
+
+    if usage is not None:
+        metrics.count('widiscover_tokens_total', usage.prompt_tokens or 0, kind='prompt')
+        metrics.count('widiscover_tokens_total', usage.completion_tokens or 0, kind='completion')
+
+
+def usage_dict(usage):
+    '''
+        Converts the usage statistics of a Groq completion to the dictionary returned by the API.
+    '''
+
+    if usage is None:
+        return {}
+    return {
+        'completion_time': usage.completion_time,
+        'prompt_time': usage.prompt_time,
+        'total_time': usage.total_time,
+
+        'completion_tokens': usage.completion_tokens,
+        'prompt_tokens': usage.prompt_tokens,
+        'total_tokens': usage.total_tokens,
+    }
@@ -0,0 +1,231 @@
+import time
+import random
+import threading
+import email.utils
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    '''
+        A thread safe token bucket limiting the rate of outgoing requests.
+        One bucket is shared by every request of the process so that the global rate towards Wikipedia stays bounded.
+    '''
+
+    def __init__(self, rate: float = 5.0, capacity: int = 10):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def reserve(self, tokens: float = 1.0):
+        '''
+            Takes the tokens from the bucket, going into debt if needed.
+                Returns:
+                    float: The number of seconds the caller has to wait before using the tokens.
+        '''
+
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+    def acquire(self, tokens: float = 1.0):
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+
+    def pause(self, seconds: float):
+        '''
+            Empties the bucket for the given number of seconds, e.g. after the server answered with `Retry-After`.
+        '''
+
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+def retry_after(response):
+    '''
+        Parses the `Retry-After` header of a `requests` or `httpx` response.
+            Returns:
+                float or None: The number of seconds to wait, or None if the header is missing or invalid.
+    '''
+
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class WikiFetcher:
+    '''
+        HTTP layer for the Wikipedia APIs: a pooled keep-alive session, a process wide rate limiter,
+        bounded concurrent downloads, timeouts and retries with exponential backoff.
+    '''
+
+    def __init__(self,
+        headers: dict = None,
+        requests_per_second: float = 5.0,
+        burst: int = 10,
+        max_workers: int = 4,
+        timeout: float = 10.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(max_workers, 10))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self.limiter = TokenBucket(rate=requests_per_second, capacity=burst)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='wikifetch')
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+
+    def get(self, url: str, params: dict = None, headers: dict = None):
+        '''
+            Sends a GET request through the rate limiter, retrying on connection errors, 429 and 5xx responses.
+                Args:
+                    url (str): The requested URL.
+                    params (dict): Optional query parameters.
+                    headers (dict): Optional headers added to the session headers.
+                Returns:
+                    requests.Response: The last response received.
+                Raises:
+                    requests.RequestException: If the request failed on every attempt without a response.
+        '''
+
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return response
+                delay = retry_after(response)
+                if delay is not None:
+                    # the server told us how long to back off: slow down every request of the process, not only this one,
+                    # the next acquire() waits for it
+                    self.limiter.pause(min(delay, self.max_backoff))
+                    attempt += 1
+                    continue
+            # full jitter exponential backoff
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            attempt += 1
+
+
+    def map(self, function, items):
+        '''
+            Applies `function` to every item on the download threads.
+                Yields:
+                    The results in the order of `items` as soon as each one is available.
+        '''
+
+        futures = [self.executor.submit(function, item) for item in items]
+        for future in futures:
+            yield future.result()
+
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+class AsyncWikiFetcher:
+    '''
+        Asynchronous counterpart of `WikiFetcher` built on `httpx.AsyncClient`.
+        It shares the token bucket of the synchronous fetcher, so both stay under the same process wide rate.
+    '''
+
+    def __init__(self,
+        limiter: TokenBucket,
+        headers: dict = None,
+        max_connections: int = 4,
+        timeout: float = 10.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ):
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max(max_connections, 10), max_keepalive_connections=max(max_connections, 10)))
+        self.limiter = limiter
+        # bounds the concurrent page downloads like the thread pool of `WikiFetcher`
+        self.downloads = asyncio.Semaphore(max_connections)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+
+    async def get(self, url: str, params: dict = None, headers: dict = None):
+        '''
+            Sends a GET request through the rate limiter, retrying on connection errors, 429 and 5xx responses.
+                Returns:
+                    httpx.Response: The last response received.
+                Raises:
+                    httpx.HTTPError: If the request failed on every attempt without a response.
+        '''
+
+        attempt = 0
+        while True:
+            delay = self.limiter.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                response = await self.client.get(url, params=params, headers=headers)
+            except httpx.TransportError:
+                if attempt >= self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                    return response
+                delay = retry_after(response)
+                if delay is not None:
+                    self.limiter.pause(min(delay, self.max_backoff))
+                    attempt += 1
+                    continue
+            await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            attempt += 1
+
+
+    async def aclose(self):
+        await self.client.aclose()